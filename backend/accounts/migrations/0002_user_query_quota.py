@@ -0,0 +1,23 @@
+# Generated by Django 5.0 on 2026-10-19 18:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='queries_this_month',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='quota_period',
+            field=models.DateField(blank=True, help_text='First day of the month queries_this_month counts', null=True),
+        ),
+    ]
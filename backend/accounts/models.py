@@ -15,6 +15,10 @@ class User(AbstractUser):
     max_documents_per_chatbot = models.IntegerField(default=10)
     max_queries_per_month = models.IntegerField(default=100)
     
+    # Monthly usage counter, reset lazily when a query lands in a new month
+    queries_this_month = models.IntegerField(default=0)
+    quota_period = models.DateField(null=True, blank=True, help_text="First day of the month queries_this_month counts")
+    
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     last_login_at = models.DateTimeField(null=True, blank=True)
@@ -31,8 +31,9 @@ class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ['id', 'email', 'username', 'first_name', 'last_name', 'full_name', 'organization', 
-                  'phone', 'plan', 'max_chatbots', 'chatbot_count', 'can_create_chatbot', 'created_at']
-        read_only_fields = ['id', 'email', 'plan', 'created_at']
+                  'phone', 'plan', 'max_chatbots', 'chatbot_count', 'can_create_chatbot',
+                  'max_queries_per_month', 'queries_this_month', 'created_at']
+        read_only_fields = ['id', 'email', 'plan', 'max_queries_per_month', 'queries_this_month', 'created_at']
 
 class UserUpdateSerializer(serializers.ModelSerializer):
     class Meta:
@@ -0,0 +1,110 @@
+"""
+Benchmark JSON rendering and response compression for a long conversation history.
+
+    cd backend && python benchmarks/bench_serialization.py [--messages 1000] [--repeat 20]
+
+Builds the body ``conversation_history`` returns for a conversation of
+``--messages`` messages with chunk previews requested, renders it with DRF's
+JSONRenderer and with the orjson renderer, then compresses it the way
+``CompressionMiddleware`` does. Times are medians over ``--repeat`` runs.
+"""
+
+import argparse
+import gzip
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ragbot_backend.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+import orjson  # noqa: E402
+from rest_framework.renderers import JSONRenderer  # noqa: E402
+
+from ragbot_backend import compression  # noqa: E402
+from ragbot_backend.renderers import ORJSONRenderer  # noqa: E402
+
+
+def conversation_body(messages, seed=0):
+    rng = random.Random(seed)
+    words = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(2, 10))) for _ in range(3000)]
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    def text(n):
+        return ' '.join(rng.choices(words, k=n))
+
+    rows = []
+    for i in range(messages):
+        assistant = i % 2 == 1
+        rows.append({
+            'id': i + 1,
+            'role': 'assistant' if assistant else 'user',
+            'content': text(rng.randint(60, 200) if assistant else rng.randint(8, 30)),
+            'created_at': start + timedelta(seconds=37 * i, microseconds=rng.randint(0, 999999)),
+            'tokens_used': rng.randint(200, 900) if assistant else None,
+            'context_used': [
+                {
+                    'chunk_id': rng.randint(1, 50000),
+                    'similarity': round(rng.random(), 4),
+                    'document': f'document-{rng.randint(1, 40)}.pdf',
+                    'content_preview': text(30)[:200] + '...',
+                }
+                for _ in range(3)
+            ] if assistant else [],
+        })
+    return {
+        'conversation_id': 1,
+        'title': 'Benchmark conversation',
+        'created_at': start,
+        'messages': rows,
+        'before': None,
+        'after': None,
+        'has_before': False,
+        'has_after': False,
+    }
+
+
+def median_seconds(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return result, statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    body = conversation_body(args.messages)
+
+    print(f"{'step':>22} {'ms':>9} {'bytes':>10}")
+    for name, renderer in (('render DRF json', JSONRenderer()), ('render orjson', ORJSONRenderer())):
+        rendered, seconds = median_seconds(lambda: renderer.render(body), args.repeat)
+        print(f"{name:>22} {seconds * 1000:>9.2f} {len(rendered):>10}")
+
+    for name, loads in (('parse json', json.loads), ('parse orjson', orjson.loads)):
+        _, seconds = median_seconds(lambda: loads(rendered), args.repeat)
+        print(f"{name:>22} {seconds * 1000:>9.2f} {len(rendered):>10}")
+
+    for encoding in compression.available_encodings():
+        compressed, seconds = median_seconds(lambda: compression.compress(rendered, encoding), args.repeat)
+        print(f"{'compress ' + encoding:>22} {seconds * 1000:>9.2f} {len(compressed):>10}")
+    if 'br' not in compression.available_encodings():
+        print("brotli is not installed; only gzip was measured")
+    assert json.loads(gzip.decompress(compression.compress(rendered, 'gzip'))) == json.loads(rendered)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Benchmark the token-aware splitter against langchain's RecursiveCharacterTextSplitter.
+
+    cd backend && python benchmarks/bench_text_splitter.py [--sizes-mb 1 5 20]
+
+The recursive splitter runs with the old ingestion settings (500/50 characters)
+and, for a like-for-like comparison, measuring length with tiktoken (128/16
+tokens). The token splitter uses the chatbot defaults (128/16 tokens, roughly
+the same amount of text per chunk). All see the same synthetic text.
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter  # noqa: E402
+
+from services.text_splitter import TokenTextSplitter, clear_token_cache, count_tokens  # noqa: E402
+
+
+def synthetic_text(size_bytes, seed=0):
+    rng = random.Random(seed)
+    vocabulary = [
+        ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(2, 11)))
+        for _ in range(5000)
+    ]
+    parts, total = [], 0
+    while total < size_bytes:
+        sentences = []
+        for _ in range(rng.randint(2, 8)):
+            words = rng.choices(vocabulary, k=rng.randint(6, 24))
+            sentences.append(' '.join(words).capitalize() + '.')
+        paragraph = ' '.join(sentences)
+        if rng.random() < 0.3:
+            paragraph = paragraph.replace('. ', '.\n', 1)
+        parts.append(paragraph)
+        total += len(paragraph) + 2
+    return '\n\n'.join(parts)
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes-mb', type=float, nargs='+', default=[1, 5, 20])
+    args = parser.parse_args()
+
+    recursive = RecursiveCharacterTextSplitter(
+        chunk_size=500, chunk_overlap=50, length_function=len, separators=["\n\n", "\n", " ", ""]
+    )
+
+    recursive_tokens = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+        encoding_name='cl100k_base', chunk_size=128, chunk_overlap=16
+    )
+
+    print(f"{'size':>8} {'splitter':>10} {'seconds':>9} {'MB/s':>7} {'chunks':>8} {'tokens p50':>11} {'tokens max':>11}")
+    for size_mb in args.sizes_mb:
+        text = synthetic_text(int(size_mb * 1024 * 1024))
+        for name, splitter in (('recursive', recursive), ('rec-tokens', recursive_tokens), ('token', None)):
+            if splitter is None:
+                clear_token_cache()  # measure with a cold word cache
+                splitter = TokenTextSplitter(chunk_size=128, chunk_overlap=16)
+            chunks, seconds = timed(lambda: splitter.split_text(text))
+            sizes = [count_tokens(chunk) for chunk in chunks[:2000]]
+            print(f"{size_mb:>6.1f}MB {name:>10} {seconds:>9.2f} {size_mb / seconds:>7.1f} "
+                  f"{len(chunks):>8} {statistics.median(sizes):>11.0f} {max(sizes):>11}")
+
+
+if __name__ == '__main__':
+    main()
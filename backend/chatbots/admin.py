@@ -7,18 +7,31 @@ class ChatbotAdmin(admin.ModelAdmin):
     list_filter = ['is_active', 'created_at']
     search_fields = ['name', 'owner__email']
     readonly_fields = ['created_at', 'updated_at', 'document_count', 'conversation_count']
+    list_select_related = ['owner']
     
     fieldsets = (
         ('Basic Info', {
             'fields': ('owner', 'name', 'description', 'is_active')
         }),
         ('Configuration', {
-            'fields': ('system_prompt', 'temperature', 'max_tokens')
+            'fields': ('system_prompt', 'temperature', 'max_tokens', 'chunk_size', 'chunk_overlap')
+        }),
+        ('Retrieval', {
+            'fields': ('mmr_enabled', 'mmr_lambda', 'duplicate_threshold', 'embedding_reduction', 'embedding_dimensions')
+        }),
+        ('Latency', {
+            'fields': ('response_deadline_seconds',)
+        }),
+        ('Retention', {
+            'fields': ('message_retention_days',)
         }),
         ('Statistics', {
             'fields': ('document_count', 'conversation_count', 'created_at', 'updated_at')
         }),
     )
+    
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_counts()
 
 @admin.register(Conversation)
 class ConversationAdmin(admin.ModelAdmin):
@@ -26,6 +39,10 @@ class ConversationAdmin(admin.ModelAdmin):
     list_filter = ['created_at']
     search_fields = ['title', 'chatbot__name']
     readonly_fields = ['created_at', 'updated_at', 'message_count']
+    list_select_related = ['chatbot__owner', 'user']
+    
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_message_count()
 
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
@@ -33,6 +50,7 @@ class MessageAdmin(admin.ModelAdmin):
     list_filter = ['role', 'created_at']
     search_fields = ['content']
     readonly_fields = ['created_at']
+    list_select_related = ['conversation__chatbot']
     
     def content_preview(self, obj):
         return obj.content[:50] + "..." if len(obj.content) > 50 else obj.content
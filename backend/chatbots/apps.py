@@ -1,6 +1,24 @@
+import os
+import sys
+
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class ChatbotsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chatbots'
+
+    def ready(self):
+        if settings.RAG_PREWARM_ON_STARTUP and _is_server_process():
+            from services.vector_index import start_prewarm_thread
+
+            start_prewarm_thread()
+
+
+def _is_server_process():
+    """True for web workers; false for migrate, shell and other management commands"""
+    if os.path.basename(sys.argv[0]) != 'manage.py':
+        return True
+    # runserver's autoreloader parent never serves requests
+    return sys.argv[1:2] == ['runserver'] and os.environ.get('RUN_MAIN') == 'true'
@@ -1,20 +1,53 @@
+import math
+
 from rest_framework import status
+from rest_framework.exceptions import NotFound
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
+from django.db import transaction
+from django.db.models import F
+from django.http import Http404
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
 
 from chatbots.models import Chatbot, Conversation, Message
+from chatbots.serializers import RetrievalFilterSerializer, chunk_previews, context_entries, wants_previews
+from ragbot_backend.conditional import conditional_response
+from ragbot_backend.db_router import mark_conversation_written, read_conversation_from_primary_if_recent
+from ragbot_backend.pagination import KeysetPagination
+from services import reaper
+from services.deadline import Deadline
 from services.rag_service import rag_service
+from services.usage_limits import (
+    check_chat_rate_limits,
+    consume_query_quota,
+    refund_query_quota,
+    seconds_until_next_period,
+)
+
+
+def _too_many_requests(message, retry_after):
+    response = Response({'error': message}, status=status.HTTP_429_TOO_MANY_REQUESTS)
+    response['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
 
 
 @api_view(['POST'])
 @permission_classes([AllowAny])  # Allow anonymous users to chat
 def chat_endpoint(request, chatbot_id):
+    # Owner whose query is counted until the turn is saved; refunded on errors
+    charged_owner_id = None
     try:
+        # Throttle before touching the database
+        retry_after = check_chat_rate_limits(request, chatbot_id)
+        if retry_after:
+            return _too_many_requests('Rate limit exceeded. Please slow down.', retry_after)
+
         # Get chatbot
-        chatbot = get_object_or_404(Chatbot, id=chatbot_id, is_active=True)
+        # Deleted chatbots are hidden by the default manager; DoesNotExist answers 404 below
+        chatbot = Chatbot.objects.annotate(owner_plan=F('owner__plan')).get(id=chatbot_id, is_active=True)
+        deadline = Deadline(chatbot.response_deadline_seconds)
 
         # Get user message
         user_message = request.data.get('message', '').strip()
@@ -24,60 +57,100 @@ def chat_endpoint(request, chatbot_id):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        # Get or create conversation
-        conversation_id = request.data.get('conversation_id')
-        if conversation_id:
-            conversation = get_object_or_404(
-                Conversation,
-                id=conversation_id,
-                chatbot=chatbot
-            )
-        else:
-            # Create new conversation
-            conversation = Conversation.objects.create(
-                chatbot=chatbot,
-                user=request.user if request.user.is_authenticated else None,
-                title=user_message[:50] + '...' if len(user_message) > 50 else user_message
-            )
+        conversation_id = request.data.get('conversation_id') or None
+        if conversation_id is not None:
+            try:
+                conversation_id = int(conversation_id)
+            except (TypeError, ValueError):
+                return Response({'error': 'Invalid conversation_id'}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Save user message
-        user_msg = Message.objects.create(
-            conversation=conversation,
-            role='user',
-            content=user_message
-        )
+        # Optional restriction of retrieval to some documents
+        retrieval_filter = None
+        if request.data.get('filter'):
+            filter_serializer = RetrievalFilterSerializer(data=request.data['filter'])
+            if not filter_serializer.is_valid():
+                return Response(
+                    {'error': 'Invalid filter', 'details': filter_serializer.errors},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            retrieval_filter = filter_serializer.validated_data
 
-        # Get conversation history (last 5 messages for context)
+        # Count the query against the owner's monthly quota
+        if not consume_query_quota(chatbot.owner_id):
+            return _too_many_requests(
+                'Monthly query limit reached for this chatbot.',
+                seconds_until_next_period()
+            )
+        charged_owner_id = chatbot.owner_id
+
+        # Existing conversation: ownership check, updated_at bump and history in one query
         history = []
-        previous_messages = conversation.messages.order_by('-created_at')[:5]
-        for msg in reversed(list(previous_messages)):
-            if msg.id != user_msg.id:  # Don't include the message we just created
-                history.append({
-                    'role': msg.role,
-                    'content': msg.content
-                })
+        if conversation_id:
+            history = Conversation.objects.touch_with_history(conversation_id, chatbot.id, limit=5)
+            if history is None:
+                refund_query_quota(chatbot.owner_id)
+                return Response({'error': 'Conversation not found'}, status=status.HTTP_404_NOT_FOUND)
 
         # Generate AI response using RAG
         rag_result = rag_service.generate_response(
             chatbot=chatbot,
             user_message=user_message,
-            conversation_history=history
+            conversation_history=history,
+            retrieval_filter=retrieval_filter,
+            deadline=deadline
         )
 
+        if rag_result.get('queue_timeout'):
+            refund_query_quota(chatbot.owner_id)
+            return _too_many_requests(
+                "Too many questions to this owner's chatbots are being answered. Please retry shortly.",
+                rag_result['retry_after']
+            )
+
+        if rag_result.get('timed_out'):
+            refund_query_quota(chatbot.owner_id)
+            return Response(
+                {'error': 'The response took too long. Please try again.'},
+                status=status.HTTP_504_GATEWAY_TIMEOUT
+            )
+
         if not rag_result['success']:
+            refund_query_quota(chatbot.owner_id)
             return Response(
                 {'error': rag_result.get('error', 'Failed to generate response')},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
-        # Save AI response
-        ai_msg = Message.objects.create(
-            conversation=conversation,
-            role='assistant',
-            content=rag_result['response'],
-            context_used=rag_result.get('chunks_used', []),
-            tokens_used=rag_result.get('tokens_used', 0)
-        )
+        # Persist the whole turn at once: the new conversation, if any, and both messages
+        with transaction.atomic():
+            if conversation_id:
+                conversation = Conversation(id=conversation_id, chatbot=chatbot)
+            else:
+                conversation = Conversation.objects.create(
+                    chatbot=chatbot,
+                    user=request.user if request.user.is_authenticated else None,
+                    title=user_message[:50] + '...' if len(user_message) > 50 else user_message
+                )
+            user_msg, ai_msg = Message.objects.bulk_create([
+                Message(
+                    conversation=conversation,
+                    role='user',
+                    content=user_message
+                ),
+                Message(
+                    conversation=conversation,
+                    role='assistant',
+                    content=rag_result['response'],
+                    context_chunk_ids=[chunk['chunk_id'] for chunk in rag_result.get('chunks_used', [])],
+                    context_scores=[chunk['similarity'] for chunk in rag_result.get('chunks_used', [])],
+                    tokens_used=rag_result.get('tokens_used', 0),
+                    prompt_tokens_saved=rag_result.get('prompt_tokens_saved', 0),
+                    degraded_paths=rag_result.get('degraded', [])
+                ),
+            ])
+        charged_owner_id = None
+        # Keep this conversation's history reads on the primary until replicas catch up
+        mark_conversation_written(conversation.id)
 
         # Return response
         return Response({
@@ -91,7 +164,10 @@ def chat_endpoint(request, chatbot_id):
                 'id': ai_msg.id,
                 'content': ai_msg.content,
                 'created_at': ai_msg.created_at,
-                'tokens_used': ai_msg.tokens_used
+                'tokens_used': ai_msg.tokens_used,
+                'prompt_tokens_saved': ai_msg.prompt_tokens_saved,
+                'degraded_paths': ai_msg.degraded_paths,
+                'coalesced': rag_result.get('coalesced', False)
             },
             'context': rag_result.get('chunks_used', [])
         })
@@ -102,6 +178,8 @@ def chat_endpoint(request, chatbot_id):
             status=status.HTTP_404_NOT_FOUND
         )
     except Exception as e:
+        if charged_owner_id is not None:
+            refund_query_quota(charged_owner_id)
         return Response(
             {'error': str(e)},
             status=status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -113,34 +191,58 @@ def chat_endpoint(request, chatbot_id):
 def conversation_history(request, conversation_id):
 
     try:
-        conversation = get_object_or_404(Conversation, id=conversation_id)
+        read_conversation_from_primary_if_recent(conversation_id)
+        conversation = get_object_or_404(Conversation.objects.select_related('chatbot'), id=conversation_id)
 
         # Check user has access
-        if request.user != conversation.chatbot.owner and conversation.user != request.user:
+        if request.user.pk != conversation.chatbot.owner_id and conversation.user_id != request.user.pk:
             return Response(
                 {'error': 'Access denied'},
                 status=status.HTTP_403_FORBIDDEN
             )
 
-        messages = conversation.messages.order_by('created_at')
-
-        return Response({
-            'conversation_id': conversation.id,
-            'title': conversation.title,
-            'created_at': conversation.created_at,
-            'messages': [
+        def build():
+            # Latest page by default; ?before= loads older messages, ?after= polls newer ones
+            paginator = KeysetPagination('created_at', start_from_end=True)
+            messages = paginator.paginate_queryset(conversation.messages.all(), request)
+            # Chunk refs only, unless the client asks for previews (one query per page)
+            previews = chunk_previews(messages) if wants_previews(request) else None
+            page = paginator.get_paginated_data([
                 {
                     'id': msg.id,
                     'role': msg.role,
                     'content': msg.content,
                     'created_at': msg.created_at,
                     'tokens_used': msg.tokens_used,
-                    'context_used': msg.context_used
+                    'context_used': context_entries(msg, previews)
                 }
                 for msg in messages
-            ]
-        })
+            ])
+            return {
+                'conversation_id': conversation.id,
+                'title': conversation.title,
+                'created_at': conversation.created_at,
+                'messages': page.pop('results'),
+                **page
+            }
 
+        # Polls of an unchanged conversation get a 304 from one watermark query
+        return conditional_response(request, [
+            (Conversation.objects.filter(id=conversation.id), 'updated_at'),
+            (Message.objects.filter(conversation_id=conversation.id), 'id'),
+        ], build)
+
+    except Http404:
+        # Also covers conversations deleted but not reaped yet
+        return Response(
+            {'error': 'Conversation not found'},
+            status=status.HTTP_404_NOT_FOUND
+        )
+    except NotFound as e:
+        return Response(
+            {'error': str(e.detail)},
+            status=status.HTTP_404_NOT_FOUND
+        )
     except Exception as e:
         return Response(
             {'error': str(e)},
@@ -166,13 +268,20 @@ def delete_conversation(request, conversation_id):
                 status=status.HTTP_403_FORBIDDEN
             )
 
-        conversation.delete()
+        # Hidden at once; messages are deleted in batches in the background
+        Conversation.objects.filter(pk=conversation.pk).soft_delete()
+        reaper.schedule_reap()
 
         return Response(
             {'message': 'Conversation deleted'},
             status=status.HTTP_204_NO_CONTENT
         )
 
+    except Http404:
+        return Response(
+            {'error': 'Conversation not found'},
+            status=status.HTTP_404_NOT_FOUND
+        )
     except Exception as e:
         return Response(
             {'error': str(e)},
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from services.message_archive import archive_expired_conversations
+
+
+class Command(BaseCommand):
+    help = (
+        "Archive conversations past their chatbot's retention period to compressed NDJSON and "
+        "delete them in small batches; also creates upcoming message partitions and drops empty old ones"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chatbot', type=int, action='append', dest='chatbot_ids',
+                            help="Only apply the retention policy of this chatbot (repeatable)")
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help="Conversations archived and deleted per transaction")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Report what would be archived without writing or deleting anything")
+
+    def handle(self, *args, **options):
+        results = archive_expired_conversations(
+            chatbot_ids=options['chatbot_ids'],
+            batch_size=options['batch_size'],
+            dry_run=options['dry_run'],
+        )
+        verb = 'would archive' if options['dry_run'] else 'archived'
+        for entry in results:
+            line = f"chatbot {entry['chatbot_id']}: {verb} {entry['conversations']} conversations, {entry['messages']} messages"
+            if entry['file']:
+                line += f" to {entry['file']}"
+            self.stdout.write(line)
+        self.stdout.write(self.style.SUCCESS(
+            f"{sum(entry['conversations'] for entry in results)} conversations {verb}"
+        ))
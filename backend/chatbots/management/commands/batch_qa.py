@@ -0,0 +1,82 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbots.models import Chatbot
+from chatbots.serializers import RetrievalFilterSerializer
+from services.batch_qa import answer_questions
+
+
+class Command(BaseCommand):
+    help = "Answer a file of questions against a chatbot and write NDJSON results"
+
+    def add_arguments(self, parser):
+        parser.add_argument('chatbot_id', type=int)
+        parser.add_argument(
+            'questions',
+            help="File with one question per line, or JSON lines with a \"question\" key ('-' for stdin)"
+        )
+        parser.add_argument('--output', help="NDJSON file to write (default: stdout)")
+        parser.add_argument('--top-k', type=int, default=5)
+        parser.add_argument('--concurrency', type=int, help="Concurrent LLM calls (default: BATCH_QA_CONCURRENCY)")
+        parser.add_argument('--filter', help="Retrieval filter as JSON, e.g. '{\"file_types\": [\"pdf\"]}'")
+
+    def handle(self, *args, **options):
+        try:
+            chatbot = Chatbot.objects.get(id=options['chatbot_id'])
+        except Chatbot.DoesNotExist:
+            raise CommandError(f"Chatbot {options['chatbot_id']} does not exist")
+
+        filters = None
+        if options['filter']:
+            try:
+                serializer = RetrievalFilterSerializer(data=json.loads(options['filter']))
+            except ValueError as e:
+                raise CommandError(f"Invalid filter JSON: {e}")
+            if not serializer.is_valid():
+                raise CommandError(f"Invalid filter: {serializer.errors}")
+            filters = serializer.validated_data
+
+        if options['questions'] == '-':
+            questions = self._read_questions(sys.stdin)
+        else:
+            with open(options['questions'], encoding='utf-8') as source:
+                questions = self._read_questions(source)
+        if not questions:
+            raise CommandError("No questions found")
+
+        output = open(options['output'], 'w', encoding='utf-8') if options['output'] else None
+        summary = None
+        try:
+            for item in answer_questions(chatbot, questions, filters=filters,
+                                         top_k=options['top_k'], concurrency=options['concurrency']):
+                line = json.dumps(item)
+                if output:
+                    output.write(line + '\n')
+                else:
+                    self.stdout.write(line)
+                if item['type'] == 'summary':
+                    summary = item
+        finally:
+            if output:
+                output.close()
+
+        self.stderr.write(self.style.SUCCESS(
+            f"Answered {summary['succeeded']}/{summary['questions']} questions "
+            f"({summary['total_tokens']} tokens) in {summary['elapsed_ms'] / 1000:.1f}s"
+        ))
+
+    def _read_questions(self, lines):
+        questions = []
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('{'):
+                try:
+                    line = json.loads(line)['question']
+                except (ValueError, KeyError):
+                    raise CommandError(f"Invalid question line: {line[:80]}")
+            questions.append(line)
+        return questions
@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbots.models import Chatbot, Message
+from services.embedding_reduction import DEFAULT_SAMPLE, evaluate
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare a chatbot's retrieval with reduced embeddings against full-dimension search: "
+        "recall@k, index memory and per-query latency"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('chatbot_id', type=int)
+        parser.add_argument('--method', choices=['truncate', 'pca'], default='pca')
+        parser.add_argument('--dimensions', type=int, nargs='+', default=[128, 256, 512],
+                            help="Reduced sizes to evaluate")
+        parser.add_argument('--k', type=int, default=10, help="Recall is measured on the top k results")
+        parser.add_argument('--sample', type=int, default=DEFAULT_SAMPLE,
+                            help="Chunks used as queries")
+        parser.add_argument('--messages', type=int, default=0,
+                            help="Embed this many recent user messages as queries instead of sampling chunks")
+
+    def handle(self, *args, **options):
+        if not Chatbot.objects.filter(id=options['chatbot_id']).exists():
+            raise CommandError(f"Chatbot {options['chatbot_id']} does not exist")
+
+        query_embeddings = None
+        if options['messages']:
+            from services.rag_service import rag_service
+
+            questions = list(
+                Message.objects.filter(conversation__chatbot_id=options['chatbot_id'], role='user')
+                .order_by('-created_at').values_list('content', flat=True)[:options['messages']]
+            )
+            if not questions:
+                raise CommandError("The chatbot has no user messages")
+            query_embeddings = rag_service.embeddings_model.embed_documents(questions)
+
+        reports = evaluate(
+            options['chatbot_id'], options['method'], options['dimensions'], k=options['k'],
+            sample=options['sample'], query_embeddings=query_embeddings,
+        )
+        if not reports:
+            raise CommandError("The chatbot has no embedded chunks")
+
+        baseline = reports[0]
+        for report in reports:
+            saved = 1 - report['bytes'] / baseline['bytes']
+            speedup = baseline['latency_ms'] / report['latency_ms'] if report['latency_ms'] else 0.0
+            self.stdout.write(
+                f"{report['method']:>8} {report['dimensions']:>5} dims: recall@{options['k']} {report['recall']:.3f}, "
+                f"{report['bytes'] / 1024 / 1024:.1f} MB ({saved:.0%} saved), "
+                f"{report['latency_ms']:.2f} ms/query ({speedup:.1f}x), fit {report['fit_seconds']:.2f}s"
+            )
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbots.models import Chatbot
+from services.snapshots import export_snapshot
+
+
+class Command(BaseCommand):
+    help = "Export a chatbot's documents, chunks and embeddings to a snapshot archive"
+
+    def add_arguments(self, parser):
+        parser.add_argument('chatbot_id', type=int)
+        parser.add_argument('output', help="Path of the .zip snapshot to write")
+        parser.add_argument('--no-files', action='store_true', help="Skip the original uploaded files")
+
+    def handle(self, *args, **options):
+        try:
+            chatbot = Chatbot.objects.get(id=options['chatbot_id'])
+        except Chatbot.DoesNotExist:
+            raise CommandError(f"Chatbot {options['chatbot_id']} does not exist")
+
+        with open(options['output'], 'wb') as output:
+            result = export_snapshot(chatbot, output, include_files=not options['no_files'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Exported {result['documents']} documents and {result['chunks']} chunks to {options['output']}"
+        ))
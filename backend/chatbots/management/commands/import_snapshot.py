@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbots.models import Chatbot
+from services.snapshots import SnapshotError, import_snapshot
+
+
+class Command(BaseCommand):
+    help = "Import a snapshot archive into an existing chatbot without re-embedding"
+
+    def add_arguments(self, parser):
+        parser.add_argument('chatbot_id', type=int)
+        parser.add_argument('snapshot', help="Path of the .zip snapshot to read")
+
+    def handle(self, *args, **options):
+        try:
+            chatbot = Chatbot.objects.get(id=options['chatbot_id'])
+        except Chatbot.DoesNotExist:
+            raise CommandError(f"Chatbot {options['chatbot_id']} does not exist")
+
+        try:
+            with open(options['snapshot'], 'rb') as snapshot:
+                result = import_snapshot(chatbot, snapshot)
+        except SnapshotError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {result['documents']} documents and {result['chunks']} chunks into {chatbot.name}"
+        ))
@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from services.reaper import reap
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete soft-deleted chatbots, documents and conversations with their chunks and messages in "
+        "small batches, then remove uploaded files no document references"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.REAP_BATCH_SIZE,
+                            help="Chunks or messages deleted per statement")
+        parser.add_argument('--orphan-grace-seconds', type=int, default=settings.ORPHAN_FILE_GRACE_SECONDS,
+                            help="Keep unreferenced files younger than this")
+
+    def handle(self, *args, **options):
+        summary = reap(batch_size=options['batch_size'], orphan_grace_seconds=options['orphan_grace_seconds'])
+        self.stdout.write(
+            f"{summary['documents']} documents ({summary['chunks']} chunks, {summary['files']} files), "
+            f"{summary['conversations']} conversations ({summary['messages']} messages), "
+            f"{summary['chatbots']} chatbots"
+        )
+        self.stdout.write(self.style.SUCCESS(f"{summary['orphaned_files']} orphaned files removed"))
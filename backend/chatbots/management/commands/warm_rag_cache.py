@@ -0,0 +1,36 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from services.vector_index import prewarm
+
+
+class Command(BaseCommand):
+    help = (
+        "Preload retrieval indexes for the most recently active chatbots; with RAG_INDEX_DIR "
+        "set this publishes the shared index files every worker maps"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=settings.RAG_PREWARM_CHATBOTS,
+                            help="Number of chatbots to warm, most recently active first")
+        parser.add_argument('--memory-mb', type=int, default=settings.RAG_INDEX_MEMORY_MB,
+                            help="Stop adding indexes beyond this much memory")
+        parser.add_argument('--chatbot', type=int, action='append', dest='chatbot_ids',
+                            help="Warm this chatbot (repeatable) instead of the most active ones")
+
+    def handle(self, *args, **options):
+        warmed = prewarm(
+            chatbot_ids=options['chatbot_ids'],
+            limit=options['limit'],
+            memory_budget=options['memory_mb'] * 1024 * 1024,
+        )
+        for entry in warmed:
+            state = 'already cached' if entry['cached'] else 'loaded'
+            self.stdout.write(
+                f"chatbot {entry['chatbot_id']}: {entry['rows']} chunks, "
+                f"{entry['bytes'] / 1024 / 1024:.1f} MB {state}"
+            )
+        total = sum(entry['bytes'] for entry in warmed)
+        self.stdout.write(self.style.SUCCESS(
+            f"Warmed {len(warmed)} chatbots ({total / 1024 / 1024:.1f} MB)"
+        ))
@@ -0,0 +1,23 @@
+# Generated by Django 5.0 on 2026-10-19 18:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbots', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatbot',
+            name='chunk_overlap',
+            field=models.IntegerField(default=16, help_text='Tokens shared between consecutive chunks'),
+        ),
+        migrations.AddField(
+            model_name='chatbot',
+            name='chunk_size',
+            field=models.IntegerField(default=128, help_text='Tokens per document chunk'),
+        ),
+    ]
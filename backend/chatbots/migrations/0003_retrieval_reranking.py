@@ -0,0 +1,33 @@
+# Generated by Django 5.0 on 2026-10-19 18:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbots', '0002_chatbot_chunking'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatbot',
+            name='duplicate_threshold',
+            field=models.FloatField(default=0.0, help_text='Drop retrieved chunks at least this similar to a better one (0 = off, e.g. 0.95)'),
+        ),
+        migrations.AddField(
+            model_name='chatbot',
+            name='mmr_enabled',
+            field=models.BooleanField(default=False, help_text='Re-rank retrieved chunks with Maximal Marginal Relevance for more diverse context'),
+        ),
+        migrations.AddField(
+            model_name='chatbot',
+            name='mmr_lambda',
+            field=models.FloatField(default=0.7, help_text='MMR trade-off (0.0-1.0). Higher = relevance, Lower = diversity'),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='prompt_tokens_saved',
+            field=models.IntegerField(default=0, help_text='Context tokens saved by re-ranking and duplicate collapse'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0 on 2026-10-19 19:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbots', '0003_retrieval_reranking'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='context_refs',
+            field=models.JSONField(blank=True, default=list, help_text='[chunk_id, similarity] pairs of the chunks used to generate the response'),
+        ),
+    ]
@@ -0,0 +1,92 @@
+"""
+Convert stored context previews into chunk references.
+
+Old rows hold ``{document, similarity, content_preview}`` entries, where the
+preview is the first 200 characters of the chunk plus '...'. Each entry is
+matched to a chunk of the same chatbot by document name and content prefix;
+entries whose chunk no longer exists are dropped.
+"""
+
+from django.db import migrations
+
+BATCH_SIZE = 500
+PREVIEW_LENGTH = 200
+
+
+def previews_to_refs(apps, schema_editor):
+    Message = apps.get_model('chatbots', 'Message')
+    DocumentChunk = apps.get_model('documents', 'DocumentChunk')
+    matches = {}
+
+    def chunk_id(chatbot_id, entry):
+        prefix = entry.get('content_preview') or ''
+        # '...' was appended to every preview, including untruncated ones
+        prefix = prefix[:-3] if prefix.endswith('...') else prefix
+        key = (chatbot_id, entry.get('document'), prefix)
+        if key not in matches:
+            matches[key] = (
+                DocumentChunk.objects
+                .filter(document__chatbot_id=chatbot_id, document__file_name=key[1], content__startswith=prefix)
+                .order_by('id')
+                .values_list('id', flat=True)
+                .first()
+            )
+        return matches[key]
+
+    batch = []
+    messages = (
+        Message.objects.exclude(context_used__isnull=True)
+        .select_related('conversation')
+        .only('id', 'context_used', 'conversation__chatbot_id')
+    )
+    for message in messages.iterator(chunk_size=BATCH_SIZE):
+        refs = []
+        for entry in message.context_used or []:
+            if not isinstance(entry, dict):
+                continue
+            found = chunk_id(message.conversation.chatbot_id, entry)
+            if found is not None:
+                refs.append([found, entry.get('similarity', 0.0)])
+        message.context_refs = refs
+        batch.append(message)
+        if len(batch) >= BATCH_SIZE:
+            Message.objects.bulk_update(batch, ['context_refs'])
+            batch = []
+    if batch:
+        Message.objects.bulk_update(batch, ['context_refs'])
+
+
+def refs_to_previews(apps, schema_editor):
+    Message = apps.get_model('chatbots', 'Message')
+    DocumentChunk = apps.get_model('documents', 'DocumentChunk')
+
+    batch = []
+    for message in Message.objects.exclude(context_refs=[]).only('id', 'context_refs').iterator(chunk_size=BATCH_SIZE):
+        chunks = DocumentChunk.objects.select_related('document').in_bulk([ref[0] for ref in message.context_refs])
+        message.context_used = [
+            {
+                'document': chunks[ref[0]].document.file_name,
+                'similarity': ref[1],
+                'content_preview': chunks[ref[0]].content[:PREVIEW_LENGTH] + '...',
+            }
+            for ref in message.context_refs
+            if ref[0] in chunks
+        ]
+        batch.append(message)
+        if len(batch) >= BATCH_SIZE:
+            Message.objects.bulk_update(batch, ['context_used'])
+            batch = []
+    if batch:
+        Message.objects.bulk_update(batch, ['context_used'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbots', '0004_message_context_refs'),
+        ('documents', '0003_document_content_hash'),
+    ]
+
+    operations = [
+        migrations.RunPython(previews_to_refs, refs_to_previews),
+    ]
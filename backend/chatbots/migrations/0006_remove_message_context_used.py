@@ -0,0 +1,17 @@
+# Generated by Django 5.0 on 2026-10-19 19:20
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbots', '0005_context_refs_from_previews'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='message',
+            name='context_used',
+        ),
+    ]
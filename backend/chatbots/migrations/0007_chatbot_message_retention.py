@@ -0,0 +1,18 @@
+# Generated by Django 5.0 on 2026-10-19 18:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbots', '0006_remove_message_context_used'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatbot',
+            name='message_retention_days',
+            field=models.PositiveIntegerField(blank=True, help_text='Archive and delete conversations inactive for this many days (empty = keep forever)', null=True),
+        ),
+    ]
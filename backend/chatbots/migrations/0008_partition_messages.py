@@ -0,0 +1,114 @@
+"""
+Range-partition the ``messages`` table by month of ``created_at`` (PostgreSQL only).
+
+A partitioned table's primary key must contain the partition key, so the
+primary key becomes ``(id, created_at)``; ids still come from one sequence
+and stay unique. Identity columns are not supported on partitioned tables
+before PostgreSQL 17, so ``id`` defaults to an owned sequence instead.
+
+Existing rows are copied once into monthly partitions covering their range
+plus the next few months, and a default partition catches anything outside
+them. Further months are added by the ``archive_conversations`` command.
+Other databases keep the plain table.
+"""
+
+from datetime import date
+
+from django.db import migrations
+
+TABLE = 'messages'
+MONTHS_AHEAD = 3
+
+
+def _next_month(day):
+    return date(day.year + 1, 1, 1) if day.month == 12 else date(day.year, day.month + 1, 1)
+
+
+def _table_definition(cursor, table):
+    """Index and foreign key DDL of ``table``, excluding its primary key"""
+    cursor.execute(
+        """
+        SELECT indexdef FROM pg_indexes i
+        WHERE i.tablename = %s AND i.indexname NOT IN (
+            SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'p'
+        )
+        """,
+        [table, table],
+    )
+    indexes = [row[0] for row in cursor.fetchall()]
+    cursor.execute(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'f'",
+        [table],
+    )
+    return indexes, cursor.fetchall()
+
+
+def _rebuild(cursor, partitioned):
+    indexes, foreign_keys = _table_definition(cursor, TABLE)
+    cursor.execute(f'SELECT MAX(id), MIN(created_at) FROM {TABLE}')
+    max_id, oldest = cursor.fetchone()
+
+    cursor.execute(f'ALTER TABLE {TABLE} RENAME TO {TABLE}_old')
+    cursor.execute(f'ALTER SEQUENCE IF EXISTS {TABLE}_id_seq RENAME TO {TABLE}_old_id_seq')
+    cursor.execute(
+        f'CREATE TABLE {TABLE} (LIKE {TABLE}_old INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING STORAGE)'
+        + (' PARTITION BY RANGE (created_at)' if partitioned else '')
+    )
+    # The copied default still points at the old table's sequence
+    cursor.execute(f'ALTER TABLE {TABLE} ALTER COLUMN id DROP DEFAULT')
+
+    if partitioned:
+        cursor.execute('SELECT CURRENT_DATE')
+        today = cursor.fetchone()[0]
+        start = min(oldest.date(), today).replace(day=1) if oldest else today.replace(day=1)
+        last = today.replace(day=1)
+        for _ in range(MONTHS_AHEAD):
+            last = _next_month(last)
+        while start <= last:
+            end = _next_month(start)
+            cursor.execute(
+                f"CREATE TABLE {TABLE}_p{start:%Y_%m} PARTITION OF {TABLE} "
+                f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+            )
+            start = end
+        cursor.execute(f'CREATE TABLE {TABLE}_default PARTITION OF {TABLE} DEFAULT')
+
+    cursor.execute(f'INSERT INTO {TABLE} SELECT * FROM {TABLE}_old')
+    cursor.execute(f'DROP TABLE {TABLE}_old')
+    cursor.execute(f'DROP SEQUENCE IF EXISTS {TABLE}_old_id_seq')
+
+    cursor.execute(f'CREATE SEQUENCE {TABLE}_id_seq OWNED BY {TABLE}.id')
+    cursor.execute(f"SELECT setval('{TABLE}_id_seq', %s, %s)", [max_id or 1, max_id is not None])
+    cursor.execute(f"ALTER TABLE {TABLE} ALTER COLUMN id SET DEFAULT nextval('{TABLE}_id_seq')")
+    primary_key = '(id, created_at)' if partitioned else '(id)'
+    cursor.execute(f'ALTER TABLE {TABLE} ADD CONSTRAINT {TABLE}_pkey PRIMARY KEY {primary_key}')
+
+    for definition in indexes:
+        cursor.execute(definition)
+    for name, definition in foreign_keys:
+        cursor.execute(f'ALTER TABLE {TABLE} ADD CONSTRAINT {name} {definition}')
+
+
+def partition_messages(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        _rebuild(cursor, partitioned=True)
+
+
+def unpartition_messages(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        _rebuild(cursor, partitioned=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbots', '0007_chatbot_message_retention'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_messages, unpartition_messages),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.0 on 2026-10-19 19:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbots', '0009_conversation_deleted_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatbot',
+            name='embedding_dimensions',
+            field=models.PositiveIntegerField(blank=True, help_text='Dimensions kept by the reduction (e.g. 256)', null=True),
+        ),
+        migrations.AddField(
+            model_name='chatbot',
+            name='embedding_reduction',
+            field=models.CharField(choices=[('none', 'Full dimension'), ('truncate', 'Truncate and renormalise'), ('pca', "PCA fitted on the chatbot's chunks")], default='none', help_text='Search a reduced copy of the chunk embeddings; queries are projected the same way', max_length=10),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.0 on 2026-10-19 19:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbots', '0010_chatbot_embedding_reduction'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatbot',
+            name='response_deadline_seconds',
+            field=models.FloatField(default=20.0, help_text='Time budget of a chat turn; degraded fast paths are taken as it runs out'),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='degraded_paths',
+            field=models.JSONField(blank=True, default=list, help_text='Fast paths taken because the response deadline was running out'),
+        ),
+    ]
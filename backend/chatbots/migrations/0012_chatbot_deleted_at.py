@@ -0,0 +1,24 @@
+# Generated by Django 5.0 on 2026-10-19 19:57
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbots', '0011_chat_response_deadline'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatbot',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, editable=False, help_text='Set when deleted; the row, its documents and its conversations are removed later by the reaper', null=True),
+        ),
+        migrations.AddIndex(
+            model_name='chatbot',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', False)), fields=['deleted_at'], name='chatbots_deleted_idx'),
+        ),
+    ]
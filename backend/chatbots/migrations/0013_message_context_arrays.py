@@ -0,0 +1,66 @@
+"""
+Store message context as packed arrays instead of JSON pairs.
+
+``context_refs`` held ``[chunk_id, similarity]`` pairs as JSON; they move to
+``context_chunk_ids`` and ``context_scores``, one bigint and one float array
+per message.
+"""
+
+from django.contrib.postgres.fields import ArrayField
+from django.db import migrations, models
+
+BATCH_SIZE = 500
+
+
+def refs_to_arrays(apps, schema_editor):
+    Message = apps.get_model('chatbots', 'Message')
+    batch = []
+    for message in Message.objects.exclude(context_refs=[]).only('id', 'context_refs').iterator(chunk_size=BATCH_SIZE):
+        pairs = [ref for ref in message.context_refs or [] if isinstance(ref, list) and len(ref) == 2]
+        message.context_chunk_ids = [int(chunk_id) for chunk_id, _ in pairs]
+        message.context_scores = [float(score) for _, score in pairs]
+        batch.append(message)
+        if len(batch) >= BATCH_SIZE:
+            Message.objects.bulk_update(batch, ['context_chunk_ids', 'context_scores'])
+            batch = []
+    if batch:
+        Message.objects.bulk_update(batch, ['context_chunk_ids', 'context_scores'])
+
+
+def arrays_to_refs(apps, schema_editor):
+    Message = apps.get_model('chatbots', 'Message')
+    batch = []
+    messages = Message.objects.exclude(context_chunk_ids=[]).only('id', 'context_chunk_ids', 'context_scores')
+    for message in messages.iterator(chunk_size=BATCH_SIZE):
+        message.context_refs = [list(pair) for pair in zip(message.context_chunk_ids, message.context_scores)]
+        batch.append(message)
+        if len(batch) >= BATCH_SIZE:
+            Message.objects.bulk_update(batch, ['context_refs'])
+            batch = []
+    if batch:
+        Message.objects.bulk_update(batch, ['context_refs'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbots', '0012_chatbot_deleted_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='context_chunk_ids',
+            field=ArrayField(base_field=models.BigIntegerField(), blank=True, default=list, help_text='Ids of the chunks used to generate the response, best first', size=None),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='context_scores',
+            field=ArrayField(base_field=models.FloatField(), blank=True, default=list, help_text='Similarity of each chunk in context_chunk_ids', size=None),
+        ),
+        migrations.RunPython(refs_to_arrays, arrays_to_refs),
+        migrations.RemoveField(
+            model_name='message',
+            name='context_refs',
+        ),
+    ]
@@ -1,8 +1,119 @@
-from django.db import models
+from django.apps import apps
+from django.db import connection, models, transaction
+from django.db.models import Count, IntegerField, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
 from django.conf import settings
+from django.contrib.postgres.fields import ArrayField
 from django.core.validators import MinLengthValidator
+from django.utils import timezone
+
+
+def _related_count(model, fk_field):
+    """Correlated COUNT(*) subquery of ``model`` rows pointing at the outer row"""
+    counts = (
+        model.objects.filter(**{fk_field: OuterRef('pk')})
+        .order_by()
+        .values(fk_field)
+        .annotate(total=Count('pk'))
+        .values('total')
+    )
+    return Coalesce(Subquery(counts, output_field=IntegerField()), 0)
+
+
+class SoftDeleteManager(models.Manager):
+    """Default manager hiding soft-deleted rows; ``all_objects`` still sees them"""
+
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted_at__isnull=True)
+
+
+class ChatbotQuerySet(models.QuerySet):
+
+    def soft_delete(self):
+        """
+        Hide the chatbots together with their documents and conversations.
+
+        Only ``deleted_at`` columns are set; ``services.reaper`` deletes the
+        chunks and messages in batches and the chatbot rows after them.
+        """
+        now = timezone.now()
+        ids = list(self.values_list('id', flat=True))
+        Document = apps.get_model('documents', 'Document')
+        with transaction.atomic():
+            Document.all_objects.filter(chatbot_id__in=ids, deleted_at__isnull=True).update(deleted_at=now)
+            Conversation.all_objects.filter(chatbot_id__in=ids, deleted_at__isnull=True).update(deleted_at=now)
+            return self.model.all_objects.filter(id__in=ids).update(deleted_at=now)
+
+    def with_counts(self):
+        """
+        Annotate document and conversation totals in the listing query itself.
+
+        Subqueries are used instead of joining both relations, which would
+        multiply documents by conversations before grouping.
+        """
+        return self.annotate(
+            num_documents=_related_count(apps.get_model('documents', 'Document'), 'chatbot'),
+            num_conversations=_related_count(Conversation, 'chatbot'),
+        )
+
+
+class ConversationQuerySet(models.QuerySet):
+
+    def soft_delete(self):
+        """Hide the conversations at once; ``services.reaper`` deletes them and their messages later"""
+        return self.update(deleted_at=timezone.now())
+
+    def with_message_count(self):
+        return self.annotate(num_messages=_related_count(Message, 'conversation'))
+
+    def touch_with_history(self, conversation_id, chatbot_id, limit=5):
+        """
+        Bump a conversation's ``updated_at`` and return its latest messages.
+
+        Returns ``None`` if the conversation does not belong to the chatbot,
+        otherwise up to ``limit`` ``{'role', 'content'}`` dicts, oldest first.
+        On PostgreSQL this is one statement: an UPDATE ... RETURNING joined
+        laterally to the history query.
+        """
+        now = timezone.now()
+        if connection.vendor != 'postgresql':
+            if not self.filter(id=conversation_id, chatbot_id=chatbot_id).update(updated_at=now):
+                return None
+            recent = Message.objects.filter(conversation_id=conversation_id).order_by('-created_at', '-id')
+            return [{'role': role, 'content': content} for role, content in reversed(recent.values_list('role', 'content')[:limit])]
+
+        conversations, messages = self.model._meta.db_table, Message._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                WITH touched AS (
+                    UPDATE {conversations} SET updated_at = %s
+                    WHERE id = %s AND chatbot_id = %s AND deleted_at IS NULL
+                    RETURNING id
+                )
+                SELECT recent.role, recent.content FROM touched
+                LEFT JOIN LATERAL (
+                    SELECT role, content, created_at, id FROM {messages}
+                    WHERE conversation_id = touched.id
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT %s
+                ) recent ON true
+                ORDER BY recent.created_at, recent.id
+                """,
+                [now, conversation_id, chatbot_id, limit],
+            )
+            rows = cursor.fetchall()
+        if not rows:
+            return None
+        return [{'role': role, 'content': content} for role, content in rows if role is not None]
+
 
 class Chatbot(models.Model):
+    EMBEDDING_REDUCTION_CHOICES = [
+        ('none', 'Full dimension'),
+        ('truncate', 'Truncate and renormalise'),
+        ('pca', "PCA fitted on the chatbot's chunks"),
+    ]
 
     owner = models.ForeignKey(
         settings.AUTH_USER_MODEL,
@@ -37,6 +148,60 @@ class Chatbot(models.Model):
         help_text="Maximum tokens in response"
     )
     
+    # Document chunking
+    chunk_size = models.IntegerField(
+        default=128,
+        help_text="Tokens per document chunk"
+    )
+    
+    chunk_overlap = models.IntegerField(
+        default=16,
+        help_text="Tokens shared between consecutive chunks"
+    )
+    
+    # Retrieval re-ranking
+    mmr_enabled = models.BooleanField(
+        default=False,
+        help_text="Re-rank retrieved chunks with Maximal Marginal Relevance for more diverse context"
+    )
+    
+    mmr_lambda = models.FloatField(
+        default=0.7,
+        help_text="MMR trade-off (0.0-1.0). Higher = relevance, Lower = diversity"
+    )
+    
+    duplicate_threshold = models.FloatField(
+        default=0.0,
+        help_text="Drop retrieved chunks at least this similar to a better one (0 = off, e.g. 0.95)"
+    )
+    
+    # Stored embedding representation
+    embedding_reduction = models.CharField(
+        max_length=10,
+        choices=EMBEDDING_REDUCTION_CHOICES,
+        default='none',
+        help_text="Search a reduced copy of the chunk embeddings; queries are projected the same way"
+    )
+    
+    embedding_dimensions = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text="Dimensions kept by the reduction (e.g. 256)"
+    )
+    
+    # Latency budget
+    response_deadline_seconds = models.FloatField(
+        default=20.0,
+        help_text="Time budget of a chat turn; degraded fast paths are taken as it runs out"
+    )
+    
+    # Data retention
+    message_retention_days = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text="Archive and delete conversations inactive for this many days (empty = keep forever)"
+    )
+    
     # Status
     is_active = models.BooleanField(
         default=True,
@@ -46,6 +211,15 @@ class Chatbot(models.Model):
     # Timestamps
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    deleted_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        editable=False,
+        help_text="Set when deleted; the row, its documents and its conversations are removed later by the reaper"
+    )
+
+    objects = SoftDeleteManager.from_queryset(ChatbotQuerySet)()
+    all_objects = ChatbotQuerySet.as_manager()
     
     class Meta:
         db_table = 'chatbots'
@@ -55,6 +229,7 @@ class Chatbot(models.Model):
         indexes = [
             models.Index(fields=['owner', '-created_at']),
             models.Index(fields=['is_active']),
+            models.Index(fields=['deleted_at'], condition=Q(deleted_at__isnull=False), name='chatbots_deleted_idx'),
         ]
     
     def __str__(self):
@@ -62,10 +237,15 @@ class Chatbot(models.Model):
     
     @property
     def document_count(self):
+        # Prefer the value annotated by ChatbotQuerySet.with_counts()
+        if hasattr(self, 'num_documents'):
+            return self.num_documents
         return self.documents.count()
     
     @property
     def conversation_count(self):
+        if hasattr(self, 'num_conversations'):
+            return self.num_conversations
         return self.conversations.count()
 
 
@@ -93,6 +273,15 @@ class Conversation(models.Model):
     
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    deleted_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        editable=False,
+        help_text="Set when deleted; the row and its messages are removed later by the reaper"
+    )
+
+    objects = SoftDeleteManager.from_queryset(ConversationQuerySet)()
+    all_objects = ConversationQuerySet.as_manager()
     
     class Meta:
         db_table = 'conversations'
@@ -101,6 +290,7 @@ class Conversation(models.Model):
         ordering = ['-updated_at']
         indexes = [
             models.Index(fields=['chatbot', '-updated_at']),
+            models.Index(fields=['deleted_at'], condition=Q(deleted_at__isnull=False), name='conversations_deleted_idx'),
         ]
     
     def __str__(self):
@@ -108,6 +298,9 @@ class Conversation(models.Model):
     
     @property
     def message_count(self):
+        # Prefer the value annotated by ConversationQuerySet.with_message_count()
+        if hasattr(self, 'num_messages'):
+            return self.num_messages
         return self.messages.count()
 
 
@@ -134,10 +327,19 @@ class Message(models.Model):
         help_text="Message content"
     )
 
-    context_used = models.JSONField(
-        null=True,
+    # Packed arrays: one row, no JSON parsing, and no join to list a page of messages
+    context_chunk_ids = ArrayField(
+        models.BigIntegerField(),
+        default=list,
+        blank=True,
+        help_text="Ids of the chunks used to generate the response, best first"
+    )
+
+    context_scores = ArrayField(
+        models.FloatField(),
+        default=list,
         blank=True,
-        help_text="Retrieved document chunks used to generate response"
+        help_text="Similarity of each chunk in context_chunk_ids"
     )
     
     # Metadata
@@ -147,6 +349,17 @@ class Message(models.Model):
         help_text="Number of tokens used for this message"
     )
     
+    prompt_tokens_saved = models.IntegerField(
+        default=0,
+        help_text="Context tokens saved by re-ranking and duplicate collapse"
+    )
+    
+    degraded_paths = models.JSONField(
+        default=list,
+        blank=True,
+        help_text="Fast paths taken because the response deadline was running out"
+    )
+    
     created_at = models.DateTimeField(auto_now_add=True)
     
     class Meta:
@@ -161,3 +374,8 @@ class Message(models.Model):
     def __str__(self):
         preview = self.content[:50] + "..." if len(self.content) > 50 else self.content
         return f"{self.role}: {preview}"
+
+    @property
+    def context_refs(self):
+        """``(chunk_id, similarity)`` pairs of the chunks used, best first"""
+        return list(zip(self.context_chunk_ids, self.context_scores))
@@ -1,9 +1,46 @@
 from rest_framework import serializers
 from .models import Chatbot, Conversation, Message
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.db.models.functions import Substr
+from documents.models import DocumentChunk
 
 User = get_user_model()
 
+
+def validate_chunking(attrs, instance=None):
+    chunk_size = attrs.get('chunk_size', getattr(instance, 'chunk_size', 128))
+    chunk_overlap = attrs.get('chunk_overlap', getattr(instance, 'chunk_overlap', 16))
+    if not 16 <= chunk_size <= 8000:
+        raise serializers.ValidationError({'chunk_size': "Chunk size must be between 16 and 8000 tokens"})
+    if not 0 <= chunk_overlap < chunk_size:
+        raise serializers.ValidationError({'chunk_overlap': "Chunk overlap must be at least 0 and less than chunk size"})
+    return attrs
+
+
+def validate_reranking(attrs):
+    for field in ('mmr_lambda', 'duplicate_threshold'):
+        if field in attrs and not 0 <= attrs[field] <= 1:
+            raise serializers.ValidationError({field: "Must be between 0 and 1"})
+    return attrs
+
+
+def validate_embedding_reduction(attrs, instance=None):
+    reduction = attrs.get('embedding_reduction', getattr(instance, 'embedding_reduction', 'none'))
+    dimensions = attrs.get('embedding_dimensions', getattr(instance, 'embedding_dimensions', None))
+    if reduction != 'none' and not dimensions:
+        raise serializers.ValidationError({'embedding_dimensions': "Required when embeddings are reduced"})
+    if dimensions is not None and not 8 <= dimensions <= 4096:
+        raise serializers.ValidationError({'embedding_dimensions': "Must be between 8 and 4096"})
+    return attrs
+
+
+def validate_response_deadline(value):
+    if not 1 <= value <= 120:
+        raise serializers.ValidationError("Response deadline must be between 1 and 120 seconds")
+    return value
+
+
 class ChatbotSerializer(serializers.ModelSerializer):
     owner_email = serializers.EmailField(source='owner.email', read_only=True)
     document_count = serializers.IntegerField(read_only=True)
@@ -14,6 +51,10 @@ class ChatbotSerializer(serializers.ModelSerializer):
         fields = [
             'id', 'name', 'description', 'owner', 'owner_email',
             'system_prompt', 'temperature', 'max_tokens',
+            'chunk_size', 'chunk_overlap',
+            'mmr_enabled', 'mmr_lambda', 'duplicate_threshold',
+            'embedding_reduction', 'embedding_dimensions',
+            'response_deadline_seconds', 'message_retention_days',
             'is_active', 'document_count', 'conversation_count',
             'created_at', 'updated_at'
         ]
@@ -28,23 +69,104 @@ class ChatbotSerializer(serializers.ModelSerializer):
         if not 0 <= value <= 1:
             raise serializers.ValidationError("Temperature must be between 0 and 1")
         return value
+    
+    def validate_response_deadline_seconds(self, value):
+        return validate_response_deadline(value)
+    
+    def validate(self, attrs):
+        attrs = validate_reranking(validate_chunking(attrs, self.instance))
+        return validate_embedding_reduction(attrs, self.instance)
 
 
 class ChatbotCreateSerializer(serializers.ModelSerializer):
     class Meta:
         model = Chatbot
-        fields = ['name', 'description', 'system_prompt', 'temperature', 'max_tokens']
+        fields = ['name', 'description', 'system_prompt', 'temperature', 'max_tokens',
+                  'chunk_size', 'chunk_overlap', 'mmr_enabled', 'mmr_lambda', 'duplicate_threshold',
+                  'embedding_reduction', 'embedding_dimensions', 'response_deadline_seconds',
+                  'message_retention_days']
+    
+    def validate_response_deadline_seconds(self, value):
+        return validate_response_deadline(value)
+    
+    def validate(self, attrs):
+        return validate_embedding_reduction(validate_reranking(validate_chunking(attrs)))
     
     def create(self, validated_data):
         validated_data['owner'] = self.context['request'].user
         return super().create(validated_data)
 
 
+PREVIEW_LENGTH = 200
+
+
+def wants_previews(request):
+    return request.query_params.get('previews', '').lower() in ('1', 'true', 'yes')
+
+
+def wants_embeddings(request):
+    return request.query_params.get('embeddings', '').lower() in ('1', 'true', 'yes')
+
+
+def chunk_previews(messages):
+    """
+    Document name and content preview of every chunk referenced by ``messages``.
+
+    One query for the whole page; only the preview prefix of each chunk is read.
+    Chunks that no longer exist, e.g. after their document was deleted or
+    reprocessed, are marked ``missing`` instead of being left out.
+    """
+    chunk_ids = {chunk_id for message in messages for chunk_id in message.context_chunk_ids}
+    if not chunk_ids:
+        return {}
+    rows = (
+        DocumentChunk.objects.filter(id__in=chunk_ids, document__deleted_at__isnull=True)
+        .values_list('id', 'document__file_name', Substr('content', 1, PREVIEW_LENGTH + 1))
+    )
+    previews = dict.fromkeys(chunk_ids, {'missing': True})
+    previews.update(
+        (chunk_id, {
+            'document': document,
+            'content_preview': text[:PREVIEW_LENGTH] + '...' if len(text) > PREVIEW_LENGTH else text,
+        })
+        for chunk_id, document, text in rows
+    )
+    return previews
+
+
+def context_entries(message, previews=None):
+    """``context_used`` of a message: chunk refs, plus previews when resolved"""
+    return [
+        {'chunk_id': chunk_id, 'similarity': similarity, **(previews or {}).get(chunk_id, {})}
+        for chunk_id, similarity in message.context_refs
+    ]
+
+
 class MessageSerializer(serializers.ModelSerializer):
+    # Pass resolved chunk_previews() as context['previews'] to include them
+    context_used = serializers.SerializerMethodField()
+
     class Meta:
         model = Message
-        fields = ['id', 'role', 'content', 'context_used', 'tokens_used', 'created_at']
-        read_only_fields = ['id', 'created_at']
+        fields = ['id', 'role', 'content', 'context_used', 'tokens_used', 'prompt_tokens_saved', 'created_at']
+        read_only_fields = ['id', 'prompt_tokens_saved', 'created_at']
+
+    def get_context_used(self, obj):
+        return context_entries(obj, self.context.get('previews'))
+
+
+class ConversationListSerializer(serializers.ModelSerializer):
+    """Conversation summary for listings, without the nested messages"""
+    message_count = serializers.IntegerField(read_only=True)
+    chatbot_name = serializers.CharField(source='chatbot.name', read_only=True)
+    
+    class Meta:
+        model = Conversation
+        fields = [
+            'id', 'chatbot', 'chatbot_name', 'user', 'title',
+            'message_count', 'created_at', 'updated_at'
+        ]
+        read_only_fields = ['id', 'created_at', 'updated_at']
 
 
 class ConversationSerializer(serializers.ModelSerializer):
@@ -59,3 +181,31 @@ class ConversationSerializer(serializers.ModelSerializer):
             'message_count', 'messages', 'created_at', 'updated_at'
         ]
         read_only_fields = ['id', 'created_at', 'updated_at']
+
+
+class RetrievalFilterSerializer(serializers.Serializer):
+    """Optional ``filter`` of a chat request, restricting which documents are searched"""
+    document_ids = serializers.ListField(child=serializers.IntegerField(), required=False, allow_empty=False)
+    file_types = serializers.ListField(
+        child=serializers.ChoiceField(choices=['pdf', 'txt', 'docx', 'md']), required=False, allow_empty=False
+    )
+    uploaded_after = serializers.DateTimeField(required=False)
+    uploaded_before = serializers.DateTimeField(required=False)
+
+    def validate(self, attrs):
+        after, before = attrs.get('uploaded_after'), attrs.get('uploaded_before')
+        if after and before and after >= before:
+            raise serializers.ValidationError("uploaded_after must be earlier than uploaded_before")
+        return attrs
+
+
+class BatchQuestionSerializer(serializers.Serializer):
+    questions = serializers.ListField(child=serializers.CharField(max_length=4000), allow_empty=False)
+    filter = RetrievalFilterSerializer(required=False)
+    top_k = serializers.IntegerField(min_value=1, max_value=20, default=5)
+
+    def validate_questions(self, value):
+        limit = settings.BATCH_QA_MAX_QUESTIONS
+        if len(value) > limit:
+            raise serializers.ValidationError(f"At most {limit} questions per batch")
+        return value
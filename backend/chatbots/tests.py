@@ -1,3 +1,1707 @@
-from django.test import TestCase
+import gzip
+import io
+import json
+import os
+import threading
+import time
+import zipfile
+import zlib
+from concurrent.futures import Future
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from unittest import skipUnless
+from unittest.mock import MagicMock, patch
 
+import numpy as np
 
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.translation import gettext_lazy
+from rest_framework.test import APIClient
+
+from chatbots.models import Chatbot, Conversation, Message
+from documents.models import Document, DocumentChunk
+from ragbot_backend import db_router
+from ragbot_backend.db_router import ReplicaRouter
+from ragbot_backend.testing import RagbotTestCase
+from services import answer_cache, exports, message_archive, vector_index
+from services.chat_scheduler import FairScheduler, QueueTimeout
+from services.coalescing import Coalescer, FlightTimeout
+from services.deadline import Deadline, DeadlineExceeded
+from services.embedding_scheduler import BACKFILL
+from services.rag_service import rag_service
+
+User = get_user_model()
+
+
+class ListingQueryCountTests(RagbotTestCase):
+    """Listing endpoints must run a constant number of queries per page"""
+
+    def setUp(self):
+        self.user = self.create_owner()
+        self.client.force_authenticate(self.user)
+
+    def _create_chatbots(self, count):
+        for i in range(count):
+            chatbot = Chatbot.objects.create(owner=self.user, name=f'Bot {i:03d}')
+            Document.objects.bulk_create([
+                Document(chatbot=chatbot, file=f'documents/doc_{i}_{j}.txt',
+                         file_name=f'doc_{i}_{j}.txt', file_type='txt', file_size=10)
+                for j in range(3)
+            ])
+            for j in range(2):
+                conversation = Conversation.objects.create(chatbot=chatbot, title=f'Conv {j}')
+                Message.objects.bulk_create([
+                    Message(conversation=conversation, role='user', content=f'Message {k}')
+                    for k in range(4)
+                ])
+
+    def _count_queries(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries), response
+
+    def test_chatbot_list_queries_constant(self):
+        self._create_chatbots(2)
+        small, _ = self._count_queries('/api/chatbots/')
+        self._create_chatbots(8)
+        large, response = self._count_queries('/api/chatbots/')
+        self.assertEqual(small, large)
+        self.assertEqual(response.data['count'], 10)
+        for item in response.data['results']:
+            self.assertEqual(item['document_count'], 3)
+            self.assertEqual(item['conversation_count'], 2)
+
+    def test_chatbot_conversations_queries_constant(self):
+        self._create_chatbots(1)
+        chatbot = Chatbot.objects.get()
+        url = f'/api/chatbots/{chatbot.id}/conversations/'
+        small, _ = self._count_queries(url)
+        for j in range(10):
+            conversation = Conversation.objects.create(chatbot=chatbot, title=f'Extra {j}')
+            Message.objects.create(conversation=conversation, role='user', content='hi')
+        large, response = self._count_queries(url)
+        self.assertEqual(small, large)
+        self.assertNotIn('messages', response.data['results'][0])
+
+    def test_conversation_list_queries_constant(self):
+        self._create_chatbots(1)
+        small, _ = self._count_queries('/api/conversations/')
+        self._create_chatbots(5)
+        large, response = self._count_queries('/api/conversations/')
+        self.assertEqual(small, large)
+        self.assertEqual(response.data['results'][0]['message_count'], 4)
+
+    def test_conversation_detail_prefetches_messages(self):
+        self._create_chatbots(1)
+        conversation = Conversation.objects.first()
+        url = f'/api/conversations/{conversation.id}/'
+        small, _ = self._count_queries(url)
+        Message.objects.bulk_create([
+            Message(conversation=conversation, role='assistant', content='more')
+            for _ in range(20)
+        ])
+        large, response = self._count_queries(url)
+        self.assertEqual(small, large)
+        self.assertEqual(len(response.data['messages']), 24)
+        self.assertEqual(response.data['message_count'], 24)
+
+
+class ConversationHistoryPaginationTests(RagbotTestCase):
+
+    def setUp(self):
+        self.user = self.create_owner()
+        self.client.force_authenticate(self.user)
+        chatbot = self.create_chatbot(self.user, 'History Bot')
+        self.conversation = Conversation.objects.create(chatbot=chatbot, title='History')
+        for i in range(25):
+            Message.objects.create(conversation=self.conversation, role='user', content=f'm{i}')
+        self.url = f'/api/chat/conversation/{self.conversation.id}/'
+
+    def test_default_page_is_most_recent(self):
+        response = self.client.get(self.url, {'limit': 10})
+        self.assertEqual(response.status_code, 200)
+        contents = [m['content'] for m in response.data['messages']]
+        self.assertEqual(contents, [f'm{i}' for i in range(15, 25)])
+        self.assertTrue(response.data['has_before'])
+        self.assertFalse(response.data['has_after'])
+
+    def test_walk_backwards_then_poll_forwards(self):
+        first = self.client.get(self.url, {'limit': 10}).data
+        older = self.client.get(self.url, {'limit': 10, 'before': first['before']}).data
+        self.assertEqual([m['content'] for m in older['messages']], [f'm{i}' for i in range(5, 15)])
+        oldest = self.client.get(self.url, {'limit': 10, 'before': older['before']}).data
+        self.assertEqual(len(oldest['messages']), 5)
+        self.assertFalse(oldest['has_before'])
+
+        polled = self.client.get(self.url, {'after': first['after']}).data
+        self.assertEqual(polled['messages'], [])
+        self.assertEqual(polled['after'], first['after'])
+        Message.objects.create(conversation=self.conversation, role='assistant', content='new')
+        polled = self.client.get(self.url, {'after': first['after']}).data
+        self.assertEqual([m['content'] for m in polled['messages']], ['new'])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(self.url, {'after': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(CHAT_RATE_LIMITS={
+    'ip': {'per_minute': 60, 'burst': 100},
+    'chatbot': {'per_minute': 60, 'burst': 100},
+})
+class ChatAdmissionTests(RagbotTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.owner = self.create_owner(max_queries_per_month=2)
+        self.chatbot = self.create_chatbot(self.owner, 'Public Bot')
+        self.url = f'/api/chat/{self.chatbot.id}/'
+        patcher = patch('chatbots.chat_views.rag_service.generate_response', return_value={
+            'success': True, 'response': 'answer', 'tokens_used': 3, 'chunks_used': []
+        })
+        self.generate = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_monthly_quota_enforced(self):
+        for _ in range(2):
+            self.assertEqual(self.client.post(self.url, {'message': 'hi'}).status_code, 200)
+        response = self.client.post(self.url, {'message': 'hi'})
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+        self.assertEqual(self.generate.call_count, 2)
+        self.owner.refresh_from_db()
+        self.assertEqual(self.owner.queries_this_month, 2)
+
+    def test_quota_resets_in_new_month(self):
+        User.objects.filter(pk=self.owner.pk).update(
+            queries_this_month=2, quota_period=date(2000, 1, 1)
+        )
+        self.assertEqual(self.client.post(self.url, {'message': 'hi'}).status_code, 200)
+        self.owner.refresh_from_db()
+        self.assertEqual(self.owner.queries_this_month, 1)
+
+    def test_failed_generation_refunds_quota(self):
+        self.generate.return_value = {'success': False, 'error': 'boom'}
+        self.assertEqual(self.client.post(self.url, {'message': 'hi'}).status_code, 500)
+        self.owner.refresh_from_db()
+        self.assertEqual(self.owner.queries_this_month, 0)
+
+    @override_settings(CHAT_RATE_LIMITS={
+        'ip': {'per_minute': 1, 'burst': 1},
+        'chatbot': {'per_minute': 60, 'burst': 100},
+    })
+    def test_ip_rate_limit_rejects_before_work(self):
+        self.assertEqual(self.client.post(self.url, {'message': 'hi'}).status_code, 200)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post(self.url, {'message': 'hi'})
+        self.assertEqual(response.status_code, 429)
+        self.assertGreaterEqual(int(response['Retry-After']), 1)
+        self.assertEqual(len(ctx.captured_queries), 0)
+        self.assertEqual(self.generate.call_count, 1)
+
+    @override_settings(CHAT_RATE_LIMITS={
+        'ip': {'per_minute': 0, 'burst': 1},
+        'chatbot': {'per_minute': 60, 'burst': 100},
+    })
+    def test_zero_rate_gets_finite_retry_after(self):
+        self.assertEqual(self.client.post(self.url, {'message': 'hi'}).status_code, 200)
+        response = self.client.post(self.url, {'message': 'hi'})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(int(response['Retry-After']), 3600)
+
+    def test_failed_persistence_refunds_quota(self):
+        with patch('chatbots.chat_views.Message.objects.bulk_create', side_effect=RuntimeError('db down')):
+            self.assertEqual(self.client.post(self.url, {'message': 'hi'}).status_code, 500)
+        self.owner.refresh_from_db()
+        self.assertEqual(self.owner.queries_this_month, 0)
+
+
+class KnowledgeBaseSnapshotTests(RagbotTestCase):
+
+    def setUp(self):
+        self.use_temp_media()
+
+        self.user = self.create_owner()
+        self.client.force_authenticate(self.user)
+        self.source = self.create_chatbot(self.user, 'Tuned Bot', temperature=0.2)
+        document = Document(chatbot=self.source, status='completed', chunk_count=3)
+        document.file.save('guide.txt', ContentFile(b'guide text'), save=False)
+        document.save()
+        self.chunks = [
+            DocumentChunk(document=document, content=f'chunk, "{i}"\nline', chunk_index=i,
+                          embedding=[0.5 * i, -0.1, 1 / 3], metadata={'chunk_number': i + 1})
+            for i in range(3)
+        ]
+        self.chunks.append(DocumentChunk(document=document, content='', chunk_index=3, embedding=None))
+        DocumentChunk.objects.bulk_create(self.chunks)
+
+    def _chunk_rows(self, chatbot):
+        return list(
+            DocumentChunk.objects.filter(document__chatbot=chatbot)
+            .order_by('chunk_index')
+            .values_list('content', 'chunk_index', 'embedding', 'metadata')
+        )
+
+    def test_export_import_round_trip(self):
+        target = Chatbot.objects.create(owner=self.user, name='Imported Bot')
+        response = self.client.get(f'/api/chatbots/{self.source.id}/export/')
+        self.assertEqual(response.status_code, 200)
+        archive = SimpleUploadedFile('snapshot.zip', b''.join(response.streaming_content))
+
+        with patch('services.rag_service.rag_service.embeddings_model') as embeddings:
+            response = self.client.post(
+                f'/api/chatbots/{target.id}/import_snapshot/', {'snapshot': archive}, format='multipart'
+            )
+            embeddings.embed_query.assert_not_called()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data, {'documents': 1, 'chunks': 4, 'queued': 0})
+        self.assertEqual(self._chunk_rows(target), self._chunk_rows(self.source))
+        imported = target.documents.get()
+        with imported.file.open('rb') as stored:
+            self.assertEqual(stored.read(), b'guide text')
+
+    def test_import_queues_unprocessed_documents_at_backfill(self):
+        pending = Document(chatbot=self.source, status='processing')
+        pending.file.save('draft.txt', ContentFile(b'draft text'), save=False)
+        pending.save()
+        target = Chatbot.objects.create(owner=self.user, name='Imported Bot')
+        archive = SimpleUploadedFile(
+            'snapshot.zip', b''.join(self.client.get(f'/api/chatbots/{self.source.id}/export/').streaming_content)
+        )
+
+        with patch('chatbots.views.ingest_documents') as ingest, self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                f'/api/chatbots/{target.id}/import_snapshot/', {'snapshot': archive}, format='multipart'
+            )
+
+        self.assertEqual(response.data['queued'], 1)
+        imported = target.documents.get(file_name='draft.txt')
+        self.assertEqual(imported.status, 'pending')
+        ingest.assert_called_once_with([imported.id], priority=BACKFILL)
+
+    def test_clone_copies_knowledge_base_in_database(self):
+        response = self.client.post(f'/api/chatbots/{self.source.id}/clone/', {'name': 'Cloned Bot'})
+        self.assertEqual(response.status_code, 201)
+        clone = Chatbot.objects.get(id=response.data['chatbot']['id'])
+        self.assertEqual(clone.temperature, 0.2)
+        self.assertEqual(response.data['copied'], {'documents': 1, 'chunks': 4})
+        self.assertEqual(self._chunk_rows(clone), self._chunk_rows(self.source))
+        self.assertNotEqual(clone.documents.get().file.name, self.source.documents.get().file.name)
+
+    def test_import_rejects_invalid_archive(self):
+        response = self.client.post(
+            f'/api/chatbots/{self.source.id}/import_snapshot/',
+            {'snapshot': SimpleUploadedFile('bad.zip', b'not a zip')}, format='multipart'
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_import_rejects_chunks_of_unknown_documents(self):
+        exported = io.BytesIO(b''.join(self.client.get(f'/api/chatbots/{self.source.id}/export/').streaming_content))
+        tampered = io.BytesIO()
+        with zipfile.ZipFile(exported) as source, zipfile.ZipFile(tampered, 'w') as target:
+            for item in source.infolist():
+                data = source.read(item)
+                if item.filename == 'chunks.json':
+                    columns = json.loads(data)
+                    columns['document'][0] = 7
+                    data = json.dumps(columns)
+                target.writestr(item, data)
+
+        target = Chatbot.objects.create(owner=self.user, name='Imported Bot')
+        response = self.client.post(
+            f'/api/chatbots/{target.id}/import_snapshot/',
+            {'snapshot': SimpleUploadedFile('snapshot.zip', tampered.getvalue())}, format='multipart'
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(target.documents.exists())
+
+    def _rewrite_manifest(self, change) -> bytes:
+        """The source's snapshot with ``change`` applied to its manifest"""
+        exported = io.BytesIO(b''.join(self.client.get(f'/api/chatbots/{self.source.id}/export/').streaming_content))
+        rewritten = io.BytesIO()
+        with zipfile.ZipFile(exported) as source, zipfile.ZipFile(rewritten, 'w') as target:
+            for item in source.infolist():
+                data = source.read(item)
+                if item.filename == 'manifest.json':
+                    manifest = json.loads(data)
+                    change(manifest)
+                    data = json.dumps(manifest)
+                target.writestr(item, data)
+        return rewritten.getvalue()
+
+    def test_import_rejects_malformed_manifest_documents(self):
+        target = Chatbot.objects.create(owner=self.user, name='Imported Bot')
+        changes = {
+            'missing processed_at': lambda manifest: manifest['documents'][0].pop('processed_at'),
+            'missing file_name': lambda manifest: manifest['documents'][0].pop('file_name'),
+            'wrong type': lambda manifest: manifest['documents'][0].update(chunk_count='4'),
+            'unknown status': lambda manifest: manifest['documents'][0].update(status='stuck'),
+            'bad date': lambda manifest: manifest['documents'][0].update(processed_at='yesterday'),
+            'missing member': lambda manifest: manifest['documents'][0].update(file='files/9/gone.txt'),
+            'not an object': lambda manifest: manifest['documents'].append('guide.txt'),
+        }
+        for label, change in changes.items():
+            with self.subTest(label):
+                response = self.client.post(
+                    f'/api/chatbots/{target.id}/import_snapshot/',
+                    {'snapshot': SimpleUploadedFile('snapshot.zip', self._rewrite_manifest(change))},
+                    format='multipart'
+                )
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('error', response.data)
+                self.assertFalse(target.documents.exists())
+
+    def test_import_fails_unprocessed_documents_without_file(self):
+        def processing_without_file(manifest):
+            manifest['documents'][0].update(status='processing', file=None)
+
+        target = Chatbot.objects.create(owner=self.user, name='Imported Bot')
+        with patch('chatbots.views.ingest_documents') as ingest, self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                f'/api/chatbots/{target.id}/import_snapshot/',
+                {'snapshot': SimpleUploadedFile('snapshot.zip', self._rewrite_manifest(processing_without_file))},
+                format='multipart'
+            )
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['queued'], 0)
+        imported = target.documents.get()
+        self.assertEqual(imported.status, 'failed')
+        self.assertEqual(imported.error_message, 'File not included in the snapshot')
+        ingest.assert_not_called()
+
+
+class FilteredRetrievalTests(RagbotTestCase):
+
+    def setUp(self):
+        self.use_temp_media()
+
+        cache.clear()
+        vector_index.invalidate()
+        self.addCleanup(vector_index.invalidate)
+        self.owner = self.create_owner()
+        self.chatbot = self.create_chatbot(self.owner, 'Filter Bot')
+        # Three documents with one-hot style embeddings so scores are predictable
+        self.documents = {}
+        for position, (name, file_type) in enumerate([('a.pdf', 'pdf'), ('b.txt', 'txt'), ('c.md', 'md')]):
+            document = Document.objects.create(
+                chatbot=self.chatbot, file=ContentFile(b'x', name=name), file_name=name,
+                file_type=file_type, file_size=1, status='completed', processed_at=timezone.now()
+            )
+            embedding = [0.0, 0.0, 0.0]
+            embedding[position] = 1.0
+            DocumentChunk.objects.bulk_create([
+                DocumentChunk(document=document, content=f'{name} chunk {i}', chunk_index=i,
+                              embedding=[value + 0.01 * i for value in embedding])
+                for i in range(3)
+            ])
+            self.documents[name] = document
+        patcher = patch('services.rag_service.rag_service.embeddings_model')
+        self.embeddings = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.embeddings.embed_query.return_value = [1.0, 0.0, 0.0]
+
+    def _retrieve(self, filters=None, top_k=2):
+        return rag_service.retrieve_relevant_chunks(self.chatbot.id, 'question', top_k=top_k, filters=filters)
+
+    def test_unfiltered_search_ranks_all_documents(self):
+        results = self._retrieve()
+        self.assertEqual([r['document_name'] for r in results], ['a.pdf', 'a.pdf'])
+        self.assertAlmostEqual(results[0]['similarity'], 1.0, places=3)
+
+    def test_filter_scores_only_selected_segments(self):
+        index = vector_index.get_index(self.chatbot.id)
+        mask = index.document_mask({'file_types': ['txt', 'md']})
+        self.assertEqual(index.row_runs(mask), [(3, 9)])
+        mask = index.document_mask({'document_ids': [self.documents['a.pdf'].id, self.documents['c.md'].id]})
+        self.assertEqual(index.row_runs(mask), [(0, 3), (6, 9)])
+
+        results = self._retrieve({'file_types': ['txt', 'md']}, top_k=10)
+        self.assertEqual(len(results), 6)
+        self.assertNotIn('a.pdf', {r['document_name'] for r in results})
+
+        results = self._retrieve({'document_ids': [self.documents['c.md'].id]})
+        self.assertEqual({r['document_name'] for r in results}, {'c.md'})
+
+        Document.objects.filter(pk=self.documents['b.txt'].pk).update(uploaded_at=timezone.now() - timedelta(days=30))
+        vector_index.invalidate()
+        results = self._retrieve({'uploaded_before': timezone.now() - timedelta(days=1)}, top_k=10)
+        self.assertEqual({r['document_name'] for r in results}, {'b.txt'})
+
+    def test_index_rebuilt_when_documents_change(self):
+        first = vector_index.get_index(self.chatbot.id)
+        self.assertIs(vector_index.get_index(self.chatbot.id), first)
+        self.documents['a.pdf'].delete()
+        self.assertEqual(len(vector_index.get_index(self.chatbot.id)), 6)
+
+    def test_chat_endpoint_passes_and_validates_filter(self):
+        url = f'/api/chat/{self.chatbot.id}/'
+        client = APIClient()
+        with patch('chatbots.chat_views.rag_service.generate_response', return_value={
+            'success': True, 'response': 'answer', 'tokens_used': 3, 'chunks_used': []
+        }) as generate:
+            response = client.post(url, {'message': 'hi', 'filter': {'file_types': ['exe']}}, format='json')
+            self.assertEqual(response.status_code, 400)
+            generate.assert_not_called()
+
+            response = client.post(url, {'message': 'hi', 'filter': {'file_types': ['pdf']}}, format='json')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(generate.call_args.kwargs['retrieval_filter'], {'file_types': ['pdf']})
+
+
+class BatchQuestionAnsweringTests(RagbotTestCase):
+
+    def setUp(self):
+        self.media_root = self.use_temp_media()
+        vector_index.invalidate()
+        self.addCleanup(vector_index.invalidate)
+
+        self.owner = self.create_owner(max_queries_per_month=10)
+        self.client.force_authenticate(self.owner)
+        self.chatbot = self.create_chatbot(self.owner, 'Batch Bot')
+        for position, name in enumerate(['a.txt', 'b.txt']):
+            document = Document.objects.create(
+                chatbot=self.chatbot, file=ContentFile(b'x', name=name), file_name=name,
+                file_type='txt', file_size=1, status='completed', processed_at=timezone.now()
+            )
+            DocumentChunk.objects.create(
+                document=document, content=f'{name} text', chunk_index=0,
+                embedding=[1.0, 0.0] if position == 0 else [0.0, 1.0]
+            )
+
+        embeddings = patch('services.rag_service.rag_service.embeddings_model')
+        self.embeddings = embeddings.start()
+        self.addCleanup(embeddings.stop)
+        self.embeddings.embed_documents.side_effect = (
+            lambda texts: [[1.0, 0.0] if text.endswith(' a') else [0.0, 1.0] for text in texts]
+        )
+
+        llm = patch('services.rag_service.rag_service.client')
+        self.llm = llm.start()
+        self.addCleanup(llm.stop)
+        self.llm.chat.completions.create.side_effect = self._completion
+
+    def _completion(self, messages, **kwargs):
+        question = messages[-1]['content']
+        if question == 'fail':
+            raise RuntimeError('upstream error')
+        response = MagicMock()
+        response.choices[0].message.content = f'answer to {question}'
+        response.usage.prompt_tokens, response.usage.completion_tokens, response.usage.total_tokens = 10, 2, 12
+        return response
+
+    def _lines(self, response):
+        return [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+
+    def test_batch_retrieval_matches_single_queries(self):
+        index = vector_index.get_index(self.chatbot.id)
+        queries = [[1.0, 0.0], [0.2, 0.9], [0.5, 0.5]]
+        self.assertEqual(
+            index.search_many(queries, top_k=2, block_size=2),
+            [index.search(query, top_k=2) for query in queries]
+        )
+
+    def test_streams_results_and_refunds_failures(self):
+        response = self.client.post(f'/api/chatbots/{self.chatbot.id}/batch_qa/', {
+            'questions': ['about a', 'about b', 'fail'], 'top_k': 1
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+
+        lines = self._lines(response)
+        results = {line['index']: line for line in lines if line['type'] == 'result'}
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0]['answer'], 'answer to about a')
+        self.assertEqual(results[0]['sources'][0]['document'], 'a.txt')
+        self.assertEqual(results[1]['sources'][0]['document'], 'b.txt')
+        self.assertEqual(results[0]['total_tokens'], 12)
+        self.assertIn('latency_ms', results[0])
+        self.assertFalse(results[2]['success'])
+        self.assertEqual(lines[-1]['type'], 'summary')
+        self.assertEqual((lines[-1]['succeeded'], lines[-1]['failed']), (2, 1))
+        # One embedding call for the whole batch
+        self.embeddings.embed_documents.assert_called_once()
+
+        self.owner.refresh_from_db()
+        self.assertEqual(self.owner.queries_this_month, 2)
+
+    def test_answers_take_the_owners_scheduler_slots(self):
+        scheduler = FairScheduler()
+        with patch.object(rag_service, 'chat_scheduler', scheduler):
+            lines = self._lines(self.client.post(f'/api/chatbots/{self.chatbot.id}/batch_qa/', {
+                'questions': ['about a', 'about b', 'about a'], 'top_k': 1
+            }, format='json'))
+            self.assertEqual(lines[-1]['succeeded'], 3)
+            stats = scheduler.stats()
+            self.assertEqual((stats['totals']['admitted'], stats['in_flight'], stats['tenants']), (3, 0, {}))
+
+            # With the owner's slots taken by chat traffic the batch fails and is refunded
+            scheduler.acquire(self.owner.id, 'free')
+            scheduler.acquire(self.owner.id, 'free')
+            with override_settings(BATCH_QA_QUEUE_TIMEOUT_SECONDS=0.05):
+                lines = self._lines(self.client.post(f'/api/chatbots/{self.chatbot.id}/batch_qa/', {
+                    'questions': ['about a', 'about b'], 'top_k': 1
+                }, format='json'))
+        self.assertEqual((lines[-1]['succeeded'], lines[-1]['failed']), (0, 2))
+        self.assertEqual(self.llm.chat.completions.create.call_count, 3)
+        self.owner.refresh_from_db()
+        self.assertEqual(self.owner.queries_this_month, 3)
+
+    def test_batch_rejected_when_quota_too_small(self):
+        response = self.client.post(f'/api/chatbots/{self.chatbot.id}/batch_qa/', {
+            'questions': ['q'] * 11
+        }, format='json')
+        self.assertEqual(response.status_code, 429)
+        self.llm.chat.completions.create.assert_not_called()
+
+    def test_management_command_writes_ndjson(self):
+        questions = os.path.join(self.media_root, 'questions.txt')
+        with open(questions, 'w') as source:
+            source.write('about a\n{"question": "about b"}\n')
+        output = os.path.join(self.media_root, 'answers.ndjson')
+        call_command('batch_qa', self.chatbot.id, questions, '--output', output, stderr=io.StringIO())
+        with open(output) as result:
+            lines = [json.loads(line) for line in result]
+        self.assertEqual(sorted(line['question'] for line in lines[:-1]), ['about a', 'about b'])
+        self.assertEqual(lines[-1]['succeeded'], 2)
+
+
+class RetrievalPrewarmTests(RagbotTestCase):
+
+    def setUp(self):
+        self.use_temp_media()
+        vector_index.invalidate()
+        self.addCleanup(vector_index.invalidate)
+
+        owner = self.create_owner()
+        self.chatbots = []
+        for i in range(3):
+            chatbot = Chatbot.objects.create(owner=owner, name=f'Bot {i}')
+            document = Document.objects.create(
+                chatbot=chatbot, file=ContentFile(b'x', name='a.txt'), file_name='a.txt',
+                file_type='txt', file_size=1, status='completed', processed_at=timezone.now()
+            )
+            DocumentChunk.objects.bulk_create([
+                DocumentChunk(document=document, content='text', chunk_index=j, embedding=[1.0] * 256)
+                for j in range(4)
+            ])
+            conversation = Conversation.objects.create(chatbot=chatbot, title='chat')
+            Conversation.objects.filter(pk=conversation.pk).update(updated_at=timezone.now() - timedelta(hours=i))
+            self.chatbots.append(chatbot)
+        # Never chatted with: not hot
+        self.create_chatbot(owner, 'Idle Bot')
+
+    def test_warms_most_recently_active_within_budget(self):
+        self.assertEqual(vector_index.hot_chatbot_ids(10), [c.id for c in self.chatbots])
+
+        index_bytes = vector_index.build_index(self.chatbots[0].id).nbytes
+        warmed = vector_index.prewarm(limit=10, memory_budget=2 * index_bytes)
+        self.assertEqual([w['chatbot_id'] for w in warmed], [c.id for c in self.chatbots[:2]])
+        self.assertEqual(vector_index.cached_bytes(), 2 * index_bytes)
+
+        with CaptureQueriesContext(connection) as ctx:
+            vector_index.get_index(self.chatbots[0].id)
+        # Only the freshness check; nothing is loaded
+        self.assertEqual(len(ctx.captured_queries), 1)
+
+    def test_command_reports_warmed_chatbots(self):
+        out = io.StringIO()
+        call_command('warm_rag_cache', '--chatbot', str(self.chatbots[2].id), stdout=out)
+        self.assertIn(f'chatbot {self.chatbots[2].id}: 4 chunks', out.getvalue())
+        self.assertIn('Warmed 1 chatbots', out.getvalue())
+
+
+class SharedIndexTests(RagbotTestCase):
+
+    def setUp(self):
+        media_root = self.make_temp_dir()
+        self.index_dir = os.path.join(media_root, 'rag_index')
+        self.use_settings(MEDIA_ROOT=media_root, RAG_INDEX_DIR=self.index_dir)
+        vector_index.invalidate()
+        self.addCleanup(vector_index.invalidate)
+
+        owner = self.create_owner()
+        self.chatbot = self.create_chatbot(owner, 'Shared Bot')
+        self.chatbot_dir = os.path.join(self.index_dir, f'chatbot_{self.chatbot.id}')
+        self._add_document('a.pdf', [[1.0, 0.0], [0.6, 0.8]])
+
+    def _add_document(self, name, embeddings):
+        document = Document.objects.create(
+            chatbot=self.chatbot, file=ContentFile(b'x', name=name), file_name=name,
+            file_type=name.rsplit('.', 1)[1], file_size=1, status='completed', processed_at=timezone.now()
+        )
+        DocumentChunk.objects.bulk_create([
+            DocumentChunk(document=document, content=f'{name} {i}', chunk_index=i, embedding=embedding)
+            for i, embedding in enumerate(embeddings)
+        ])
+        return document
+
+    def _current(self):
+        return vector_index.version_name(vector_index.index_signature(self.chatbot.id))
+
+    def _versions(self):
+        return sorted(name for name in os.listdir(self.chatbot_dir) if name.startswith('v'))
+
+    def test_workers_map_the_published_version(self):
+        index = vector_index.get_index(self.chatbot.id)
+        self.assertIsInstance(index.matrix, np.memmap)
+        self.assertEqual(self._versions(), [vector_index.version_name(index.signature)])
+
+        # Another worker: nothing cached in-process, so it maps the files without loading chunks
+        vector_index.invalidate()
+        with CaptureQueriesContext(connection) as ctx:
+            mapped = vector_index.get_index(self.chatbot.id)
+        self.assertEqual(len(ctx.captured_queries), 1)
+        self.assertEqual(mapped.search([1.0, 0.0], top_k=2), index.search([1.0, 0.0], top_k=2))
+
+        with override_settings(RAG_INDEX_DIR=''):
+            private = vector_index.build_index(self.chatbot.id)
+        self.assertEqual(private.search([0.0, 1.0], top_k=2), mapped.search([0.0, 1.0], top_k=2))
+
+    def test_refresh_publishes_version_and_prunes_old_ones(self):
+        first = vector_index.version_name(vector_index.get_index(self.chatbot.id).signature)
+
+        self._add_document('b.txt', [[0.0, 1.0]])
+        vector_index.refresh(self.chatbot.id)
+        second = self._current()
+        self.assertNotEqual(second, first)
+        self.assertEqual(self._versions(), sorted([first, second]))
+        self.assertEqual(len(vector_index.get_index(self.chatbot.id)), 3)
+
+        self._add_document('c.md', [[0.5, 0.5]])
+        vector_index.refresh(self.chatbot.id)
+        self.assertEqual(self._versions(), sorted([second, self._current()]))
+
+    def test_pruning_waits_for_loading_processes(self):
+        first = vector_index.index_signature(self.chatbot.id)
+        vector_index.publish(self.chatbot.id, first)
+        self._add_document('b.txt', [[0.0, 1.0]])
+        vector_index.publish(self.chatbot.id)
+        self._add_document('c.md', [[0.5, 0.5]])
+        third = vector_index.index_signature(self.chatbot.id)
+        third_index = vector_index.build_index(self.chatbot.id, third)
+
+        loading = threading.Event()
+        release = threading.Event()
+        load_version = vector_index._load_version
+
+        def slow_load(directory, signature):
+            loading.set()
+            release.wait(5)
+            return load_version(directory, signature)
+
+        # Another process is opening the first version when the third is published,
+        # which prunes the first
+        results = []
+        with patch('services.vector_index._load_version', side_effect=slow_load):
+            reader = threading.Thread(target=lambda: results.append(vector_index._load_or_build(self.chatbot.id, first)))
+            reader.start()
+            self.assertTrue(loading.wait(5))
+        with patch('services.vector_index.build_index', return_value=third_index):
+            publisher = threading.Thread(target=vector_index.publish, args=(self.chatbot.id, third))
+            publisher.start()
+            publisher.join(0.2)
+            self.assertTrue(publisher.is_alive())
+            release.set()
+            reader.join(5)
+            publisher.join(5)
+
+        self.assertEqual(len(results[0]), 2)
+        self.assertNotIn(vector_index.version_name(first), self._versions())
+
+
+class ReRankingTests(RagbotTestCase):
+
+    def setUp(self):
+        self.use_temp_media()
+        cache.clear()
+        vector_index.invalidate()
+        self.addCleanup(vector_index.invalidate)
+
+        owner = self.create_owner()
+        self.chatbot = self.create_chatbot(owner, 'Rerank Bot')
+        document = Document.objects.create(
+            chatbot=self.chatbot, file=ContentFile(b'x', name='a.txt'), file_name='a.txt',
+            file_type='txt', file_size=1, status='completed', processed_at=timezone.now()
+        )
+        # Three near-copies of the best answer and one different, still relevant chunk
+        embeddings = [[1.0, 0.0, 0.0], [0.99, 0.01, 0.0], [0.99, 0.0, 0.01], [0.7, 0.7, 0.0]]
+        DocumentChunk.objects.bulk_create([
+            DocumentChunk(document=document, content=f'chunk {i}', chunk_index=i,
+                          embedding=embedding, metadata={'token_count': 10})
+            for i, embedding in enumerate(embeddings)
+        ])
+        patcher = patch('services.rag_service.rag_service.embeddings_model')
+        self.embeddings = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.embeddings.embed_query.return_value = [1.0, 0.0, 0.0]
+
+    def _retrieve(self, **rerank):
+        return rag_service.retrieve_many(self.chatbot.id, ['q'], top_k=3, rerank=rerank or None)[0]
+
+    def test_plain_top_k_returns_duplicates(self):
+        retrieved = self._retrieve()
+        self.assertEqual([c['content'] for c in retrieved['chunks']], ['chunk 0', 'chunk 1', 'chunk 2'])
+        self.assertEqual(retrieved['prompt_tokens_saved'], 0)
+
+    def test_duplicate_collapse_drops_near_copies(self):
+        retrieved = self._retrieve(duplicate_threshold=0.98)
+        self.assertEqual([c['content'] for c in retrieved['chunks']], ['chunk 0'])
+        self.assertEqual(retrieved['prompt_tokens_saved'], 20)
+
+    def test_mmr_prefers_diverse_chunks(self):
+        retrieved = self._retrieve(mmr_lambda=0.3)
+        self.assertEqual([c['content'] for c in retrieved['chunks']][:2], ['chunk 0', 'chunk 3'])
+
+        retrieved = self._retrieve(mmr_lambda=0.3, duplicate_threshold=0.98)
+        self.assertEqual([c['content'] for c in retrieved['chunks']], ['chunk 0', 'chunk 3'])
+        self.assertEqual(retrieved['prompt_tokens_saved'], 10)
+
+    def test_chat_records_tokens_saved(self):
+        Chatbot.objects.filter(pk=self.chatbot.pk).update(duplicate_threshold=0.98)
+        response = MagicMock()
+        response.choices[0].message.content = 'answer'
+        response.usage.total_tokens = 30
+        with patch('services.rag_service.rag_service.client') as llm:
+            llm.chat.completions.create.return_value = response
+            reply = APIClient().post(f'/api/chat/{self.chatbot.id}/', {'message': 'hi'})
+        self.assertEqual(reply.status_code, 200)
+        self.assertEqual(reply.data['ai_response']['prompt_tokens_saved'], 20)
+        self.assertEqual(Message.objects.get(role='assistant').prompt_tokens_saved, 20)
+
+
+class ContextReferenceTests(RagbotTestCase):
+    """Assistant messages store chunk refs; previews are resolved only on request"""
+
+    def setUp(self):
+        cache.clear()
+        self.owner = self.create_owner()
+        self.client.force_authenticate(self.owner)
+        self.chatbot = self.create_chatbot(self.owner, 'Context Bot')
+        document = Document.objects.create(
+            chatbot=self.chatbot, file='documents/guide.txt', file_name='guide.txt',
+            file_type='txt', file_size=1, status='completed'
+        )
+        self.chunks = [
+            DocumentChunk.objects.create(document=document, chunk_index=i, content=f'chunk {i} ' + 'x' * 300)
+            for i in range(3)
+        ]
+
+    def test_chat_stores_refs_without_previews(self):
+        chunk = self.chunks[1]
+        with patch('chatbots.chat_views.rag_service.generate_response', return_value={
+            'success': True, 'response': 'answer', 'tokens_used': 3,
+            'chunks_used': [{'chunk_id': chunk.id, 'document': 'guide.txt', 'similarity': 0.9,
+                             'content_preview': chunk.content[:200] + '...'}],
+        }):
+            response = self.client.post(f'/api/chat/{self.chatbot.id}/', {'message': 'hi'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['context'][0]['document'], 'guide.txt')
+        message = Message.objects.get(role='assistant')
+        self.assertEqual((message.context_chunk_ids, message.context_scores), ([chunk.id], [0.9]))
+
+    def test_history_resolves_previews_in_one_query(self):
+        conversation = Conversation.objects.create(chatbot=self.chatbot, user=self.owner, title='t')
+        for i in range(4):
+            Message.objects.create(
+                conversation=conversation, role='assistant', content=f'answer {i}',
+                context_chunk_ids=[chunk.id for chunk in self.chunks], context_scores=[0.5] * 3,
+            )
+        url = f'/api/chat/conversation/{conversation.id}/'
+
+        plain = self.client.get(url).data['messages'][0]['context_used']
+        self.assertEqual(plain[0], {'chunk_id': self.chunks[0].id, 'similarity': 0.5})
+
+        # Compare uncached builds of both representations
+        cache.clear()
+        with CaptureQueriesContext(connection) as plain_queries:
+            self.client.get(url)
+        with CaptureQueriesContext(connection) as preview_queries:
+            response = self.client.get(url, {'previews': 'true'})
+        self.assertEqual(len(preview_queries), len(plain_queries) + 1)
+
+        entry = response.data['messages'][0]['context_used'][2]
+        self.assertEqual(entry['chunk_id'], self.chunks[2].id)
+        self.assertEqual(entry['document'], 'guide.txt')
+        self.assertEqual(entry['content_preview'], self.chunks[2].content[:200] + '...')
+
+    def test_conversation_messages_action_with_previews(self):
+        conversation = Conversation.objects.create(chatbot=self.chatbot, user=self.owner, title='t')
+        Message.objects.create(
+            conversation=conversation, role='assistant', content='answer',
+            context_chunk_ids=[self.chunks[0].id, self.chunks[1].id], context_scores=[0.8, 0.1],
+        )
+        # Reprocessing replaces a document's chunks with new ids
+        stale_id = self.chunks[1].id
+        self.chunks[1].delete()
+        response = self.client.get(f'/api/conversations/{conversation.id}/messages/', {'previews': '1'})
+
+        context = response.data['results'][0]['context_used']
+        self.assertEqual(context[0]['document'], 'guide.txt')
+        # Refs to deleted chunks keep their score and are flagged
+        self.assertEqual(context[1], {'chunk_id': stale_id, 'similarity': 0.1, 'missing': True})
+
+
+class ConversationRetentionTests(RagbotTestCase):
+
+    def setUp(self):
+        self.archive_dir = self.make_temp_dir()
+        self.use_settings(CONVERSATION_ARCHIVE_DIR=self.archive_dir)
+
+        self.owner = self.create_owner()
+        self.chatbot = self.create_chatbot(self.owner, 'Short Memory', message_retention_days=30)
+        self.keeper = self.create_chatbot(self.owner, 'Keeps Everything')
+
+    def _conversation(self, chatbot, days_idle, messages=2):
+        conversation = Conversation.objects.create(chatbot=chatbot, title=f'{days_idle} days')
+        for i in range(messages):
+            Message.objects.create(
+                conversation=conversation, role='user' if i % 2 == 0 else 'assistant',
+                content=f'message {i}', context_chunk_ids=[1] if i % 2 else [], context_scores=[0.5] if i % 2 else [],
+                degraded_paths=['fewer_chunks'] if i % 2 else []
+            )
+        Conversation.objects.filter(id=conversation.id).update(updated_at=timezone.now() - timedelta(days=days_idle))
+        return conversation
+
+    def test_expired_conversations_archived_and_deleted(self):
+        expired = [self._conversation(self.chatbot, 40 + i, messages=i + 1) for i in range(3)]
+        recent = self._conversation(self.chatbot, 5)
+        kept = self._conversation(self.keeper, 400)
+
+        out = io.StringIO()
+        call_command('archive_conversations', '--batch-size', '2', stdout=out)
+
+        self.assertIn('archived 3 conversations, 6 messages', out.getvalue())
+        remaining = set(Conversation.objects.values_list('id', flat=True))
+        self.assertEqual(remaining, {recent.id, kept.id})
+        self.assertFalse(Message.objects.filter(conversation_id__in=[c.id for c in expired]).exists())
+
+        archives = os.listdir(os.path.join(self.archive_dir, f'chatbot_{self.chatbot.id}'))
+        self.assertEqual(len(archives), 1)
+        # Two batches are two gzip members of the same file
+        with gzip.open(os.path.join(self.archive_dir, f'chatbot_{self.chatbot.id}', archives[0]), 'rt') as source:
+            lines = [json.loads(line) for line in source]
+        self.assertEqual([line['id'] for line in lines], [c.id for c in expired])
+        self.assertEqual([m['content'] for m in lines[2]['messages']], ['message 0', 'message 1', 'message 2'])
+        self.assertEqual(lines[2]['messages'][1]['context_chunk_ids'], [1])
+        self.assertEqual(lines[2]['messages'][1]['context_scores'], [0.5])
+        self.assertEqual(lines[2]['messages'][1]['degraded_paths'], ['fewer_chunks'])
+
+    def test_dry_run_changes_nothing(self):
+        self._conversation(self.chatbot, 90)
+        out = io.StringIO()
+        call_command('archive_conversations', '--dry-run', stdout=out)
+        self.assertIn('would archive 1 conversations, 2 messages', out.getvalue())
+        self.assertEqual(Conversation.objects.count(), 1)
+        self.assertEqual(os.listdir(self.archive_dir), [])
+
+    @skipUnless(connection.vendor == 'postgresql', 'messages is only partitioned on PostgreSQL')
+    def test_monthly_partitions_maintained(self):
+        self.assertTrue(message_archive.messages_partitioned())
+
+        created = message_archive.ensure_message_partitions(months_ahead=1, today=date(2020, 1, 15))
+        self.assertEqual(created, ['messages_p2020_01', 'messages_p2020_02'])
+        self.assertEqual(message_archive.ensure_message_partitions(months_ahead=1, today=date(2020, 1, 15)), [])
+
+        conversation = self._conversation(self.chatbot, 0, messages=1)
+        # Rows move between partitions when their key changes
+        Message.objects.filter(conversation=conversation).update(created_at=datetime(2020, 2, 10, tzinfo=dt_timezone.utc))
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM messages_p2020_02')
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+        dropped = message_archive.drop_empty_partitions(today=date(2020, 3, 1))
+        self.assertEqual(dropped, ['messages_p2020_01'])
+        self.assertIn('messages_p2020_02', message_archive.message_partitions())
+
+    @skipUnless(connection.vendor == 'postgresql', 'messages is only partitioned on PostgreSQL')
+    def test_missed_month_moved_out_of_default_partition(self):
+        conversation = self._conversation(self.chatbot, 0, messages=2)
+        # No partition covers June 2019, so the rows land in the default partition
+        Message.objects.filter(conversation=conversation).update(created_at=datetime(2019, 6, 10, tzinfo=dt_timezone.utc))
+
+        created = message_archive.ensure_message_partitions(months_ahead=0, today=date(2020, 1, 15))
+
+        self.assertEqual(created, ['messages_p2019_06', 'messages_p2020_01'])
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM messages_p2019_06')
+            self.assertEqual(cursor.fetchone()[0], 2)
+            cursor.execute('SELECT COUNT(*) FROM messages_default')
+            self.assertEqual(cursor.fetchone()[0], 0)
+        self.assertEqual(Message.objects.filter(conversation=conversation).count(), 2)
+        self.assertEqual(message_archive.ensure_message_partitions(months_ahead=0, today=date(2020, 1, 15)), [])
+
+
+class ChatTurnPersistenceTests(RagbotTestCase):
+    """A chat turn reads and writes the database in a fixed, small number of statements"""
+
+    MAX_QUERIES_PER_TURN = 4
+
+    def setUp(self):
+        cache.clear()
+        self.owner = self.create_owner()
+        self.chatbot = self.create_chatbot(self.owner, 'Turn Bot')
+        self.url = f'/api/chat/{self.chatbot.id}/'
+        patcher = patch('chatbots.chat_views.rag_service.generate_response', return_value={
+            'success': True, 'response': 'answer', 'tokens_used': 3, 'chunks_used': []
+        })
+        self.generate = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _post(self, **data):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.url, {'message': 'hello', **data}, format='json')
+        # Savepoints only exist because the test itself runs in a transaction
+        statements = [q['sql'] for q in queries if not q['sql'].startswith(('SAVEPOINT', 'RELEASE SAVEPOINT'))]
+        return response, statements
+
+    def test_new_conversation_turn(self):
+        response, statements = self._post()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(len(statements), self.MAX_QUERIES_PER_TURN, statements)
+        conversation = Conversation.objects.get(id=response.data['conversation_id'])
+        self.assertEqual(list(conversation.messages.values_list('role', 'content')),
+                         [('user', 'hello'), ('assistant', 'answer')])
+
+    def test_existing_conversation_turn(self):
+        first, _ = self._post()
+        conversation_id = first.data['conversation_id']
+        stale = timezone.now() - timedelta(days=3)
+        Conversation.objects.filter(id=conversation_id).update(updated_at=stale)
+
+        response, statements = self._post(message='again', conversation_id=conversation_id)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(len(statements), self.MAX_QUERIES_PER_TURN, statements)
+        self.assertEqual(self.generate.call_args.kwargs['conversation_history'], [
+            {'role': 'user', 'content': 'hello'}, {'role': 'assistant', 'content': 'answer'},
+        ])
+        conversation = Conversation.objects.get(id=conversation_id)
+        self.assertGreater(conversation.updated_at, stale)
+        self.assertEqual([m.content for m in conversation.messages.all()], ['hello', 'answer', 'again', 'answer'])
+
+    def test_history_limited_to_latest_messages(self):
+        conversation = Conversation.objects.create(chatbot=self.chatbot, title='long')
+        Message.objects.bulk_create([
+            Message(conversation=conversation, role='user', content=f'm{i}') for i in range(8)
+        ])
+        self._post(conversation_id=conversation.id)
+        history = self.generate.call_args.kwargs['conversation_history']
+        self.assertEqual([entry['content'] for entry in history], ['m3', 'm4', 'm5', 'm6', 'm7'])
+
+    def test_foreign_conversation_rejected_and_refunded(self):
+        other = Chatbot.objects.create(owner=self.owner, name='Other Bot')
+        conversation = Conversation.objects.create(chatbot=other, title='elsewhere')
+
+        response, _ = self._post(conversation_id=conversation.id)
+
+        self.assertEqual(response.status_code, 404)
+        self.generate.assert_not_called()
+        self.assertFalse(Message.objects.exists())
+        self.owner.refresh_from_db()
+        self.assertEqual(self.owner.queries_this_month, 0)
+
+
+@override_settings(DATABASE_READ_REPLICA='replica', DATABASE_REPLICA_STICKY_SECONDS=5)
+class ReplicaRoutingTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.router = ReplicaRouter()
+        token = db_router._pinned.set(False)
+        self.addCleanup(db_router._pinned.reset, token)
+
+    def test_reads_go_to_replica_until_a_write(self):
+        self.assertEqual(self.router.db_for_read(DocumentChunk), 'replica')
+        self.assertEqual(self.router.db_for_read(Conversation), 'replica')
+        # Auth data is always read from the primary
+        self.assertEqual(self.router.db_for_read(User), 'default')
+
+        self.assertEqual(self.router.db_for_write(User), 'default')
+        self.assertEqual(self.router.db_for_read(DocumentChunk), 'replica')
+
+        self.assertEqual(self.router.db_for_write(Message), 'default')
+        self.assertEqual(self.router.db_for_read(DocumentChunk), 'default')
+
+    def test_recently_written_conversation_read_from_primary(self):
+        db_router.mark_conversation_written(7)
+        db_router.read_conversation_from_primary_if_recent(8)
+        self.assertEqual(self.router.db_for_read(Message), 'replica')
+        db_router.read_conversation_from_primary_if_recent(7)
+        self.assertEqual(self.router.db_for_read(Message), 'default')
+
+    def test_middleware_unpins_each_request(self):
+        seen = []
+
+        def view(request):
+            seen.append(self.router.db_for_read(Message))
+            self.router.db_for_write(Message)
+            return None
+
+        middleware = db_router.ReplicaPinMiddleware(view)
+        db_router.pin_to_primary()
+        middleware(None)
+        middleware(None)
+        self.assertEqual(seen, ['replica', 'replica'])
+        self.assertTrue(db_router.pinned_to_primary())
+
+    @override_settings(DATABASE_READ_REPLICA=None)
+    def test_without_replica_everything_uses_default(self):
+        self.assertEqual(self.router.db_for_read(DocumentChunk), 'default')
+        self.assertFalse(self.router.allow_migrate('replica', 'documents'))
+
+
+class ConditionalGetTests(RagbotTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = self.create_owner('etag')
+        self.client.force_authenticate(self.user)
+        self.chatbot = self.create_chatbot(self.user, 'Polled Bot')
+        self.conversation = Conversation.objects.create(chatbot=self.chatbot, title='Polled')
+        Message.objects.create(conversation=self.conversation, role='user', content='hello')
+
+    def test_not_modified_skips_serialization(self):
+        first = self.client.get('/api/chatbots/')
+        self.assertEqual(first.status_code, 200)
+        etag = first['ETag']
+
+        with patch('chatbots.views.ChatbotSerializer') as serializer, \
+                CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/chatbots/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        serializer.assert_not_called()
+        self.assertEqual(len(queries), 1)
+
+    def test_delete_not_hidden_by_if_modified_since(self):
+        url = f'/api/chatbots/{self.chatbot.id}/'
+        first = self.client.get(url)
+        self.assertFalse(first.has_header('Last-Modified'))
+        self.assertEqual(first.data['conversation_count'], 1)
+        self.assertEqual(self.client.delete(f'/api/conversations/{self.conversation.id}/').status_code, 204)
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE='Fri, 01 Jan 2100 00:00:00 GMT')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['conversation_count'], 0)
+
+    def test_repeat_request_served_from_cache(self):
+        self.client.get(f'/api/chatbots/{self.chatbot.id}/')
+        with patch('chatbots.views.ChatbotSerializer') as serializer:
+            response = self.client.get(f'/api/chatbots/{self.chatbot.id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['name'], 'Polled Bot')
+        serializer.assert_not_called()
+
+    def test_write_changes_etag(self):
+        url = f'/api/chatbots/{self.chatbot.id}/'
+        etag = self.client.get(url)['ETag']
+        self.client.patch(url, {'description': 'changed'}, format='json')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['description'], 'changed')
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_document_status_change_changes_etag(self):
+        document = Document.objects.create(
+            chatbot=self.chatbot, file='documents/doc.txt', file_name='doc.txt',
+            file_type='txt', file_size=4, status='processing'
+        )
+        etag = self.client.get('/api/documents/')['ETag']
+        self.assertEqual(self.client.get('/api/documents/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        # Background processing writes outside the API
+        document.status = 'completed'
+        document.save(update_fields=['status', 'updated_at'])
+        response = self.client.get('/api/documents/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_history_not_modified_until_new_message(self):
+        url = f'/api/chat/conversation/{self.conversation.id}/'
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        Message.objects.create(conversation=self.conversation, role='assistant', content='hi')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([m['content'] for m in response.data['messages']], ['hello', 'hi'])
+
+
+class ResponseEncodingTests(RagbotTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = self.create_owner('encoding')
+        self.client.force_authenticate(self.user)
+        self.chatbot = self.create_chatbot(self.user, 'Encoding Bot')
+        self.conversation = Conversation.objects.create(chatbot=self.chatbot, title='Long')
+        Message.objects.bulk_create([
+            Message(conversation=self.conversation, role='user', content=f'question {i} ' + 'lorem ipsum ' * 20)
+            for i in range(50)
+        ])
+        self.url = f'/api/chat/conversation/{self.conversation.id}/'
+
+    def test_renderer_matches_drf_encoding(self):
+        from rest_framework.renderers import JSONRenderer
+        from ragbot_backend.renderers import ORJSONRenderer
+
+        data = {
+            'created_at': datetime(2024, 5, 1, 12, 30, 15, 120000, tzinfo=dt_timezone.utc),
+            'day': date(2024, 5, 1),
+            'elapsed': timedelta(seconds=90),
+            'score': np.float32(0.5),
+            'label': gettext_lazy('Chatbot'),
+            'text': 'line\u2028break',
+            7: 'non-string key',
+        }
+        self.assertEqual(
+            json.loads(ORJSONRenderer().render(data)),
+            json.loads(JSONRenderer().render(data)),
+        )
+        rendered = ORJSONRenderer().render({'created_at': data['created_at'], 'price': Decimal('0.10')})
+        self.assertEqual(rendered, b'{"created_at":"2024-05-01T12:30:15.120000Z","price":"0.10"}')
+        self.assertIn(b'\\u2028', ORJSONRenderer().render(data))
+
+    def test_parser_accepts_and_rejects_json(self):
+        response = self.client.patch(
+            f'/api/chatbots/{self.chatbot.id}/', '{"description": "café"}', content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.chatbot.refresh_from_db()
+        self.assertEqual(self.chatbot.description, 'café')
+
+        response = self.client.patch(
+            f'/api/chatbots/{self.chatbot.id}/', '{"description": ', content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_large_response_compressed_with_preferred_encoding(self):
+        plain = self.client.get(self.url, {'limit': 50})
+        self.assertFalse(plain.has_header('Content-Encoding'))
+
+        response = self.client.get(self.url, {'limit': 50}, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(json.loads(gzip.decompress(response.content)), json.loads(plain.content))
+        self.assertLess(len(response.content), len(plain.content) // 4)
+        self.assertTrue(response['ETag'].startswith('W/'))
+
+        response = self.client.get(self.url, {'limit': 50}, HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        response = self.client.get(self.url, {'limit': 50}, HTTP_ACCEPT_ENCODING='gzip;q=1.0, br;q=0')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+
+    def test_small_response_not_compressed(self):
+        response = self.client.get(self.url, {'limit': 1}, HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    def test_streaming_response_compressed_per_chunk(self):
+        from ragbot_backend.compression import compress_stream
+
+        chunks = [f'{{"line": {i}}}\n'.encode() for i in range(3)]
+        with gzip.GzipFile(fileobj=io.BytesIO(b''.join(compress_stream(iter(chunks), 'gzip')))) as stream:
+            self.assertEqual(stream.read(), b''.join(chunks))
+        # Every chunk is decodable as soon as it is sent
+        first = next(compress_stream(iter(chunks), 'gzip'))
+        self.assertEqual(zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(first), chunks[0])
+
+
+class StreamingExportTests(RagbotTestCase):
+
+    def setUp(self):
+        self.user = self.create_owner('export')
+        self.client.force_authenticate(self.user)
+        self.chatbot = self.create_chatbot(self.user, 'Export Bot')
+        self.document = Document.objects.create(
+            chatbot=self.chatbot, file='documents/export.txt', file_name='export.txt',
+            file_type='txt', file_size=1, status='completed'
+        )
+        DocumentChunk.objects.bulk_create([
+            DocumentChunk(document=self.document, content=f'chunk {i}', chunk_index=i,
+                          embedding=[0.25, float(i)], metadata={'chunk_number': i + 1})
+            for i in range(7)
+        ])
+        deleted = Document.objects.create(
+            chatbot=self.chatbot, file='documents/gone.txt', file_name='gone.txt',
+            file_type='txt', file_size=1, status='completed'
+        )
+        DocumentChunk.objects.create(document=deleted, content='gone', chunk_index=0)
+        Document.objects.filter(id=deleted.id).soft_delete()
+
+    @staticmethod
+    def _lines(response):
+        return [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+
+    def test_chunks_stream_lazily_in_blocks(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f'/api/chatbots/{self.chatbot.id}/export_chunks/')
+        # Nothing is read until the body is consumed
+        self.assertFalse(any('document_chunks' in query['sql'] for query in queries))
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+
+        with patch.object(exports, 'ITERATOR_CHUNK_SIZE', 2), patch.object(exports, 'BLOCK_BYTES', 150):
+            blocks = list(response.streaming_content)
+        self.assertGreater(len(blocks), 1)
+        rows = [json.loads(line) for line in b''.join(blocks).splitlines()]
+        self.assertEqual([row['content'] for row in rows], [f'chunk {i}' for i in range(7)])
+        self.assertEqual(rows[0]['document'], 'export.txt')
+        self.assertEqual(rows[0]['metadata'], {'chunk_number': 1})
+        self.assertNotIn('embedding', rows[0])
+
+    def test_document_chunks_with_embeddings(self):
+        response = self.client.get(f'/api/documents/{self.document.id}/export_chunks/', {'embeddings': 'true'})
+        rows = self._lines(response)
+        self.assertEqual(len(rows), 7)
+        self.assertEqual(rows[3]['embedding'], [0.25, 3.0])
+
+    def test_conversations_followed_by_their_messages(self):
+        first = Conversation.objects.create(chatbot=self.chatbot, title='First')
+        Conversation.objects.create(chatbot=self.chatbot, title='Empty')
+        last = Conversation.objects.create(chatbot=self.chatbot, title='Last')
+        Message.objects.bulk_create([
+            Message(conversation=conversation, role='user', content=f'{conversation.title} {i}')
+            for conversation in (last, first) for i in range(2)
+        ])
+        deleted = Conversation.objects.create(chatbot=self.chatbot, title='Deleted')
+        Message.objects.create(conversation=deleted, role='user', content='hidden')
+        Conversation.objects.filter(id=deleted.id).soft_delete()
+
+        rows = self._lines(self.client.get(f'/api/chatbots/{self.chatbot.id}/export_conversations/'))
+        self.assertEqual(
+            [(row['type'], row.get('title') or row['content']) for row in rows],
+            [('conversation', 'First'), ('message', 'First 0'), ('message', 'First 1'),
+             ('conversation', 'Empty'),
+             ('conversation', 'Last'), ('message', 'Last 0'), ('message', 'Last 1')],
+        )
+        self.assertEqual(rows[1]['conversation_id'], first.id)
+
+
+class EmbeddingReductionTests(RagbotTestCase):
+
+    def setUp(self):
+        self.media_root = self.use_temp_media()
+        vector_index.invalidate()
+        self.addCleanup(vector_index.invalidate)
+
+        self.owner = self.create_owner('reduce')
+        self.chatbot = self.create_chatbot(self.owner, 'Reduced Bot')
+        document = Document.objects.create(
+            chatbot=self.chatbot, file=ContentFile(b'x', name='a.txt'), file_name='a.txt',
+            file_type='txt', file_size=1, status='completed', processed_at=timezone.now()
+        )
+        # 8-dimensional vectors that vary almost only within a 2-dimensional subspace
+        rng = np.random.default_rng(1)
+        basis = np.linalg.qr(rng.normal(size=(8, 2)))[0].T
+        self.vectors = rng.normal(size=(40, 2)) @ basis + rng.normal(scale=1e-3, size=(40, 8))
+        DocumentChunk.objects.bulk_create([
+            DocumentChunk(document=document, content=f'chunk {i}', chunk_index=i, embedding=vector.tolist())
+            for i, vector in enumerate(self.vectors)
+        ])
+
+    def _reduce(self, method, dimensions):
+        Chatbot.objects.filter(pk=self.chatbot.pk).update(embedding_reduction=method, embedding_dimensions=dimensions)
+
+    def test_pca_index_matches_full_search(self):
+        full = vector_index.get_index(self.chatbot.id)
+        self._reduce('pca', 2)
+        reduced = vector_index.get_index(self.chatbot.id)
+
+        self.assertEqual(full.matrix.shape, (40, 8))
+        self.assertEqual(reduced.matrix.shape, (40, 2))
+        self.assertLess(reduced.nbytes, full.nbytes)
+        np.testing.assert_allclose(np.linalg.norm(reduced.matrix, axis=1), 1.0, rtol=1e-5)
+        for query in self.vectors[:5]:
+            self.assertEqual(
+                [chunk_id for chunk_id, _ in reduced.search(query, top_k=3)][0],
+                [chunk_id for chunk_id, _ in full.search(query, top_k=3)][0],
+            )
+
+    def test_truncation_keeps_leading_components_renormalised(self):
+        self._reduce('truncate', 3)
+        index = vector_index.get_index(self.chatbot.id)
+        first = self.vectors[0][:3]
+        np.testing.assert_allclose(index.matrix[0], first / np.linalg.norm(first), rtol=1e-5)
+        self.assertEqual(index.search(self.vectors[0], top_k=1)[0][0], index.chunk_ids[0])
+
+    def test_shared_version_stores_the_projection(self):
+        self._reduce('pca', 2)
+        with override_settings(RAG_INDEX_DIR=os.path.join(self.media_root, 'rag_index')):
+            built = vector_index.get_index(self.chatbot.id)
+            self.assertTrue(vector_index.version_name(built.signature).endswith('-pca2'))
+            vector_index.invalidate()
+            mapped = vector_index.get_index(self.chatbot.id)
+        self.assertIsInstance(mapped.matrix, np.memmap)
+        np.testing.assert_array_equal(mapped.projection.components, built.projection.components)
+        self.assertEqual(mapped.search(self.vectors[3], top_k=3), built.search(self.vectors[3], top_k=3))
+
+    def test_evaluation_command_reports_recall_memory_and_latency(self):
+        out = io.StringIO()
+        call_command('evaluate_embedding_reduction', self.chatbot.id, '--dimensions', '2', '4',
+                     '--k', '3', '--sample', '10', stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertIn('8 dims: recall@3 1.000', lines[0])
+        self.assertIn('pca     2 dims', lines[1])
+        self.assertIn('saved', lines[1])
+
+    def test_reduction_requires_dimensions(self):
+        client = APIClient()
+        client.force_authenticate(self.owner)
+        url = f'/api/chatbots/{self.chatbot.id}/'
+        response = client.patch(url, {'embedding_reduction': 'pca'}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('embedding_dimensions', response.data)
+
+        response = client.patch(url, {'embedding_reduction': 'pca', 'embedding_dimensions': 256}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['embedding_dimensions'], 256)
+
+
+class ChatDeadlineTests(RagbotTestCase):
+
+    def setUp(self):
+        cache.clear()
+        vector_index.invalidate()
+        self.addCleanup(vector_index.invalidate)
+        self.owner = self.create_owner('deadline')
+        self.chatbot = self.create_chatbot(self.owner, 'Deadline Bot')
+        document = Document.objects.create(
+            chatbot=self.chatbot, file='documents/faq.txt', file_name='faq.txt',
+            file_type='txt', file_size=1, status='completed', processed_at=timezone.now()
+        )
+        DocumentChunk.objects.bulk_create([
+            DocumentChunk(document=document, content=content, chunk_index=i, embedding=embedding)
+            for i, (content, embedding) in enumerate([
+                ('Shipping takes five business days.', [1.0, 0.0]),
+                ('Our refund policy allows returns within 30 days.', [0.0, 1.0]),
+                ('Support is available on weekdays.', [0.7, 0.7]),
+            ])
+        ])
+        self.url = f'/api/chat/{self.chatbot.id}/'
+
+        patcher = patch('services.rag_service.rag_service.embeddings_model')
+        self.embeddings = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.embeddings.embed_query.return_value = [1.0, 0.0]
+        patcher = patch('services.rag_service.rag_service.client')
+        self.llm = patcher.start()
+        self.addCleanup(patcher.stop)
+        response = MagicMock()
+        response.choices[0].message.content = 'answer'
+        response.usage.total_tokens = 30
+        response.usage.prompt_tokens, response.usage.completion_tokens = 20, 10
+        self.llm.chat.completions.create.return_value = response
+
+    def _deadline(self, seconds):
+        Chatbot.objects.filter(pk=self.chatbot.pk).update(response_deadline_seconds=seconds)
+
+    def _slow(self, seconds, result):
+        def call(*args, **kwargs):
+            time.sleep(seconds)
+            return result
+        return call
+
+    def test_unhurried_turn_takes_no_fast_path(self):
+        response = APIClient().post(self.url, {'message': 'shipping?'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['ai_response']['degraded_paths'], [])
+        self.assertEqual(response.data['context'][0]['document'], 'faq.txt')
+        self.assertEqual(self.llm.chat.completions.create.call_args.kwargs['max_tokens'], 500)
+
+    @override_settings(CHAT_EMBEDDING_TIMEOUT_SECONDS=0.05)
+    def test_slow_embedding_falls_back_to_lexical_retrieval(self):
+        self.embeddings.embed_query.side_effect = self._slow(0.5, [1.0, 0.0])
+        response = APIClient().post(self.url, {'message': 'What is the refund policy?'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['ai_response']['degraded_paths'], ['lexical_retrieval'])
+        self.assertEqual([c['content_preview'][:10] for c in response.data['context']], ['Our refund'])
+        self.assertEqual(Message.objects.get(role='assistant').degraded_paths, ['lexical_retrieval'])
+
+    def test_small_budget_uses_fewer_chunks_and_tokens(self):
+        self._deadline(5)
+        response = APIClient().post(self.url, {'message': 'shipping?'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['ai_response']['degraded_paths'], ['fewer_chunks', 'reduced_max_tokens'])
+        self.assertEqual(len(response.data['context']), 2)
+        kwargs = self.llm.chat.completions.create.call_args.kwargs
+        self.assertLessEqual(kwargs['max_tokens'], 200)
+        self.assertLessEqual(kwargs['timeout'], 5)
+
+    @override_settings(CHAT_LLM_MIN_SECONDS=0.05, CHAT_DEGRADE_BELOW_SECONDS=0)
+    def test_slow_completion_serves_cached_answer_or_times_out(self):
+        first = APIClient().post(self.url, {'message': 'Shipping time?'})
+        self.assertEqual(first.status_code, 200)
+
+        self._deadline(0.3)
+        self.llm.chat.completions.create.side_effect = self._slow(1.0, self.llm.chat.completions.create.return_value)
+        cached = APIClient().post(self.url, {'message': '  shipping   TIME? '})
+        self.assertEqual(cached.status_code, 200)
+        self.assertEqual(cached.data['ai_response']['content'], 'answer')
+        self.assertIn('cached_answer', cached.data['ai_response']['degraded_paths'])
+
+        timed_out = APIClient().post(self.url, {'message': 'Something new?'})
+        self.assertEqual(timed_out.status_code, 504)
+        self.owner.refresh_from_db()
+        self.assertEqual(self.owner.queries_this_month, 2)
+
+    @override_settings(CHAT_LLM_MIN_SECONDS=0.05, CHAT_DEGRADE_BELOW_SECONDS=0)
+    def test_slot_stays_taken_until_abandoned_completion_returns(self):
+        scheduler = FairScheduler()
+        release = threading.Event()
+        self.addCleanup(release.set)
+        response = self.llm.chat.completions.create.return_value
+        self.llm.chat.completions.create.side_effect = lambda *args, **kwargs: release.wait(5) and response
+        self._deadline(0.3)
+        with patch.object(rag_service, 'chat_scheduler', scheduler):
+            self.assertEqual(APIClient().post(self.url, {'message': 'shipping?'}).status_code, 504)
+        self.assertEqual(scheduler.stats()['in_flight'], 1)
+
+        release.set()
+        for _ in range(200):
+            if not scheduler.stats()['in_flight']:
+                break
+            time.sleep(0.01)
+        self.assertEqual(scheduler.stats()['in_flight'], 0)
+        self.assertEqual(scheduler.stats()['totals']['overruns'], 1)
+
+    def test_bounded_calls_share_a_pool_and_record_abandoned_ones(self):
+        deadline = Deadline(5)
+        self.assertTrue(deadline.call(lambda: threading.current_thread().name).startswith('deadline-call'))
+        self.assertEqual(deadline.abandoned, [])
+
+        release = threading.Event()
+        self.addCleanup(release.set)
+        with self.assertRaises(DeadlineExceeded):
+            deadline.call(lambda: release.wait(5), timeout=0.05)
+        self.assertEqual(len(deadline.abandoned), 1)
+        self.assertFalse(deadline.abandoned[0].done())
+        release.set()
+        self.assertTrue(deadline.abandoned[0].result(5))
+
+
+class RequestCoalescingTests(RagbotTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.flights = Coalescer('test')
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+        self.calls = []
+
+    def _slow_answer(self, value='answer'):
+        def compute():
+            self.calls.append(value)
+            self.release.wait(5)
+            return value
+        return compute
+
+    def _in_thread(self, func):
+        results = []
+        thread = threading.Thread(target=lambda: results.append(func()))
+        thread.start()
+        # Cleanups run last-in first-out: release the leader, then join
+        self.addCleanup(thread.join, 5)
+        self.addCleanup(self.release.set)
+        return thread, results
+
+    def _wait_for(self, condition):
+        for _ in range(200):
+            if condition():
+                return
+            time.sleep(0.01)
+        self.fail("Condition not reached")
+
+    def test_concurrent_identical_calls_run_once(self):
+        leader, leader_result = self._in_thread(lambda: self.flights.run('q', self._slow_answer()))
+        self._wait_for(lambda: self.calls)
+        followers = [self._in_thread(lambda: self.flights.run('q', self._slow_answer('other'))) for _ in range(3)]
+        self._wait_for(lambda: self.flights.stats()['followers'] == 3)
+        self.release.set()
+
+        for thread, _ in [(leader, leader_result)] + followers:
+            thread.join(5)
+        self.assertEqual(self.calls, ['answer'])
+        self.assertEqual(leader_result, [('answer', False)])
+        self.assertEqual([result for _, result in followers], [[('answer', True)]] * 3)
+        # The flight has landed: the next caller computes again
+        self.assertEqual(self.flights.run('q', lambda: 'fresh'), ('fresh', False))
+
+    def test_follower_gives_up_after_timeout(self):
+        self._in_thread(lambda: self.flights.run('q', self._slow_answer()))
+        self._wait_for(lambda: self.calls)
+        with self.assertRaises(FlightTimeout):
+            self.flights.run('q', lambda: 'never', timeout=0.05)
+        self.assertEqual(self.flights.stats()['timeouts'], 1)
+
+    @override_settings(CHAT_COALESCE_ACROSS_PROCESSES=True, CHAT_COALESCE_POLL_SECONDS=0.01)
+    def test_follows_leader_of_another_process_through_the_cache(self):
+        # Another process holds the lock and publishes its result under its token
+        cache.add('flight:test:q', 'token')
+        timer = threading.Timer(0.1, lambda: (cache.set('flight:test:q:token', 'remote'), cache.delete('flight:test:q')))
+        timer.start()
+        self.addCleanup(timer.cancel)
+
+        self.assertEqual(self.flights.run('q', lambda: 'local'), ('remote', True))
+        self.assertEqual(self.flights.stats()['remote_followers'], 1)
+        # No lock left: this process leads and releases its own lock
+        self.assertEqual(self.flights.run('q', lambda: 'local'), ('local', False))
+        self.assertIsNone(cache.get('flight:test:q'))
+
+    def test_coalesced_chat_gets_its_own_messages(self):
+        owner = self.create_owner('coalesce')
+        chatbot = Chatbot.objects.create(owner=owner, name='Launch Bot')
+        key = answer_cache.answer_key(chatbot, 'When is the launch?', vector_index.get_index(chatbot.id).signature)
+        shared = {'success': True, 'response': 'Tomorrow', 'tokens_used': 40, 'chunks_used': [], 'degraded': []}
+        self._in_thread(lambda: rag_service.answer_flights.run(key, self._slow_answer(shared)))
+        self._wait_for(lambda: self.calls)
+        threading.Timer(0.1, self.release.set).start()
+
+        with patch('services.rag_service.rag_service.client') as llm:
+            response = APIClient().post(f'/api/chat/{chatbot.id}/', {'message': 'when is the LAUNCH?'})
+        llm.chat.completions.create.assert_not_called()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['ai_response']['content'], 'Tomorrow')
+        self.assertTrue(response.data['ai_response']['coalesced'])
+        self.assertEqual(response.data['ai_response']['tokens_used'], 0)
+        self.assertEqual(
+            list(Message.objects.filter(conversation_id=response.data['conversation_id']).values_list('role', 'content')),
+            [('user', 'when is the LAUNCH?'), ('assistant', 'Tomorrow')],
+        )
+
+
+@override_settings(
+    CHAT_MAX_CONCURRENT_ANSWERS=2, CHAT_PLAN_CONCURRENCY={'free': 2, 'pro': 2}, CHAT_PLAN_WEIGHTS={'free': 1, 'pro': 3},
+    CHAT_MAX_QUEUED_PER_OWNER=3,
+)
+class FairSchedulerTests(RagbotTestCase):
+
+    def setUp(self):
+        self.scheduler = FairScheduler()
+        self.admitted = []
+
+    def _queue(self, owner_id, plan):
+        """Start a thread waiting for a slot; returns once it is queued"""
+        def run():
+            self.scheduler.acquire(owner_id, plan, timeout=5)
+            self.admitted.append(owner_id)
+        queued = self.scheduler.stats()['queued']
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        for _ in range(200):
+            if self.scheduler.stats()['queued'] > queued:
+                break
+            time.sleep(0.01)
+        return thread
+
+    def test_quiet_tenant_goes_ahead_of_a_burst(self):
+        self.scheduler.acquire(1, 'free')
+        self.scheduler.acquire(1, 'free')
+        burst = [self._queue(1, 'free') for _ in range(3)]
+        quiet = self._queue(2, 'pro')
+        self.assertEqual(self.scheduler.stats()['queued'], 4)
+
+        self.scheduler.release(1)
+        quiet.join(5)
+        self.assertEqual(self.admitted, [2])
+        # Owner 1 is back under its limit once its own requests finish
+        self.scheduler.release(2)
+        self.scheduler.release(1)
+        for thread in burst[:2]:
+            thread.join(5)
+        self.assertEqual(self.admitted, [2, 1, 1])
+        self.assertEqual(self.scheduler.stats(1)['tenants'][1]['queued'], 1)
+        # Owner 2 has nothing in flight any more and is no longer tracked
+        self.assertEqual(self.scheduler.stats(2)['tenants'], {})
+        self.scheduler.release(1)
+        burst[2].join(5)
+        self.assertEqual(self.scheduler.stats(1)['tenants'][1]['admitted'], 5)
+        self.assertEqual(self.scheduler.stats()['totals']['admitted'], 6)
+
+    def test_owner_limit_holds_with_free_capacity(self):
+        with override_settings(CHAT_PLAN_CONCURRENCY={'free': 1}):
+            self.scheduler.acquire(1, 'free')
+            started = time.monotonic()
+            with self.assertRaises(QueueTimeout):
+                self.scheduler.acquire(1, 'free', timeout=0.05)
+            self.assertLess(time.monotonic() - started, 1)
+            # Another owner still gets the spare slot at once
+            self.scheduler.acquire(2, 'free', timeout=0)
+        stats = self.scheduler.stats()
+        self.assertEqual((stats['in_flight'], stats['queued']), (2, 0))
+        self.assertEqual(stats['tenants'][1]['timeouts'], 1)
+
+    def test_full_queue_rejects_without_waiting(self):
+        self.scheduler.acquire(1, 'free')
+        self.scheduler.acquire(1, 'free')
+        for _ in range(3):
+            self._queue(1, 'free')
+        started = time.monotonic()
+        with self.assertRaises(QueueTimeout):
+            self.scheduler.acquire(1, 'free', timeout=5)
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(self.scheduler.stats(1)['tenants'][1]['rejected'], 1)
+        for _ in range(5):
+            self.scheduler.release(1)
+
+    def test_slot_held_until_abandoned_call_finishes(self):
+        abandoned = Future()
+        abandoned.set_running_or_notify_cancel()
+        pending = []
+        with override_settings(CHAT_PLAN_CONCURRENCY={'free': 1}):
+            with self.scheduler.slot(1, 'free', pending=pending):
+                pending.append(abandoned)
+            self.assertEqual(self.scheduler.stats()['in_flight'], 1)
+            with self.assertRaises(QueueTimeout):
+                self.scheduler.acquire(1, 'free', timeout=0)
+
+            abandoned.set_result(None)
+            self.assertEqual(self.scheduler.stats()['in_flight'], 0)
+            self.scheduler.acquire(1, 'free', timeout=0)
+        self.assertEqual(self.scheduler.stats()['totals']['overruns'], 1)
+
+    def test_idle_owners_are_forgotten(self):
+        for owner_id in range(100):
+            with self.scheduler.slot(owner_id, 'free'):
+                pass
+        with override_settings(CHAT_PLAN_CONCURRENCY={'free': 1}):
+            self.scheduler.acquire(100, 'free')
+            with self.assertRaises(QueueTimeout):
+                self.scheduler.acquire(100, 'free', timeout=0)
+            self.scheduler.release(100)
+        stats = self.scheduler.stats()
+        self.assertEqual(stats['tenants'], {})
+        self.assertEqual(stats['totals'], {'admitted': 101, 'timeouts': 1, 'rejected': 0, 'overruns': 0})
+
+    def test_chat_returns_429_when_owner_has_no_slot(self):
+        owner = self.create_owner('tenant')
+        chatbot = Chatbot.objects.create(owner=owner, name='Busy Bot')
+        with patch.object(rag_service, 'chat_scheduler', self.scheduler), \
+                override_settings(CHAT_QUEUE_TIMEOUT_SECONDS=0.05):
+            self.scheduler.acquire(owner.id, 'free')
+            self.scheduler.acquire(owner.id, 'free')
+            response = APIClient().post(f'/api/chat/{chatbot.id}/', {'message': 'hello'})
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response['Retry-After'], '1')
+            owner.refresh_from_db()
+            self.assertEqual(owner.queries_this_month, 0)
+
+            client = APIClient()
+            client.force_authenticate(owner)
+            metrics = client.get('/api/chatbots/chat_queue/').data
+        self.assertEqual(metrics['in_flight'], 2)
+        self.assertEqual(metrics['tenants'][owner.id]['timeouts'], 1)
+        self.assertEqual(metrics['tenants'][owner.id]['plan'], 'free')
@@ -1,17 +1,37 @@
+import tempfile
+
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.parsers import MultiPartParser
+from django.db import transaction
+from django.http import FileResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from ragbot_backend.conditional import InvalidateOnWriteMixin, conditional_response
+from ragbot_backend.db_router import mark_conversation_written, read_conversation_from_primary_if_recent
+from ragbot_backend.pagination import KeysetPagination
 from .models import Chatbot, Conversation, Message
+from documents.models import Document
+from services import exports, reaper, snapshots
+from services.batch_qa import answer_questions, to_ndjson
+from services.embedding_scheduler import BACKFILL
+from services.ingestion import ingest_documents
+from services.rag_service import rag_service
+from services.usage_limits import consume_query_quota, refund_query_quota, seconds_until_next_period
 from .serializers import (
+    BatchQuestionSerializer,
     ChatbotSerializer, 
     ChatbotCreateSerializer,
     ConversationSerializer,
-    MessageSerializer
+    ConversationListSerializer,
+    MessageSerializer,
+    chunk_previews,
+    wants_embeddings,
+    wants_previews,
 )
 
-class ChatbotViewSet(viewsets.ModelViewSet):
+class ChatbotViewSet(InvalidateOnWriteMixin, viewsets.ModelViewSet):
 
     permission_classes = [IsAuthenticated]
     
@@ -21,7 +41,33 @@ class ChatbotViewSet(viewsets.ModelViewSet):
         return ChatbotSerializer
     
     def get_queryset(self):
-        return Chatbot.objects.filter(owner=self.request.user)
+        return (
+            Chatbot.objects.filter(owner=self.request.user)
+            .select_related('owner')
+            .with_counts()
+        )
+    
+    def watermark_sources(self, **lookup):
+        """Rows behind the listing: chatbots plus the documents and conversations they count"""
+        chatbots = Chatbot.objects.filter(owner=self.request.user, **lookup)
+        return [
+            (chatbots, 'updated_at'),
+            (Document.objects.filter(chatbot__in=chatbots.values('id')), 'updated_at'),
+            (Conversation.objects.filter(chatbot__in=chatbots.values('id')), 'id'),
+        ]
+    
+    def list(self, request, *args, **kwargs):
+        return conditional_response(
+            request, self.watermark_sources(), lambda: super(ChatbotViewSet, self).list(request, *args, **kwargs).data
+        )
+    
+    def retrieve(self, request, *args, **kwargs):
+        if not str(kwargs['pk']).isdigit():
+            return super().retrieve(request, *args, **kwargs)
+        return conditional_response(
+            request, self.watermark_sources(pk=kwargs['pk']),
+            lambda: super(ChatbotViewSet, self).retrieve(request, *args, **kwargs).data
+        )
     
     def create(self, request, *args, **kwargs):
 
@@ -42,6 +88,11 @@ class ChatbotViewSet(viewsets.ModelViewSet):
             status=status.HTTP_201_CREATED
         )
     
+    def perform_destroy(self, instance):
+        # Hidden with its documents and conversations at once; the reaper deletes the rows in batches
+        Chatbot.objects.filter(pk=instance.pk).soft_delete()
+        reaper.schedule_reap()
+    
     @action(detail=True, methods=['post'])
     def toggle_active(self, request, pk=None):
         """Toggle chatbot active status"""
@@ -54,12 +105,22 @@ class ChatbotViewSet(viewsets.ModelViewSet):
             'is_active': chatbot.is_active
         })
     
+    @action(detail=False, methods=['get'])
+    def chat_queue(self, request):
+        """Answer slots and queue waits of this worker process; staff see every owner"""
+        owner_id = None if request.user.is_staff else request.user.pk
+        return Response(rag_service.chat_scheduler.stats(owner_id))
+    
     @action(detail=True, methods=['get'])
     def conversations(self, request, pk=None):
         """Get all conversations for a chatbot"""
         chatbot = self.get_object()
-        conversations = chatbot.conversations.all()
-        serializer = ConversationSerializer(conversations, many=True)
+        conversations = chatbot.conversations.select_related('chatbot').with_message_count()
+        page = self.paginate_queryset(conversations)
+        if page is not None:
+            serializer = ConversationListSerializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
+        serializer = ConversationListSerializer(conversations, many=True)
         return Response(serializer.data)
     
     @action(detail=True, methods=['get'])
@@ -68,21 +129,196 @@ class ChatbotViewSet(viewsets.ModelViewSet):
         from documents.serializers import DocumentSerializer
         chatbot = self.get_object()
         documents = chatbot.documents.all()
+        page = self.paginate_queryset(documents)
+        if page is not None:
+            serializer = DocumentSerializer(page, many=True, context={'request': request})
+            return self.get_paginated_response(serializer.data)
         serializer = DocumentSerializer(documents, many=True, context={'request': request})
         return Response(serializer.data)
+    
+    @action(detail=True, methods=['get'])
+    def export_chunks(self, request, pk=None):
+        """Stream every chunk of the chatbot as NDJSON; ?embeddings=true includes vectors"""
+        chatbot = self.get_object()
+        response = StreamingHttpResponse(
+            exports.chunks_ndjson(exports.chatbot_chunks(chatbot), include_embeddings=wants_embeddings(request)),
+            content_type='application/x-ndjson'
+        )
+        response['Content-Disposition'] = f'attachment; filename="chatbot-{chatbot.id}-chunks.ndjson"'
+        return response
+    
+    @action(detail=True, methods=['get'])
+    def export_conversations(self, request, pk=None):
+        """Stream every conversation of the chatbot as NDJSON, each followed by its messages"""
+        chatbot = self.get_object()
+        response = StreamingHttpResponse(
+            exports.conversations_ndjson(Conversation.objects.filter(chatbot=chatbot)),
+            content_type='application/x-ndjson'
+        )
+        response['Content-Disposition'] = f'attachment; filename="chatbot-{chatbot.id}-conversations.ndjson"'
+        return response
 
 
-class ConversationViewSet(viewsets.ModelViewSet):
+    @action(detail=True, methods=['get'])
+    def export(self, request, pk=None):
+        """Download the chatbot's knowledge base as a snapshot archive"""
+        chatbot = self.get_object()
+        include_files = request.query_params.get('include_files', 'true').lower() != 'false'
+        archive = tempfile.TemporaryFile()
+        snapshots.export_snapshot(chatbot, archive, include_files=include_files)
+        archive.seek(0)
+        return FileResponse(
+            archive,
+            as_attachment=True,
+            filename=snapshots.snapshot_filename(chatbot),
+            content_type='application/zip'
+        )
+    
+    @action(detail=True, methods=['post'], parser_classes=[MultiPartParser])
+    def import_snapshot(self, request, pk=None):
+        """Add the documents and embeddings of a snapshot archive to this chatbot"""
+        chatbot = self.get_object()
+        upload = request.FILES.get('snapshot')
+        if not upload:
+            return Response({'error': 'snapshot file required'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        try:
+            manifest = snapshots.read_manifest(upload)
+            incoming = len(manifest['documents'])
+            if chatbot.document_count + incoming > request.user.max_documents_per_chatbot:
+                return Response({
+                    'error': f'Document limit reached. Maximum {request.user.max_documents_per_chatbot} documents per chatbot.'
+                }, status=status.HTTP_403_FORBIDDEN)
+            result = snapshots.import_snapshot(chatbot, upload)
+        except snapshots.SnapshotError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        # Documents exported before they were processed are embedded behind new uploads
+        pending = result.pop('pending_document_ids')
+        if pending:
+            transaction.on_commit(lambda: ingest_documents(pending, priority=BACKFILL))
+        result['queued'] = len(pending)
+        return Response(result, status=status.HTTP_201_CREATED)
+    
+    @action(detail=True, methods=['post'])
+    def clone(self, request, pk=None):
+        """Duplicate the chatbot, its configuration and knowledge base, without re-embedding"""
+        source = self.get_object()
+        user = request.user
+        
+        if not user.can_create_chatbot:
+            return Response({
+                'error': f'Chatbot limit reached. Maximum {user.max_chatbots} chatbots allowed.'
+            }, status=status.HTTP_403_FORBIDDEN)
+        
+        name = request.data.get('name') or f'{source.name} (copy)'
+        with transaction.atomic():
+            clone = Chatbot.objects.create(
+                owner=user,
+                name=name[:200],
+                description=source.description,
+                system_prompt=source.system_prompt,
+                temperature=source.temperature,
+                max_tokens=source.max_tokens,
+                chunk_size=source.chunk_size,
+                chunk_overlap=source.chunk_overlap,
+                mmr_enabled=source.mmr_enabled,
+                mmr_lambda=source.mmr_lambda,
+                duplicate_threshold=source.duplicate_threshold,
+                embedding_reduction=source.embedding_reduction,
+                embedding_dimensions=source.embedding_dimensions,
+                response_deadline_seconds=source.response_deadline_seconds,
+                message_retention_days=source.message_retention_days,
+                is_active=source.is_active
+            )
+            result = snapshots.clone_knowledge_base(source, clone)
+        
+        return Response({
+            'chatbot': ChatbotSerializer(clone).data,
+            'copied': result
+        }, status=status.HTTP_201_CREATED)
+
+
+    @action(detail=True, methods=['post'])
+    def batch_qa(self, request, pk=None):
+        """
+        Answer many questions in one request, streamed back as NDJSON.
+
+        Each question counts against the monthly quota; questions that were
+        not answered (failures, aborted streams) are refunded at the end.
+        """
+        chatbot = self.get_object()
+        serializer = BatchQuestionSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        questions = serializer.validated_data['questions']
+        
+        if not consume_query_quota(chatbot.owner_id, len(questions)):
+            response = Response({
+                'error': 'Monthly query limit does not cover this batch.'
+            }, status=status.HTTP_429_TOO_MANY_REQUESTS)
+            response['Retry-After'] = str(seconds_until_next_period())
+            return response
+        
+        items = answer_questions(
+            chatbot,
+            questions,
+            filters=serializer.validated_data.get('filter'),
+            top_k=serializer.validated_data['top_k']
+        )
+        
+        def stream():
+            answered = 0
+            try:
+                for item in items:
+                    if item['type'] == 'result' and item['success']:
+                        answered += 1
+                    yield item
+            except Exception as e:
+                yield {'type': 'error', 'error': str(e)}
+            finally:
+                items.close()
+                if answered < len(questions):
+                    refund_query_quota(chatbot.owner_id, len(questions) - answered)
+        
+        return StreamingHttpResponse(to_ndjson(stream()), content_type='application/x-ndjson')
+
+
+class ConversationViewSet(InvalidateOnWriteMixin, viewsets.ModelViewSet):
     """
     ViewSet for Conversation operations
     """
     permission_classes = [IsAuthenticated]
-    serializer_class = ConversationSerializer
+    
+    def get_serializer_class(self):
+        if self.action == 'list':
+            return ConversationListSerializer
+        return ConversationSerializer
     
     def get_queryset(self):
         """Return conversations for user's chatbots"""
-        user_chatbots = Chatbot.objects.filter(owner=self.request.user)
-        return Conversation.objects.filter(chatbot__in=user_chatbots)
+        if self.kwargs.get('pk'):
+            read_conversation_from_primary_if_recent(self.kwargs['pk'])
+        queryset = (
+            Conversation.objects.filter(chatbot__owner=self.request.user)
+            .select_related('chatbot')
+            .with_message_count()
+        )
+        if self.action in ('retrieve', 'update', 'partial_update'):
+            queryset = queryset.prefetch_related('messages')
+        return queryset
+    
+    def retrieve(self, request, *args, **kwargs):
+        """Conversation with its messages; ?previews=true resolves context chunk previews"""
+        conversation = self.get_object()
+        context = self.get_serializer_context()
+        if wants_previews(request):
+            context['previews'] = chunk_previews(conversation.messages.all())
+        return Response(ConversationSerializer(conversation, context=context).data)
+    
+    def perform_destroy(self, instance):
+        # Hidden at once; messages are deleted in batches in the background
+        Conversation.objects.filter(pk=instance.pk).soft_delete()
+        reaper.schedule_reap()
     
     @action(detail=True, methods=['post'])
     def add_message(self, request, pk=None):
@@ -92,8 +328,19 @@ class ConversationViewSet(viewsets.ModelViewSet):
         serializer = MessageSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         message = serializer.save(conversation=conversation)
+        mark_conversation_written(conversation.id)
         
         return Response(
             MessageSerializer(message).data,
             status=status.HTTP_201_CREATED
         )
+    
+    @action(detail=True, methods=['get'])
+    def messages(self, request, pk=None):
+        """Get conversation messages, keyset-paginated on created_at"""
+        conversation = self.get_object()
+        paginator = KeysetPagination('created_at', start_from_end=True)
+        messages = paginator.paginate_queryset(conversation.messages.all(), request)
+        context = {'previews': chunk_previews(messages)} if wants_previews(request) else {}
+        serializer = MessageSerializer(messages, many=True, context=context)
+        return paginator.get_paginated_response(serializer.data)
@@ -7,6 +7,7 @@ class DocumentAdmin(admin.ModelAdmin):
     list_filter = ['status', 'file_type', 'uploaded_at']
     search_fields = ['file_name', 'chatbot__name']
     readonly_fields = ['uploaded_at', 'processed_at', 'file_size', 'chunk_count']
+    list_select_related = ['chatbot__owner']
     
     fieldsets = (
         ('File Info', {
@@ -23,6 +24,7 @@ class DocumentChunkAdmin(admin.ModelAdmin):
     list_filter = ['created_at']
     search_fields = ['content', 'document__file_name']
     readonly_fields = ['created_at']
+    list_select_related = ['document__chatbot']
     
     def content_preview(self, obj):
         return obj.content[:50] + "..." if len(obj.content) > 50 else obj.content
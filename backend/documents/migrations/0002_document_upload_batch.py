@@ -0,0 +1,18 @@
+# Generated by Django 5.0 on 2026-10-19 18:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='upload_batch',
+            field=models.UUIDField(blank=True, db_index=True, help_text='Bulk upload this document arrived in, for progress reporting', null=True),
+        ),
+    ]
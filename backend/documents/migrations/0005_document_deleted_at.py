@@ -0,0 +1,23 @@
+# Generated by Django 5.0 on 2026-10-19 19:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbots', '0009_conversation_deleted_at'),
+        ('documents', '0004_document_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, editable=False, help_text='Set when deleted; the row, its chunks and its file are removed later by the reaper', null=True),
+        ),
+        migrations.AddIndex(
+            model_name='document',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', False)), fields=['deleted_at'], name='documents_deleted_idx'),
+        ),
+    ]
@@ -1,12 +1,23 @@
 from django.db import models
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector
+from django.db.models import Q
 from django.core.validators import FileExtensionValidator
-from chatbots.models import Chatbot
+from django.utils import timezone
+from chatbots.models import Chatbot, SoftDeleteManager
 import os
 
 def document_upload_path(instance, filename):
 
     return f'documents/chatbot_{instance.chatbot.id}/{filename}'
 
+class DocumentQuerySet(models.QuerySet):
+
+    def soft_delete(self):
+        """Hide the documents from listings and retrieval at once; ``services.reaper`` deletes them later"""
+        return self.update(deleted_at=timezone.now())
+
+
 class Document(models.Model):
 
     FILE_TYPE_CHOICES = [
@@ -68,9 +79,33 @@ class Document(models.Model):
         help_text="Error message if processing failed"
     )
     
+    content_hash = models.CharField(
+        max_length=64,
+        blank=True,
+        db_index=True,
+        help_text="SHA-256 of the uploaded file, for reusing chunks of identical files"
+    )
+    
+    upload_batch = models.UUIDField(
+        null=True,
+        blank=True,
+        db_index=True,
+        help_text="Bulk upload this document arrived in, for progress reporting"
+    )
+    
     # Timestamps
     uploaded_at = models.DateTimeField(auto_now_add=True)
     processed_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    deleted_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        editable=False,
+        help_text="Set when deleted; the row, its chunks and its file are removed later by the reaper"
+    )
+
+    objects = SoftDeleteManager.from_queryset(DocumentQuerySet)()
+    all_objects = DocumentQuerySet.as_manager()
     
     class Meta:
         db_table = 'documents'
@@ -80,6 +115,7 @@ class Document(models.Model):
         indexes = [
             models.Index(fields=['chatbot', '-uploaded_at']),
             models.Index(fields=['status']),
+            models.Index(fields=['deleted_at'], condition=Q(deleted_at__isnull=False), name='documents_deleted_idx'),
         ]
     
     def __str__(self):
@@ -96,15 +132,23 @@ class Document(models.Model):
         if self.file and not self.file_type:
             ext = os.path.splitext(self.file_name)[1].lower().replace('.', '')
             self.file_type = ext
+
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            # Processing saves a copy loaded before any soft delete; it must not clear deleted_at
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'deleted_at'
+            ]
             
         super().save(*args, **kwargs)
     
     def delete(self, *args, **kwargs):
-        """Delete file from storage when document is deleted"""
-        if self.file:
-            if os.path.isfile(self.file.path):
-                os.remove(self.file.path)
-        super().delete(*args, **kwargs)
+        """Soft-delete; ``services.reaper`` removes the chunks, the row and the file in the background"""
+        from services import reaper
+        deleted = Document.objects.filter(pk=self.pk).soft_delete()
+        self.deleted_at = timezone.now()
+        reaper.schedule_reap()
+        return deleted, {self._meta.label: deleted}
 
 
 class DocumentChunk(models.Model):
@@ -144,6 +188,8 @@ class DocumentChunk(models.Model):
         ordering = ['document', 'chunk_index']
         indexes = [
             models.Index(fields=['document', 'chunk_index']),
+            # Lexical retrieval when there is no time for a query embedding
+            GinIndex(SearchVector('content', config='english'), name='document_chunks_content_fts'),
         ]
     
     def __str__(self):
@@ -1,5 +1,17 @@
+import os
+import uuid
+import zipfile
+
+from django.core.files import File
+from django.db import transaction
 from rest_framework import serializers
+
+from chatbots.models import Chatbot
 from .models import Document, DocumentChunk
+from .upload_handlers import HashingReader
+
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024  # 10MB per document
+ALLOWED_FILE_TYPES = [choice for choice, _ in Document.FILE_TYPE_CHOICES]
 
 class DocumentSerializer(serializers.ModelSerializer):
     file_url = serializers.SerializerMethodField()
@@ -8,11 +20,11 @@ class DocumentSerializer(serializers.ModelSerializer):
         model = Document
         fields = [
             'id', 'chatbot', 'file', 'file_url', 'file_name',
-            'file_type', 'file_size', 'status', 'chunk_count',
+            'file_type', 'file_size', 'content_hash', 'status', 'chunk_count',
             'error_message', 'uploaded_at', 'processed_at'
         ]
         read_only_fields = [
-            'id', 'file_name', 'file_type', 'file_size',
+            'id', 'file_name', 'file_type', 'file_size', 'content_hash',
             'status', 'chunk_count', 'error_message',
             'uploaded_at', 'processed_at'
         ]
@@ -26,8 +38,7 @@ class DocumentSerializer(serializers.ModelSerializer):
     
     def validate_file(self, value):
         # Check file size (max 10MB)
-        max_size = 10 * 1024 * 1024  # 10MB
-        if value.size > max_size:
+        if value.size > MAX_UPLOAD_SIZE:
             raise serializers.ValidationError("File size must be less than 10MB")
         return value
 
@@ -52,6 +63,120 @@ class DocumentUploadSerializer(serializers.ModelSerializer):
             )
         
         return data
+    
+    def create(self, validated_data):
+        # Computed by the upload handlers while the file streamed in
+        validated_data['content_hash'] = getattr(validated_data['file'], 'sha256', '')
+        return super().create(validated_data)
+
+
+class DocumentBulkUploadSerializer(serializers.Serializer):
+    """
+    Upload several files and/or a ZIP archive to one chatbot.
+
+    Limits are checked once for the whole batch. Archive members are read
+    from the ZIP central directory during validation and decompressed one at
+    a time straight into storage on save.
+    """
+    chatbot = serializers.PrimaryKeyRelatedField(queryset=Chatbot.objects.all())
+    files = serializers.ListField(child=serializers.FileField(), required=False)
+    archive = serializers.FileField(required=False)
+
+    def validate_files(self, value):
+        for upload in value:
+            if _file_type(upload.name) not in ALLOWED_FILE_TYPES:
+                raise serializers.ValidationError(f"Unsupported file type: {upload.name}")
+            if upload.size > MAX_UPLOAD_SIZE:
+                raise serializers.ValidationError(f"{upload.name}: file size must be less than 10MB")
+        return value
+
+    def validate_archive(self, value):
+        if not zipfile.is_zipfile(value):
+            raise serializers.ValidationError("Archive must be a ZIP file")
+        value.seek(0)
+        return value
+
+    def validate(self, data):
+        chatbot = data['chatbot']
+        user = self.context['request'].user
+
+        if chatbot.owner != user:
+            raise serializers.ValidationError("You don't have permission to upload to this chatbot")
+
+        members = []
+        skipped = []
+        if data.get('archive'):
+            with zipfile.ZipFile(data['archive']) as archive:
+                for info in archive.infolist():
+                    name = os.path.basename(info.filename)
+                    if info.is_dir() or not name or name.startswith('.') or '__MACOSX' in info.filename:
+                        continue
+                    if _file_type(name) not in ALLOWED_FILE_TYPES:
+                        skipped.append(info.filename)
+                        continue
+                    if info.file_size > MAX_UPLOAD_SIZE:
+                        raise serializers.ValidationError(f"{info.filename}: file size must be less than 10MB")
+                    members.append(info)
+            data['archive'].seek(0)
+
+        incoming = len(data.get('files', [])) + len(members)
+        if not incoming:
+            raise serializers.ValidationError("No supported files to upload")
+
+        # One count for the whole batch instead of one per file
+        remaining = user.max_documents_per_chatbot - chatbot.documents.count()
+        if incoming > remaining:
+            raise serializers.ValidationError(
+                f"Document limit reached. Maximum {user.max_documents_per_chatbot} documents per chatbot, "
+                f"{max(remaining, 0)} remaining but {incoming} uploaded."
+            )
+
+        data['archive_members'] = members
+        data['skipped'] = skipped
+        return data
+
+    def create(self, validated_data):
+        chatbot = validated_data['chatbot']
+        batch = uuid.uuid4()
+        documents = []
+
+        def add(name, content, size):
+            document = Document(
+                chatbot=chatbot,
+                file_name=name,
+                file_type=_file_type(name),
+                file_size=size,
+                upload_batch=batch,
+            )
+            document.file.save(name, content, save=False)
+            document.content_hash = getattr(content, 'sha256', '')
+            documents.append(document)
+
+        try:
+            for upload in validated_data.get('files', []):
+                add(os.path.basename(upload.name), upload, upload.size)
+
+            if validated_data['archive_members']:
+                with zipfile.ZipFile(validated_data['archive']) as archive:
+                    for info in validated_data['archive_members']:
+                        with archive.open(info) as member:
+                            # Hash members as they are decompressed into storage
+                            reader = HashingReader(member)
+                            content = File(reader, name=info.filename)
+                            content.size = info.file_size
+                            add(os.path.basename(info.filename), content, info.file_size)
+                            documents[-1].content_hash = reader.hexdigest()
+
+            with transaction.atomic():
+                return Document.objects.bulk_create(documents)
+        except Exception:
+            for document in documents:
+                document.file.delete(save=False)
+            raise
+
+
+def _file_type(name):
+    return os.path.splitext(name)[1].lower().lstrip('.')
 
 
 class DocumentChunkSerializer(serializers.ModelSerializer):
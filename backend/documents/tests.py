@@ -1,3 +1,579 @@
-from django.test import TestCase
+import hashlib
+import io
+import os
+import random
+import threading
+import time
+import zipfile
+from unittest.mock import MagicMock, patch
 
-# Create your tests here.
+import httpx
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from openai import RateLimitError
+
+from chatbots.models import Chatbot, Conversation, Message
+from documents.models import Document, DocumentChunk
+from ragbot_backend.testing import RagbotTestCase
+from services import embedding_scheduler, reaper, text_cache, text_splitter, vector_index
+from services.rag_service import rag_service
+from services.text_splitter import TokenTextSplitter
+
+User = get_user_model()
+
+
+class DocumentChunkPaginationTests(RagbotTestCase):
+
+    def setUp(self):
+        self.user = self.create_owner()
+        self.client.force_authenticate(self.user)
+        chatbot = self.create_chatbot(self.user, 'Docs Bot')
+        self.document = Document.objects.create(
+            chatbot=chatbot, file='documents/a.txt', file_name='a.txt',
+            file_type='txt', file_size=10, status='completed'
+        )
+        DocumentChunk.objects.bulk_create([
+            DocumentChunk(document=self.document, content=f'chunk {i}', chunk_index=i)
+            for i in range(12)
+        ])
+
+    def test_chunks_walk_forward(self):
+        url = f'/api/documents/{self.document.id}/chunks/'
+        page = self.client.get(url, {'limit': 5}).data
+        seen = [c['chunk_index'] for c in page['results']]
+        while page['has_after']:
+            page = self.client.get(url, {'limit': 5, 'after': page['after']}).data
+            seen.extend(c['chunk_index'] for c in page['results'])
+        self.assertEqual(seen, list(range(12)))
+
+
+class BulkUploadTests(RagbotTestCase):
+
+    def setUp(self):
+        self.use_temp_media()
+        self.user = self.create_owner(max_documents_per_chatbot=5)
+        self.client.force_authenticate(self.user)
+        self.chatbot = self.create_chatbot(self.user, 'Bulk Bot')
+
+        patcher = patch('documents.views.ingest_documents')
+        self.ingest = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _archive(self, names):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for name in names:
+                archive.writestr(name, f'contents of {name}')
+        return SimpleUploadedFile('bundle.zip', buffer.getvalue(), content_type='application/zip')
+
+    def test_files_and_archive_in_one_batch(self):
+        response = self.client.post('/api/documents/bulk_upload/', {
+            'chatbot': self.chatbot.id,
+            'files': [
+                SimpleUploadedFile('a.txt', b'alpha'),
+                SimpleUploadedFile('b.md', b'# beta'),
+            ],
+            'archive': self._archive(['docs/c.txt', 'docs/d.md', 'docs/image.png', '__MACOSX/._c.txt']),
+        }, format='multipart')
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(len(response.data['documents']), 4)
+        self.assertEqual(response.data['skipped'], ['docs/image.png'])
+        self.assertEqual(response.data['progress']['pending'], 4)
+
+        documents = Document.objects.filter(upload_batch=response.data['batch'])
+        self.assertEqual(sorted(d.file_name for d in documents), ['a.txt', 'b.md', 'c.txt', 'd.md'])
+        c_txt = documents.get(file_name='c.txt')
+        self.assertEqual(c_txt.file_size, len(b'contents of docs/c.txt'))
+        with c_txt.file.open('rb') as stored:
+            self.assertEqual(stored.read(), b'contents of docs/c.txt')
+        self.ingest.assert_called_once()
+        self.assertEqual(sorted(self.ingest.call_args[0][0]), sorted(d.id for d in documents))
+
+        progress = self.client.get('/api/documents/upload_progress/', {'batch': response.data['batch']})
+        self.assertEqual(progress.data['total'], 4)
+        self.assertFalse(progress.data['done'])
+
+    def test_limit_checked_for_whole_batch(self):
+        response = self.client.post('/api/documents/bulk_upload/', {
+            'chatbot': self.chatbot.id,
+            'archive': self._archive([f'doc_{i}.txt' for i in range(6)]),
+        }, format='multipart')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Document.objects.exists())
+        self.ingest.assert_not_called()
+
+
+class _CharEncoding:
+    """One token per character, so tests don't need tiktoken's encoding files"""
+
+    def encode(self, text, disallowed_special=()):
+        return [ord(c) for c in text]
+
+    def decode(self, ids):
+        return ''.join(map(chr, ids))
+
+
+class TokenTextSplitterTests(TestCase):
+
+    def setUp(self):
+        patcher = patch.object(text_splitter, 'get_encoding', return_value=_CharEncoding())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        text_splitter.clear_token_cache()
+        self.addCleanup(text_splitter.clear_token_cache)
+
+    def test_chunks_respect_budget_and_overlap(self):
+        text = ' '.join(f'word{i:03d}' for i in range(200))
+        chunks = TokenTextSplitter(chunk_size=60, chunk_overlap=16).split_text(text)
+
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(len(chunk) <= 60 for chunk in chunks))
+        for previous, current in zip(chunks, chunks[1:]):
+            # Each ' wordNNN' is 8 tokens, so the 16-token overlap is two words
+            self.assertEqual(current.split()[:2], previous.split()[-2:])
+        words = [word for chunk in chunks for word in chunk.split()]
+        self.assertEqual(list(dict.fromkeys(words)), text.split())
+
+    def test_prefers_paragraph_boundaries(self):
+        first = 'alpha beta gamma delta epsilon.'
+        second = 'zeta eta theta iota kappa lambda mu nu.'
+        chunks = TokenTextSplitter(chunk_size=60, chunk_overlap=0).split_text(f'{first}\n\n{second}')
+        self.assertEqual(chunks, [first, second])
+
+    def test_streamed_blocks_match_single_pass(self):
+        text = '\n\n'.join(
+            '\n'.join(' '.join(f'w{p}{l}{i}' for i in range(9)) for l in range(3)) for p in range(12)
+        )
+        splitter = TokenTextSplitter(chunk_size=50, chunk_overlap=10)
+        blocks = [text[i:i + 37] for i in range(0, len(text), 37)]
+        self.assertEqual(list(splitter.iter_chunks(blocks)), splitter.split_text(text))
+
+    def test_random_text_streams_identically_within_budget(self):
+        rng = random.Random(31)
+        pieces = ['a', 'beta', 'tab', ' ', '  ', '\n', '\n\n', '\t', '\r\n', 'y' * 30]
+        for _ in range(300):
+            text = ''.join(rng.choice(pieces) for _ in range(rng.randint(0, 80)))
+            chunk_size = rng.randint(4, 40)
+            splitter = TokenTextSplitter(chunk_size=chunk_size, chunk_overlap=rng.randint(0, chunk_size - 1))
+            cuts = sorted(rng.sample(range(len(text) + 1), min(len(text) + 1, rng.randint(0, 8))))
+            blocks = [text[i:j] for i, j in zip([0, *cuts], [*cuts, len(text)])]
+
+            chunks = splitter.split_text(text)
+            self.assertEqual(list(splitter.iter_chunks(blocks)), chunks, repr(text))
+            for chunk in chunks:
+                self.assertTrue(0 < len(chunk) <= chunk_size, repr(chunk))
+                self.assertIn(chunk, text)
+
+    def test_separators_count_against_budget(self):
+        chunks = TokenTextSplitter(chunk_size=16, chunk_overlap=0).split_text('beta  a\r\n\n\ttab \nx')
+        self.assertEqual(chunks, ['beta  a\r\n\n\ttab', 'x'])
+
+    def test_oversized_word_is_sliced(self):
+        chunks = TokenTextSplitter(chunk_size=20, chunk_overlap=4).split_text('start ' + 'x' * 70 + ' end')
+        self.assertTrue(all(len(chunk) <= 20 for chunk in chunks))
+        self.assertEqual(''.join(chunks).count('x'), 70)
+        self.assertEqual(chunks[-1].split()[-1], 'end')
+
+
+class ContentHashReuseTests(RagbotTestCase):
+
+    def setUp(self):
+        self.use_temp_media(EXTRACTED_TEXT_CACHE_DIR=self.make_temp_dir())
+
+        patcher = patch.object(text_splitter, 'get_encoding', return_value=_CharEncoding())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        text_splitter.clear_token_cache()
+        self.addCleanup(text_splitter.clear_token_cache)
+
+        patcher = patch.object(rag_service, 'embeddings_model')
+        self.embeddings = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.embeddings.embed_documents.side_effect = lambda texts: [[float(len(text)), 1.0] for text in texts]
+
+        self.user = self.create_owner()
+        self.client.force_authenticate(self.user)
+        self.text = ' '.join(f'word{i:03d}' for i in range(60)).encode()
+
+    def _embedded_texts(self):
+        return sum(len(call.args[0]) for call in self.embeddings.embed_documents.call_args_list)
+
+    def _upload(self, chatbot, name='notes.txt'):
+        response = self.client.post('/api/documents/', {
+            'chatbot': chatbot.id, 'file': SimpleUploadedFile(name, self.text),
+        }, format='multipart')
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(response.data['processing']['success'])
+        return Document.objects.get(id=response.data['document']['id']), response.data['processing']
+
+    def test_upload_records_sha256(self):
+        chatbot = Chatbot.objects.create(owner=self.user, name='Hash Bot')
+        document, _ = self._upload(chatbot)
+        self.assertEqual(document.content_hash, hashlib.sha256(self.text).hexdigest())
+
+    def test_identical_file_reuses_chunks_without_embedding(self):
+        first_bot = Chatbot.objects.create(owner=self.user, name='First Bot', chunk_size=64, chunk_overlap=8)
+        second_bot = Chatbot.objects.create(owner=self.user, name='Second Bot', chunk_size=64, chunk_overlap=8)
+        original, _ = self._upload(first_bot)
+        embedded = self._embedded_texts()
+
+        copy, processing = self._upload(second_bot, name='renamed.txt')
+
+        self.assertEqual(processing['reused_from'], original.id)
+        self.assertEqual(self._embedded_texts(), embedded)
+        self.assertEqual(copy.chunk_count, original.chunk_count)
+        self.assertEqual(
+            list(copy.chunks.values_list('content', 'embedding')),
+            list(original.chunks.values_list('content', 'embedding')),
+        )
+
+    def test_different_chunking_reuses_extracted_text(self):
+        first_bot = Chatbot.objects.create(owner=self.user, name='First Bot', chunk_size=64, chunk_overlap=8)
+        second_bot = Chatbot.objects.create(owner=self.user, name='Second Bot', chunk_size=32, chunk_overlap=0)
+        self._upload(first_bot)
+
+        with patch.object(rag_service, 'iter_text_from_file') as extract:
+            document, processing = self._upload(second_bot)
+
+        extract.assert_not_called()
+        self.assertNotIn('reused_from', processing)
+        self.assertGreater(document.chunk_count, 0)
+        self.assertTrue(all(len(chunk) <= 32 for chunk in document.chunks.values_list('content', flat=True)))
+
+    def test_reprocess_embeds_again_from_cached_text(self):
+        chatbot = Chatbot.objects.create(owner=self.user, name='Hash Bot')
+        document, _ = self._upload(chatbot)
+        embedded = self._embedded_texts()
+
+        with patch.object(rag_service, 'iter_text_from_file') as extract:
+            response = self.client.post(f'/api/documents/{document.id}/reprocess/')
+
+        extract.assert_not_called()
+        self.assertTrue(response.data['success'])
+        self.assertEqual(self._embedded_texts(), embedded + document.chunk_count)
+
+    def test_reprocess_embeds_at_backfill_priority(self):
+        chatbot = Chatbot.objects.create(owner=self.user, name='Hash Bot')
+        document, _ = self._upload(chatbot)
+        with patch.object(rag_service.embedding_scheduler, 'embed', wraps=rag_service.embedding_scheduler.embed) as embed:
+            self.client.post(f'/api/documents/{document.id}/reprocess/')
+        self.assertEqual(embed.call_args.kwargs['priority'], embedding_scheduler.BACKFILL)
+
+    def test_least_recently_used_text_is_evicted(self):
+        hashes = [hashlib.sha256(str(i).encode()).hexdigest() for i in range(3)]
+        for age, content_hash in zip([30, 20, 10], hashes):
+            list(text_cache.caching(content_hash, [os.urandom(2000).hex()]))
+            path = text_cache._cache_path(content_hash)
+            os.utime(path, (time.time() - age, time.time() - age))
+        entry_size = text_cache._cache_path(hashes[0]).stat().st_size
+        # Reading the oldest entry makes it the most recently used
+        list(text_cache.cached_blocks(hashes[0]))
+
+        removed = text_cache.evict(text_cache._cache_path(hashes[0]).parent.parent, 2 * entry_size + 100)
+
+        self.assertEqual(removed, 1)
+        self.assertIsNone(text_cache.cached_blocks(hashes[1]))
+        self.assertIsNotNone(text_cache.cached_blocks(hashes[0]))
+        self.assertIsNotNone(text_cache.cached_blocks(hashes[2]))
+
+
+class SoftDeleteReaperTests(RagbotTestCase):
+
+    def setUp(self):
+        self.media_root = self.use_temp_media(REAP_IN_BACKGROUND=False)
+
+        self.user = self.create_owner()
+        self.client.force_authenticate(self.user)
+        self.chatbot = self.create_chatbot(self.user, 'Reaper Bot')
+        self.document = self._document('guide.txt')
+
+    def _document(self, name, chunks=12):
+        document = Document(chatbot=self.chatbot, file_type='txt', status='completed', chunk_count=chunks)
+        document.file.save(name, ContentFile(b'some text'), save=False)
+        document.save()
+        DocumentChunk.objects.bulk_create([
+            DocumentChunk(document=document, content=f'chunk {i}', chunk_index=i, embedding=[1.0, float(i)])
+            for i in range(chunks)
+        ])
+        return document
+
+    def test_deleted_document_hidden_at_once(self):
+        other = self._document('other.txt', chunks=2)
+        response = self.client.delete(f'/api/documents/{self.document.id}/')
+        self.assertEqual(response.status_code, 204)
+
+        listed = [entry['id'] for entry in self.client.get('/api/documents/').data['results']]
+        self.assertEqual(listed, [other.id])
+        self.assertEqual(self.client.get(f'/api/documents/{self.document.id}/').status_code, 404)
+        index = vector_index.build_index(self.chatbot.id)
+        self.assertEqual(set(index.chunk_ids.tolist()), set(other.chunks.values_list('id', flat=True)))
+
+        # Nothing is removed until the reaper runs
+        self.assertEqual(DocumentChunk.objects.filter(document_id=self.document.id).count(), 12)
+        self.assertTrue(os.path.exists(self.document.file.path))
+
+    def test_stale_instance_does_not_undelete(self):
+        processing = Document.objects.get(id=self.document.id)
+        Document.objects.filter(id=self.document.id).soft_delete()
+        processing.status = 'failed'
+        processing.save()
+        self.assertFalse(Document.objects.filter(id=self.document.id).exists())
+        self.assertEqual(Document.all_objects.get(id=self.document.id).status, 'failed')
+
+    def test_reaper_deletes_in_batches_and_removes_file(self):
+        path = self.document.file.path
+        Document.objects.filter(id=self.document.id).soft_delete()
+
+        with CaptureQueriesContext(connection) as queries:
+            summary = reaper.reap(batch_size=5)
+        table = DocumentChunk._meta.db_table
+        chunk_deletes = [q for q in queries if q['sql'].startswith(f'DELETE FROM "{table}" WHERE "{table}"."id" IN')]
+        self.assertEqual(len(chunk_deletes), 3)
+        self.assertEqual((summary['documents'], summary['chunks'], summary['files']), (1, 12, 1))
+        self.assertFalse(Document.all_objects.filter(id=self.document.id).exists())
+        self.assertFalse(os.path.exists(path))
+
+    def test_shared_file_kept(self):
+        clone = Document.objects.create(
+            chatbot=self.chatbot, file=self.document.file.name, file_name='guide.txt',
+            file_type='txt', file_size=9, status='completed'
+        )
+        Document.objects.filter(id=clone.id).soft_delete()
+        self.assertEqual(reaper.reap()['files'], 0)
+        self.assertTrue(os.path.exists(self.document.file.path))
+
+    def test_conversation_deleted_then_reaped(self):
+        conversation = Conversation.objects.create(chatbot=self.chatbot, title='Old')
+        Message.objects.bulk_create([
+            Message(conversation=conversation, role='user', content=f'm{i}') for i in range(7)
+        ])
+        response = self.client.delete(f'/api/chat/conversation/{conversation.id}/delete/')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.client.get(f'/api/chat/conversation/{conversation.id}/').status_code, 404)
+        self.assertIsNone(Conversation.objects.touch_with_history(conversation.id, self.chatbot.id))
+
+        summary = reaper.reap(batch_size=3)
+        self.assertEqual((summary['conversations'], summary['messages']), (1, 7))
+        self.assertFalse(Conversation.all_objects.filter(id=conversation.id).exists())
+
+    def test_document_delete_is_soft(self):
+        path = self.document.file.path
+        self.document.delete()
+        self.assertFalse(Document.objects.filter(id=self.document.id).exists())
+        self.assertEqual(DocumentChunk.objects.filter(document_id=self.document.id).count(), 12)
+        self.assertTrue(os.path.exists(path))
+
+        self.assertEqual(reaper.reap()['files'], 1)
+        self.assertFalse(os.path.exists(path))
+
+    def test_chatbot_deleted_then_reaped(self):
+        path = self.document.file.path
+        conversation = Conversation.objects.create(chatbot=self.chatbot, title='Old')
+        Message.objects.bulk_create([
+            Message(conversation=conversation, role='user', content=f'm{i}') for i in range(7)
+        ])
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.delete(f'/api/chatbots/{self.chatbot.id}/')
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse([q for q in queries if q['sql'].startswith('DELETE')])
+        self.assertEqual(self.client.get(f'/api/chatbots/{self.chatbot.id}/').status_code, 404)
+        self.assertEqual(self.client.post(f'/api/chat/{self.chatbot.id}/', {'message': 'hi'}).status_code, 404)
+        self.assertFalse(Document.objects.filter(chatbot_id=self.chatbot.id).exists())
+        self.assertFalse(Conversation.objects.filter(chatbot_id=self.chatbot.id).exists())
+        self.assertEqual(self.user.chatbot_count, 0)
+
+        summary = reaper.reap(batch_size=5)
+        self.assertEqual(
+            (summary['chatbots'], summary['documents'], summary['chunks'], summary['files'], summary['messages']),
+            (1, 1, 12, 1, 7)
+        )
+        self.assertFalse(Chatbot.all_objects.filter(id=self.chatbot.id).exists())
+        self.assertFalse(os.path.exists(path))
+
+    def test_chatbot_kept_until_processing_document_is_reaped(self):
+        Document.objects.filter(id=self.document.id).update(status='processing')
+        Chatbot.objects.filter(id=self.chatbot.id).soft_delete()
+        self.assertEqual(reaper.reap()['chatbots'], 0)
+        self.assertTrue(Chatbot.all_objects.filter(id=self.chatbot.id).exists())
+
+    def test_orphaned_files_removed_after_grace(self):
+        directory = os.path.join(self.media_root, 'documents', f'chatbot_{self.chatbot.id}')
+        old, young = os.path.join(directory, 'old.txt'), os.path.join(directory, 'young.txt')
+        for path in (old, young):
+            with open(path, 'w') as handle:
+                handle.write('left behind')
+        two_hours_ago = time.time() - 7200
+        os.utime(old, (two_hours_ago, two_hours_ago))
+        os.utime(self.document.file.path, (two_hours_ago, two_hours_ago))
+
+        removed = reaper.remove_orphaned_files(grace_seconds=3600)
+        self.assertEqual(removed, [f'documents/chatbot_{self.chatbot.id}/old.txt'])
+        self.assertTrue(os.path.exists(young))
+        self.assertTrue(os.path.exists(self.document.file.path))
+
+    @override_settings(REAP_IN_BACKGROUND=True)
+    def test_deletes_schedule_one_background_run(self):
+        other = self._document('other.txt', chunks=1)
+        self.addCleanup(reaper._pending.clear)
+        with patch.object(reaper, '_executor') as executor:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.delete(f'/api/documents/{self.document.id}/')
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.delete(f'/api/documents/{other.id}/')
+        executor.submit.assert_called_once_with(reaper._run)
+
+
+@override_settings(
+    EMBEDDING_BATCH_SIZE=4, EMBEDDING_BATCH_MAX_TOKENS=1000, EMBEDDING_MAX_IN_FLIGHT=1,
+    EMBEDDING_REQUESTS_PER_MINUTE=0, EMBEDDING_TOKENS_PER_MINUTE=0, EMBEDDING_AGING_SECONDS=60,
+)
+class EmbeddingSchedulerTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        patcher = patch.object(text_splitter, 'get_encoding', return_value=_CharEncoding())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        text_splitter.clear_token_cache()
+        self.addCleanup(text_splitter.clear_token_cache)
+
+        self.batches = []
+        self.release = threading.Event()
+
+        def embed_batch(texts):
+            self.batches.append(list(texts))
+            if len(self.batches) == 1:
+                # Hold the first batch so later submissions queue up behind it
+                self.release.wait(5)
+            return [[float(len(text))] for text in texts]
+
+        self.scheduler = embedding_scheduler.EmbeddingScheduler(embed_batch)
+        self.addCleanup(self.release.set)
+
+    def _blocked(self):
+        first = self.scheduler.submit(['warm-up'])
+        for _ in range(100):
+            if self.batches:
+                break
+            time.sleep(0.01)
+        return first
+
+    def test_chunks_of_concurrent_documents_share_batches(self):
+        first = self._blocked()
+        a = self.scheduler.submit(['a1', 'a2'], priority=embedding_scheduler.BULK)
+        b = self.scheduler.submit(['b1', 'b2', 'b3'], priority=embedding_scheduler.BULK)
+        self.assertEqual(self.scheduler.stats()['queued_texts'], 5)
+        time.sleep(0.05)
+        self.release.set()
+
+        self.assertEqual(a.result(5), [[2.0], [2.0]])
+        self.assertEqual(b.result(5), [[2.0]] * 3)
+        self.assertEqual(first.result(5), [[7.0]])
+        self.assertEqual(self.batches[1:], [['a1', 'a2', 'b1', 'b2'], ['b3']])
+        stats = self.scheduler.stats()
+        self.assertEqual((stats['queued_jobs'], stats['batches'], stats['texts']), (0, 3, 6))
+        self.assertGreaterEqual(stats['max_wait_seconds'], 0.05)
+
+    def test_interactive_and_small_documents_first(self):
+        self._blocked()
+        backfill = self.scheduler.submit(['x'], priority=embedding_scheduler.BACKFILL)
+        large = self.scheduler.submit(['long text ' * 5] * 2, priority=embedding_scheduler.BULK)
+        small = self.scheduler.submit(['tiny'], priority=embedding_scheduler.BULK)
+        interactive = self.scheduler.submit(['question'], priority=embedding_scheduler.INTERACTIVE)
+        self.assertEqual(self.scheduler.stats()['queued_by_priority'], {'interactive': 1, 'bulk': 2, 'backfill': 1})
+        self.release.set()
+
+        for future in (backfill, large, small, interactive):
+            future.result(5)
+        self.assertEqual(self.batches[1], ['question', 'tiny', 'long text ' * 5, 'long text ' * 5])
+        self.assertEqual(self.batches[2], ['x'])
+
+    @override_settings(EMBEDDING_REQUESTS_PER_MINUTE=60, EMBEDDING_TOKENS_PER_MINUTE=120)
+    def test_token_budget_delays_batches(self):
+        clock = [1000.0]
+
+        def sleep(seconds):
+            clock[0] += seconds
+
+        with patch('services.usage_limits.time.time', side_effect=lambda: clock[0]), \
+                patch('services.embedding_scheduler.time.sleep', side_effect=sleep) as sleeper:
+            self.assertEqual(self.scheduler._wait_for_budget(100), 0)
+            self.assertEqual(self.scheduler._wait_for_budget(60), 20)
+        # 20 tokens were left and 40 more refill at 2 tokens per second
+        sleeper.assert_called_once_with(20.0)
+
+    def test_rate_limited_batch_retried_after_pause(self):
+        responses = [
+            RateLimitError('slow down', response=httpx.Response(
+                429, headers={'retry-after': '0'}, request=httpx.Request('POST', 'https://api.openai.com/v1/embeddings')
+            ), body=None),
+            [[1.0], [2.0]],
+        ]
+
+        def embed_batch(texts):
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        scheduler = embedding_scheduler.EmbeddingScheduler(embed_batch)
+        self.assertEqual(scheduler.embed(['p', 'q']), [[1.0], [2.0]])
+        self.assertEqual(scheduler.stats()['rate_limited'], 1)
+
+    @override_settings(EMBEDDING_BATCH_SIZE=1, EMBEDDING_MAX_IN_FLIGHT=2)
+    def test_rate_limit_pauses_every_dispatcher(self):
+        lock = threading.Lock()
+        starts, limited_at = [], []
+
+        def embed_batch(texts):
+            with lock:
+                starts.append(time.monotonic())
+                first = len(starts) == 1
+            if first:
+                limited_at.append(time.monotonic())
+                raise RateLimitError('slow down', response=httpx.Response(
+                    429, headers={'retry-after': '0.3'},
+                    request=httpx.Request('POST', 'https://api.openai.com/v1/embeddings')
+                ), body=None)
+            time.sleep(0.05)
+            return [[1.0]]
+
+        scheduler = embedding_scheduler.EmbeddingScheduler(embed_batch)
+        futures = [scheduler.submit([text]) for text in 'pqr']
+        for future in futures:
+            self.assertEqual(future.result(5), [[1.0]])
+        # Whichever dispatcher sends next, the retry and 'r' at least, waits out the pause
+        later = [start for start in starts if start > limited_at[0]]
+        self.assertGreaterEqual(len(later), 2)
+        self.assertGreaterEqual(min(later) - limited_at[0], 0.28)
+        self.assertGreaterEqual(scheduler.stats()['budget_wait_seconds'], 0.25)
+
+    def test_failed_batch_fails_its_documents(self):
+        scheduler = embedding_scheduler.EmbeddingScheduler(MagicMock(side_effect=ValueError('bad input')))
+        with self.assertRaisesMessage(ValueError, 'bad input'):
+            scheduler.embed(['p'])
+        self.assertEqual(scheduler.stats()['failed_batches'], 1)
+
+    def test_errors_outside_the_api_call_fail_the_batch_not_the_dispatcher(self):
+        scheduler = embedding_scheduler.EmbeddingScheduler(lambda texts: [[1.0]] * len(texts))
+        with patch.object(scheduler, '_wait_for_budget', side_effect=[RuntimeError('cache down'), 0.0, 0.0]):
+            with self.assertRaisesMessage(RuntimeError, 'cache down'):
+                scheduler.embed(['p'], timeout=5)
+            self.assertEqual(scheduler.embed(['q'], timeout=5), [[1.0]])
+
+        short = embedding_scheduler.EmbeddingScheduler(lambda texts: [[1.0]])
+        with self.assertRaisesMessage(ValueError, 'returned 1 vectors for 2 texts'):
+            short.embed(['p', 'q'], timeout=5)
+
+    def test_embed_gives_up_after_timeout(self):
+        self._blocked()
+        with self.assertRaises(TimeoutError):
+            self.scheduler.embed(['waiting'], timeout=0.05)
+        self.assertEqual(self.scheduler.stats()['queued_jobs'], 0)
@@ -0,0 +1,61 @@
+"""
+Upload handlers that hash files while they stream in.
+
+The SHA-256 of every uploaded file is computed chunk by chunk as Django
+receives it and exposed as ``uploaded_file.sha256``, so documents can be
+deduplicated without reading the file back from disk.
+"""
+
+import hashlib
+
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+
+
+class HashingUploadMixin:
+
+    def new_file(self, *args, **kwargs):
+        # Set before super(): the memory handler raises StopFutureHandlers from new_file
+        self.sha256 = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        self.sha256.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        uploaded = super().file_complete(file_size)
+        if uploaded is not None:
+            uploaded.sha256 = self.sha256.hexdigest()
+        return uploaded
+
+
+class HashingMemoryFileUploadHandler(HashingUploadMixin, MemoryFileUploadHandler):
+    pass
+
+
+class HashingTemporaryFileUploadHandler(HashingUploadMixin, TemporaryFileUploadHandler):
+    pass
+
+
+class HashingReader:
+    """File-like wrapper hashing whatever is read through it (e.g. ZIP members)"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.sha256.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+
+def file_sha256(fileobj, block_size=1024 * 1024):
+    """Hash a stored file, for documents uploaded before hashes were recorded"""
+    digest = hashlib.sha256()
+    for block in iter(lambda: fileobj.read(block_size), b''):
+        digest.update(block)
+    return digest.hexdigest()
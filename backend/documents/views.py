@@ -7,23 +7,39 @@ from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.parsers import MultiPartParser, FormParser
+from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.http import StreamingHttpResponse
 from django.utils import timezone
 
 from .models import Document, DocumentChunk
-from .serializers import DocumentSerializer, DocumentUploadSerializer, DocumentChunkSerializer
+from .serializers import (
+    DocumentSerializer,
+    DocumentUploadSerializer,
+    DocumentBulkUploadSerializer,
+    DocumentChunkSerializer,
+)
 from chatbots.models import Chatbot
+from chatbots.serializers import wants_embeddings
+from ragbot_backend.conditional import InvalidateOnWriteMixin, conditional_response
+from ragbot_backend.pagination import KeysetPagination
 
 # Import RAG service
+from services import exports, reaper, vector_index
+from services.embedding_scheduler import BACKFILL
 from services.rag_service import rag_service
+from services.ingestion import batch_progress, ingest_documents
 
 
-class DocumentViewSet(viewsets.ModelViewSet):
+class DocumentViewSet(InvalidateOnWriteMixin, viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
     parser_classes = [MultiPartParser, FormParser]
 
     def get_serializer_class(self):
         if self.action == 'create':
             return DocumentUploadSerializer
+        if self.action == 'bulk_upload':
+            return DocumentBulkUploadSerializer
         return DocumentSerializer
 
     def get_queryset(self):
@@ -31,6 +47,21 @@ class DocumentViewSet(viewsets.ModelViewSet):
         user_chatbots = Chatbot.objects.filter(owner=self.request.user)
         return Document.objects.filter(chatbot__in=user_chatbots)
 
+    def list(self, request, *args, **kwargs):
+        # Status polling: unchanged documents answer 304 without serializing
+        return conditional_response(
+            request, [(self.get_queryset(), 'updated_at')],
+            lambda: super(DocumentViewSet, self).list(request, *args, **kwargs).data
+        )
+
+    def retrieve(self, request, *args, **kwargs):
+        if not str(kwargs['pk']).isdigit():
+            return super().retrieve(request, *args, **kwargs)
+        return conditional_response(
+            request, [(self.get_queryset().filter(pk=kwargs['pk']), 'updated_at')],
+            lambda: super(DocumentViewSet, self).retrieve(request, *args, **kwargs).data
+        )
+
     def create(self, request, *args, **kwargs):
         """
         Upload document and automatically process it with RAG
@@ -65,26 +96,79 @@ class DocumentViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_201_CREATED
             )
 
+    @action(detail=False, methods=['post'])
+    def bulk_upload(self, request):
+        """
+        Upload multiple files and/or a ZIP archive in one request.
+
+        Documents are created in one batch and processed in parallel in the
+        background; poll upload_progress with the returned batch id.
+        """
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        documents = serializer.save()
+        batch = documents[0].upload_batch
+
+        ingest_documents([document.id for document in documents])
+
+        return Response(
+            {
+                'batch': batch,
+                'documents': DocumentSerializer(documents, many=True, context={'request': request}).data,
+                'skipped': serializer.validated_data['skipped'],
+                'progress': batch_progress(self.get_queryset().filter(upload_batch=batch)),
+            },
+            status=status.HTTP_202_ACCEPTED
+        )
+
+    @action(detail=False, methods=['get'])
+    def upload_progress(self, request):
+        """Aggregate processing progress of a bulk upload batch"""
+        batch = request.query_params.get('batch')
+        if not batch:
+            return Response({'error': 'batch parameter required'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            documents = self.get_queryset().filter(upload_batch=batch)
+            progress = batch_progress(documents)
+        except DjangoValidationError:
+            return Response({'error': 'Invalid batch id'}, status=status.HTTP_400_BAD_REQUEST)
+        if not progress['total']:
+            return Response({'error': 'Batch not found'}, status=status.HTTP_404_NOT_FOUND)
+        return Response({'batch': batch, **progress, 'embedding_queue': rag_service.embedding_scheduler.stats()})
+
     @action(detail=True, methods=['post'])
     def reprocess(self, request, pk=None):
         """Manually reprocess a document"""
         document = self.get_object()
 
-        # Delete existing chunks
-        DocumentChunk.objects.filter(document=document).delete()
+        # Delete existing chunks in short batches rather than one long DELETE
+        reaper.delete_in_batches(DocumentChunk.objects.filter(document=document), settings.REAP_BATCH_SIZE)
 
-        # Reprocess
-        result = rag_service.process_document(document.id)
+        # Reprocess with fresh embeddings; extracted text still comes from the cache.
+        # New uploads go first, so they aren't held up by a re-embedding
+        result = rag_service.process_document(document.id, reuse_chunks=False, priority=BACKFILL)
 
         return Response(result)
 
     @action(detail=True, methods=['get'])
     def chunks(self, request, pk=None):
-        """Get all chunks for a document"""
+        """Get chunks for a document, keyset-paginated on chunk_index"""
         document = self.get_object()
-        chunks = document.chunks.all()
+        paginator = KeysetPagination('chunk_index')
+        chunks = paginator.paginate_queryset(document.chunks.all(), request)
         serializer = DocumentChunkSerializer(chunks, many=True)
-        return Response(serializer.data)
+        return paginator.get_paginated_response(serializer.data)
+
+    @action(detail=True, methods=['get'])
+    def export_chunks(self, request, pk=None):
+        """Stream all chunks of a document as NDJSON; ?embeddings=true includes vectors"""
+        document = self.get_object()
+        response = StreamingHttpResponse(
+            exports.chunks_ndjson(document.chunks.all(), include_embeddings=wants_embeddings(request)),
+            content_type='application/x-ndjson'
+        )
+        response['Content-Disposition'] = f'attachment; filename="document-{document.id}-chunks.ndjson"'
+        return response
 
     def destroy(self, request, *args, **kwargs):
         """Delete document and all its chunks"""
@@ -93,4 +177,9 @@ class DocumentViewSet(viewsets.ModelViewSet):
         return Response(
             {'message': 'Document and all associated chunks deleted'},
             status=status.HTTP_204_NO_CONTENT
-        )
\ No newline at end of file
+        )
+
+    def perform_destroy(self, instance):
+        # Hidden from listings and retrieval at once; chunks and the file go in the background
+        instance.delete()
+        vector_index.refresh(instance.chatbot_id)
@@ -0,0 +1,127 @@
+"""
+Negotiated response compression.
+
+Responses of at least ``RESPONSE_COMPRESSION_MIN_SIZE`` bytes are compressed
+with brotli or gzip, whichever the client prefers by ``Accept-Encoding``
+q-value (brotli on a tie). Smaller bodies are not worth the CPU. Brotli is
+only offered when the ``brotli`` package is installed.
+
+Streaming responses are compressed chunk by chunk and flushed after each
+chunk, so NDJSON streams still reach the client line by line.
+"""
+
+import gzip
+import io
+
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+# Already-compressed payloads only get bigger
+INCOMPRESSIBLE_PREFIXES = ('image/', 'video/', 'audio/')
+INCOMPRESSIBLE_TYPES = {
+    'application/gzip', 'application/zip', 'application/pdf',
+    'application/x-7z-compressed', 'application/octet-stream',
+}
+
+
+def available_encodings():
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def negotiate_encoding(accept_encoding: str):
+    """The supported coding the client accepts with the highest q-value, or None"""
+    weights = {}
+    for part in accept_encoding.split(','):
+        coding, _, params = part.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[coding] = q
+
+    best, best_q = None, 0.0
+    for coding in available_encodings():
+        q = weights.get(coding, weights.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def compress(content: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(content, quality=settings.RESPONSE_COMPRESSION_BROTLI_QUALITY)
+    return gzip.compress(content, compresslevel=settings.RESPONSE_COMPRESSION_GZIP_LEVEL, mtime=0)
+
+
+def compress_stream(chunks, encoding: str):
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=settings.RESPONSE_COMPRESSION_BROTLI_QUALITY)
+        for chunk in chunks:
+            data = compressor.process(chunk) + compressor.flush()
+            if data:
+                yield data
+        yield compressor.finish()
+        return
+
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=settings.RESPONSE_COMPRESSION_GZIP_LEVEL, mtime=0) as target:
+        for chunk in chunks:
+            target.write(chunk)
+            target.flush()
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _compressible(response) -> bool:
+    if response.has_header('Content-Encoding') or response.status_code in (204, 304):
+        return False
+    content_type = response.get('Content-Type', '').split(';')[0].strip().lower()
+    return not (content_type.startswith(INCOMPRESSIBLE_PREFIXES) or content_type in INCOMPRESSIBLE_TYPES)
+
+
+class CompressionMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if not _compressible(response):
+            return response
+        if not response.streaming and len(response.content) < settings.RESPONSE_COMPRESSION_MIN_SIZE:
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encoding = negotiate_encoding(request.headers.get('Accept-Encoding', ''))
+        if encoding is None:
+            return response
+
+        if response.streaming:
+            response.streaming_content = compress_stream(response.streaming_content, encoding)
+            del response['Content-Length']
+        else:
+            compressed = compress(response.content, encoding)
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response.headers['Content-Length'] = str(len(compressed))
+
+        # The representation changed, so a strong validator no longer applies
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response.headers['ETag'] = 'W/' + etag
+        response.headers['Content-Encoding'] = encoding
+        return response
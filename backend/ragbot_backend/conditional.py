@@ -0,0 +1,106 @@
+"""
+Conditional GET and short-lived response caching for polled endpoints.
+
+Validators are derived from cheap watermarks (row counts plus the latest
+``updated_at`` or id of the rows behind a response), all read in one query,
+never from the serialized payload. A matching ``If-None-Match`` returns 304
+before anything is serialized. There is no ``Last-Modified``: deletes only
+change a count, so a date alone would validate stale representations.
+
+Serialized bodies are also cached for ``RESPONSE_CACHE_SECONDS`` under their
+ETag. The ETag includes a per-user generation that every write through the
+API bumps, so a write invalidates that user's cached responses at once.
+"""
+
+import hashlib
+from typing import Callable, Iterable, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, router
+from django.db.models import Count, Max, QuerySet, Value
+from django.utils.http import quote_etag
+from rest_framework import status
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.response import Response
+
+
+def watermark(*sources: Tuple[QuerySet, str]) -> tuple:
+    """
+    ``COUNT(*)`` and ``MAX(field)`` of each ``(queryset, field)`` source.
+
+    Every aggregate is a scalar subquery of a single SELECT, so the whole
+    watermark costs one round-trip however many sources there are.
+    """
+    parts, params = [], []
+    for queryset, field in sources:
+        # Grouping on a constant aggregates the whole filtered set
+        base = queryset.order_by().annotate(_all=Value(1)).values('_all')
+        for aggregate in (Count('pk'), Max(field)):
+            sql, part_params = base.annotate(value=aggregate).values('value').query.sql_with_params()
+            parts.append(f'({sql})')
+            params.extend(part_params)
+    using = router.db_for_read(sources[0][0].model)
+    with connections[using].cursor() as cursor:
+        cursor.execute('SELECT ' + ', '.join(parts), params)
+        return cursor.fetchone()
+
+
+def _generation_key(user_id) -> str:
+    return f'response-generation:{user_id}'
+
+
+def user_generation(user_id) -> int:
+    return cache.get_or_set(_generation_key(user_id), 0, None)
+
+
+def invalidate_user_responses(user_id) -> None:
+    """Make every cached response and ETag of ``user_id`` stale"""
+    key = _generation_key(user_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, None)
+
+
+def _not_modified(request, etag: str) -> bool:
+    if_none_match = request.headers.get('If-None-Match')
+    if not if_none_match:
+        return False
+    candidates = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+    return etag in candidates or '*' in candidates
+
+
+def conditional_response(request, sources: Iterable[Tuple[QuerySet, str]], build: Callable[[], dict]) -> Response:
+    """
+    Serve a GET from its watermark: 304, a cached body, or ``build()``.
+
+    ``build`` is only called when neither the client nor the response cache
+    holds the current representation.
+    """
+    mark = watermark(*sources)
+    user_id = request.user.pk if request.user.is_authenticated else None
+    digest = hashlib.sha256(
+        repr((user_id, user_generation(user_id), request.get_full_path(), mark)).encode()
+    ).hexdigest()[:32]
+    etag = quote_etag(digest)
+    headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+
+    if _not_modified(request, etag):
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    cache_key = f'response:{digest}'
+    data = cache.get(cache_key)
+    if data is None:
+        data = build()
+        cache.set(cache_key, data, settings.RESPONSE_CACHE_SECONDS)
+    return Response(data, headers=headers)
+
+
+class InvalidateOnWriteMixin:
+    """Bump the user's response generation after any unsafe request to the view"""
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        if request.method not in SAFE_METHODS and request.user.is_authenticated:
+            invalidate_user_responses(request.user.pk)
+        return super().finalize_response(request, response, *args, **kwargs)
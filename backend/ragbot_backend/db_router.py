@@ -0,0 +1,90 @@
+"""
+Read-replica routing with read-your-writes stickiness.
+
+With ``DATABASE_READ_REPLICA`` set, reads of chatbot, conversation and
+document data (retrieval, history, listings) go to that database alias and
+everything else, including all writes, goes to ``default``.
+
+Two kinds of stickiness keep replica lag invisible to the writer:
+
+* Within a request (or background thread), the first write to those apps
+  pins every later read to the primary. ``ReplicaPinMiddleware`` clears the
+  pin at the start of each request.
+* Across requests, writing to a conversation marks it in the cache for
+  ``DATABASE_REPLICA_STICKY_SECONDS``; views reading that conversation call
+  ``read_conversation_from_primary_if_recent`` first.
+"""
+
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+
+REPLICA_APPS = {'chatbots', 'documents'}
+
+_pinned = ContextVar('db_pinned_to_primary', default=False)
+
+
+def replica_alias():
+    return getattr(settings, 'DATABASE_READ_REPLICA', None)
+
+
+def pin_to_primary():
+    """Send the remaining reads of this request or thread to the primary"""
+    _pinned.set(True)
+
+
+def pinned_to_primary():
+    return _pinned.get()
+
+
+def _conversation_key(conversation_id):
+    return f'db-sticky:conversation:{conversation_id}'
+
+
+def mark_conversation_written(conversation_id):
+    if replica_alias():
+        cache.set(_conversation_key(conversation_id), 1, settings.DATABASE_REPLICA_STICKY_SECONDS)
+
+
+def read_conversation_from_primary_if_recent(conversation_id):
+    """Pin to the primary if ``conversation_id`` was written within the sticky window"""
+    if replica_alias() and cache.get(_conversation_key(conversation_id)):
+        pin_to_primary()
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        replica = replica_alias()
+        if replica and not _pinned.get() and model._meta.app_label in REPLICA_APPS:
+            return replica
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        # Only writes to replicated data matter; e.g. the chat quota update must
+        # not pull the retrieval reads after it back to the primary
+        if model._meta.app_label in REPLICA_APPS:
+            _pinned.set(True)
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica mirrors the primary, so objects from either may be related
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == 'default'
+
+
+class ReplicaPinMiddleware:
+    """Start every request unpinned, whatever the worker thread did before"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = _pinned.set(False)
+        try:
+            return self.get_response(request)
+        finally:
+            _pinned.reset(token)
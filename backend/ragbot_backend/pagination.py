@@ -0,0 +1,129 @@
+"""
+Keyset (cursor) pagination for append-mostly tables.
+
+Pages are addressed by the ``(sort_field, id)`` pair of their first or last
+row instead of an OFFSET, so fetching page N costs the same as page 1 and
+walks the existing ``(parent, sort_field)`` composite indexes.
+"""
+
+import base64
+import json
+
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.response import Response
+
+
+class KeysetPagination:
+    """
+    Paginate a queryset on ``(sort_field, id)`` with ``before``/``after`` cursors.
+
+    Query parameters:
+        after  - rows strictly after the cursor, oldest first
+        before - rows strictly before the cursor, returned oldest first
+        limit  - page size, clamped to ``max_page_size``
+
+    Without a cursor the first page is returned, or the last one when
+    ``start_from_end`` is set (e.g. the most recent chat messages).
+    """
+    page_size = 50
+    max_page_size = 200
+    invalid_cursor_message = 'Invalid cursor'
+
+    def __init__(self, sort_field, start_from_end=False, page_size=None):
+        self.sort_field = sort_field
+        self.start_from_end = start_from_end
+        if page_size:
+            self.page_size = page_size
+
+    def paginate_queryset(self, queryset, request):
+        self.limit = self._get_limit(request)
+        self.field = queryset.model._meta.get_field(self.sort_field)
+        before = request.query_params.get('before')
+        after = request.query_params.get('after')
+        self.before_given = bool(before)
+        self.after_given = bool(after)
+
+        if after:
+            value, pk = self._decode_cursor(after)
+            rows = self._fetch(queryset.filter(self._after_q(value, pk)), descending=False)
+            self.has_after = len(rows) > self.limit
+            self.has_before = True
+            self.page = rows[:self.limit]
+            self.request_cursor = after
+        elif before or self.start_from_end:
+            if before:
+                value, pk = self._decode_cursor(before)
+                queryset = queryset.filter(self._before_q(value, pk))
+            rows = self._fetch(queryset, descending=True)
+            self.has_before = len(rows) > self.limit
+            self.has_after = bool(before)
+            self.page = list(reversed(rows[:self.limit]))
+            self.request_cursor = before
+        else:
+            rows = self._fetch(queryset, descending=False)
+            self.has_after = len(rows) > self.limit
+            self.has_before = False
+            self.page = rows[:self.limit]
+            self.request_cursor = None
+
+        return self.page
+
+    def get_paginated_data(self, data):
+        if self.page:
+            before_cursor = self._encode_cursor(self.page[0])
+            after_cursor = self._encode_cursor(self.page[-1])
+        else:
+            # Keep handing back the caller's cursor so polling can continue
+            before_cursor = after_cursor = self.request_cursor
+        return {
+            'results': data,
+            'before': before_cursor,
+            'after': after_cursor,
+            'has_before': self.has_before,
+            'has_after': self.has_after,
+        }
+
+    def get_paginated_response(self, data):
+        return Response(self.get_paginated_data(data))
+
+    def _get_limit(self, request):
+        try:
+            limit = int(request.query_params.get('limit', self.page_size))
+        except (TypeError, ValueError):
+            return self.page_size
+        return max(1, min(limit, self.max_page_size))
+
+    def _fetch(self, queryset, descending):
+        prefix = '-' if descending else ''
+        ordered = queryset.order_by(f'{prefix}{self.sort_field}', f'{prefix}id')
+        return list(ordered[:self.limit + 1])
+
+    def _after_q(self, value, pk):
+        # The redundant ">=" bound lets the planner range-scan the composite index
+        field = self.sort_field
+        return Q(**{f'{field}__gte': value}) & (
+            Q(**{f'{field}__gt': value}) | Q(**{field: value, 'id__gt': pk})
+        )
+
+    def _before_q(self, value, pk):
+        field = self.sort_field
+        return Q(**{f'{field}__lte': value}) & (
+            Q(**{f'{field}__lt': value}) | Q(**{field: value, 'id__lt': pk})
+        )
+
+    def _encode_cursor(self, obj):
+        value = getattr(obj, self.sort_field)
+        if hasattr(value, 'isoformat'):
+            value = value.isoformat()
+        raw = json.dumps([value, obj.id], separators=(',', ':')).encode()
+        return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+    def _decode_cursor(self, cursor):
+        try:
+            padded = cursor + '=' * (-len(cursor) % 4)
+            value, pk = json.loads(base64.urlsafe_b64decode(padded.encode()))
+            return self.field.to_python(value), int(pk)
+        except (ValueError, TypeError, DjangoValidationError):
+            raise NotFound(self.invalid_cursor_message)
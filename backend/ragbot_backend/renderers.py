@@ -0,0 +1,87 @@
+"""
+orjson-based JSON renderer and parser for the API.
+
+Drop-in replacements for DRF's ``JSONRenderer`` and ``JSONParser`` with the
+same output for the values the views return: aware datetimes end in ``Z``,
+Decimals follow ``COERCE_DECIMAL_TO_STRING`` like the serializers' decimal
+fields, and lazy strings, timedeltas, querysets and numpy values are handled
+as DRF's encoder handles them.
+"""
+
+import datetime
+import decimal
+
+import orjson
+from django.conf import settings
+from django.db.models.query import QuerySet
+from django.utils.encoding import force_str
+from django.utils.functional import Promise
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+from rest_framework.renderers import BaseRenderer
+from rest_framework.settings import api_settings
+
+OPTIONS = orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+
+def _default(obj):
+    """Types orjson does not serialize natively"""
+    if isinstance(obj, Promise):
+        return force_str(obj)
+    if isinstance(obj, decimal.Decimal):
+        return str(obj) if api_settings.COERCE_DECIMAL_TO_STRING else float(obj)
+    if isinstance(obj, datetime.timedelta):
+        return str(obj.total_seconds())
+    if isinstance(obj, QuerySet):
+        return list(obj)
+    if isinstance(obj, bytes):
+        return obj.decode()
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    if hasattr(obj, 'keys') and hasattr(obj, '__getitem__'):
+        return dict(obj)
+    if hasattr(obj, '__iter__'):
+        return list(obj)
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def dumps(data, indent=False) -> bytes:
+    ret = orjson.dumps(data, default=_default, option=OPTIONS | (orjson.OPT_INDENT_2 if indent else 0))
+    # Like DRF, escape the separators that are valid JSON but not valid JavaScript
+    if b'\xe2\x80\xa8' in ret or b'\xe2\x80\xa9' in ret:
+        ret = ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+    return ret
+
+
+class ORJSONRenderer(BaseRenderer):
+    media_type = 'application/json'
+    format = 'json'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        # orjson only indents by two spaces; any requested indent turns it on
+        indent = False
+        if accepted_media_type:
+            params = dict(
+                part.strip().split('=', 1) for part in accepted_media_type.split(';')[1:] if '=' in part
+            )
+            indent = params.get('indent', '0').strip() not in ('', '0')
+        indent = indent or bool((renderer_context or {}).get('indent'))
+        return dumps(data, indent=indent)
+
+
+class ORJSONParser(BaseParser):
+    media_type = 'application/json'
+    renderer_class = ORJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        encoding = (parser_context or {}).get('encoding', settings.DEFAULT_CHARSET)
+        body = stream.read()
+        try:
+            if encoding.lower().replace('-', '') != 'utf8':
+                body = body.decode(encoding)
+            return orjson.loads(body)
+        except (orjson.JSONDecodeError, UnicodeDecodeError) as exc:
+            raise ParseError(f'JSON parse error - {exc}')
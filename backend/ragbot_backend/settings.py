@@ -1,3 +1,5 @@
+import os
+import tempfile
 from pathlib import Path
 from decouple import config
 from datetime import timedelta
@@ -28,7 +30,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'ragbot_backend.db_router.ReplicaPinMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'ragbot_backend.compression.CompressionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -66,9 +70,26 @@ DATABASES = {
         'PASSWORD': config('DB_PASSWORD', default=''),
         'HOST': config('DB_HOST', default='localhost'),
         'PORT': config('DB_PORT', default='5432'),
+        # Persistent connections, checked before reuse, instead of a handshake per request
+        'CONN_MAX_AGE': config('DB_CONN_MAX_AGE', default=300, cast=int),
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
+# Optional read replica for retrieval, history and listing reads
+DB_REPLICA_HOST = config('DB_REPLICA_HOST', default='')
+if DB_REPLICA_HOST:
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'HOST': DB_REPLICA_HOST,
+        'PORT': config('DB_REPLICA_PORT', default=DATABASES['default']['PORT']),
+        'TEST': {'MIRROR': 'default'},
+    }
+DATABASE_READ_REPLICA = 'replica' if DB_REPLICA_HOST else None
+DATABASE_ROUTERS = ['ragbot_backend.db_router.ReplicaRouter']
+# Reads of a conversation stay on the primary this long after it is written
+DATABASE_REPLICA_STICKY_SECONDS = config('DATABASE_REPLICA_STICKY_SECONDS', default=5, cast=int)
+
 AUTH_USER_MODEL = 'accounts.User'
 
 AUTH_PASSWORD_VALIDATORS = [
@@ -90,15 +111,92 @@ STATICFILES_DIRS = [BASE_DIR / 'static']
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Bulk uploads: files per request and parallel ingestion workers per process
+DATA_UPLOAD_MAX_NUMBER_FILES = config('DATA_UPLOAD_MAX_NUMBER_FILES', default=500, cast=int)
+DOCUMENT_INGEST_WORKERS = config('DOCUMENT_INGEST_WORKERS', default=4, cast=int)
+# Hash uploads while they stream in so identical files can reuse chunks
+FILE_UPLOAD_HANDLERS = [
+    'documents.upload_handlers.HashingMemoryFileUploadHandler',
+    'documents.upload_handlers.HashingTemporaryFileUploadHandler',
+]
+# gzip-compressed extracted text keyed by file hash, least recently used entries
+# evicted beyond EXTRACTED_TEXT_CACHE_MB; empty disables the cache
+EXTRACTED_TEXT_CACHE_DIR = config(
+    'EXTRACTED_TEXT_CACHE_DIR', default=os.path.join(tempfile.gettempdir(), 'ragbot-extracted-text')
+)
+EXTRACTED_TEXT_CACHE_MB = config('EXTRACTED_TEXT_CACHE_MB', default=1024, cast=int)
+
+# In-process retrieval indexes: cache limits and optional prewarm of the most
+# recently active chatbots when a server process starts
+RAG_INDEX_CACHE_SIZE = config('RAG_INDEX_CACHE_SIZE', default=32, cast=int)
+RAG_INDEX_MEMORY_MB = config('RAG_INDEX_MEMORY_MB', default=512, cast=int)
+# Directory for memory-mapped index files shared by all workers on a node;
+# empty keeps a private in-memory copy per worker process
+RAG_INDEX_DIR = config('RAG_INDEX_DIR', default='')
+RAG_PREWARM_ON_STARTUP = config('RAG_PREWARM_ON_STARTUP', default=False, cast=bool)
+RAG_PREWARM_CHATBOTS = config('RAG_PREWARM_CHATBOTS', default=20, cast=int)
+
+# Document embeddings: chunks of concurrent ingestions are merged into batches
+# of up to this many texts/tokens, within a requests and tokens per minute
+# budget per process (0 = unlimited)
+EMBEDDING_BATCH_SIZE = config('EMBEDDING_BATCH_SIZE', default=256, cast=int)
+EMBEDDING_BATCH_MAX_TOKENS = config('EMBEDDING_BATCH_MAX_TOKENS', default=100_000, cast=int)
+EMBEDDING_REQUESTS_PER_MINUTE = config('EMBEDDING_REQUESTS_PER_MINUTE', default=3000, cast=int)
+EMBEDDING_TOKENS_PER_MINUTE = config('EMBEDDING_TOKENS_PER_MINUTE', default=1_000_000, cast=int)
+EMBEDDING_MAX_IN_FLIGHT = config('EMBEDDING_MAX_IN_FLIGHT', default=2, cast=int)
+EMBEDDING_MAX_RETRIES = config('EMBEDDING_MAX_RETRIES', default=5, cast=int)
+# Jobs queued longer than this are served before higher-priority ones
+EMBEDDING_AGING_SECONDS = config('EMBEDDING_AGING_SECONDS', default=30, cast=int)
+# Per request to the embeddings API; the client doesn't retry (see services.embedding_scheduler)
+EMBEDDING_REQUEST_TIMEOUT_SECONDS = config('EMBEDDING_REQUEST_TIMEOUT_SECONDS', default=30.0, cast=float)
+# A document stops waiting for its embeddings (and fails) after this long
+EMBEDDING_JOB_TIMEOUT_SECONDS = config('EMBEDDING_JOB_TIMEOUT_SECONDS', default=600, cast=int)
+
+# Soft-deleted documents and conversations are removed by services.reaper in batches of this many rows
+REAP_BATCH_SIZE = config('REAP_BATCH_SIZE', default=1000, cast=int)
+REAP_IN_BACKGROUND = config('REAP_IN_BACKGROUND', default=True, cast=bool)
+# Unreferenced uploads younger than this are kept; their document row may not be committed yet
+ORPHAN_FILE_GRACE_SECONDS = config('ORPHAN_FILE_GRACE_SECONDS', default=3600, cast=int)
+
+# Conversations past a chatbot's retention period are archived here as
+# gzip-compressed NDJSON by the archive_conversations command. The default
+# (ignored by git) is for development; point it at durable storage elsewhere
+CONVERSATION_ARCHIVE_DIR = config('CONVERSATION_ARCHIVE_DIR', default=str(BASE_DIR / 'archive' / 'conversations'))
+MESSAGE_PARTITION_MONTHS_AHEAD = config('MESSAGE_PARTITION_MONTHS_AHEAD', default=3, cast=int)
+
+# Batch Q&A: questions per request and concurrent LLM calls per batch
+BATCH_QA_MAX_QUESTIONS = config('BATCH_QA_MAX_QUESTIONS', default=1000, cast=int)
+BATCH_QA_CONCURRENCY = config('BATCH_QA_CONCURRENCY', default=8, cast=int)
+# Batch answers take the owner's chat scheduler slots; they may wait longer than chat requests
+BATCH_QA_QUEUE_TIMEOUT_SECONDS = config('BATCH_QA_QUEUE_TIMEOUT_SECONDS', default=60.0, cast=float)
+
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Serialized GET responses are cached per user this long, keyed by their ETag
+RESPONSE_CACHE_SECONDS = config('RESPONSE_CACHE_SECONDS', default=10, cast=int)
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': ('rest_framework_simplejwt.authentication.JWTAuthentication',),
     'DEFAULT_PERMISSION_CLASSES': ('rest_framework.permissions.IsAuthenticated',),
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 20,
+    'DEFAULT_RENDERER_CLASSES': (
+        'ragbot_backend.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
+    'DEFAULT_PARSER_CLASSES': (
+        'ragbot_backend.renderers.ORJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ),
 }
 
+# Bodies smaller than this many bytes are sent uncompressed
+RESPONSE_COMPRESSION_MIN_SIZE = config('RESPONSE_COMPRESSION_MIN_SIZE', default=1024, cast=int)
+RESPONSE_COMPRESSION_GZIP_LEVEL = config('RESPONSE_COMPRESSION_GZIP_LEVEL', default=6, cast=int)
+# Quality 4-5 is the usual sweet spot for dynamic responses; 11 is for static assets
+RESPONSE_COMPRESSION_BROTLI_QUALITY = config('RESPONSE_COMPRESSION_BROTLI_QUALITY', default=5, cast=int)
+
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(hours=1),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=7),
@@ -114,6 +212,53 @@ SIMPLE_JWT = {
     'TOKEN_TYPE_CLAIM': 'token_type',
 }
 
+# Token-bucket limits for the anonymous chat endpoint, per client IP and per chatbot
+CHAT_RATE_LIMITS = {
+    'ip': {
+        'per_minute': config('CHAT_IP_RATE_PER_MINUTE', default=20, cast=int),
+        'burst': config('CHAT_IP_BURST', default=10, cast=int),
+    },
+    'chatbot': {
+        'per_minute': config('CHAT_CHATBOT_RATE_PER_MINUTE', default=120, cast=int),
+        'burst': config('CHAT_CHATBOT_BURST', default=60, cast=int),
+    },
+}
+# Only enable behind a proxy that overwrites X-Forwarded-For
+CHAT_TRUST_X_FORWARDED_FOR = config('CHAT_TRUST_X_FORWARDED_FOR', default=False, cast=bool)
+
+# Chat deadline (Chatbot.response_deadline_seconds): the query embedding gets at
+# most CHAT_EMBEDDING_TIMEOUT_SECONDS and must leave CHAT_LLM_MIN_SECONDS for the
+# completion, else retrieval is lexical. With less than CHAT_DEGRADE_BELOW_SECONDS
+# left after retrieval only CHAT_DEGRADED_TOP_K chunks are used, and max_tokens is
+# capped at what CHAT_LLM_TOKENS_PER_SECOND can generate in the time left.
+CHAT_EMBEDDING_TIMEOUT_SECONDS = config('CHAT_EMBEDDING_TIMEOUT_SECONDS', default=3.0, cast=float)
+# Threads running the deadline-bounded embedding and completion calls, per process
+CHAT_DEADLINE_WORKERS = config('CHAT_DEADLINE_WORKERS', default=32, cast=int)
+CHAT_LLM_MIN_SECONDS = config('CHAT_LLM_MIN_SECONDS', default=2.0, cast=float)
+CHAT_DEGRADE_BELOW_SECONDS = config('CHAT_DEGRADE_BELOW_SECONDS', default=8.0, cast=float)
+CHAT_DEGRADED_TOP_K = config('CHAT_DEGRADED_TOP_K', default=2, cast=int)
+CHAT_LLM_TOKENS_PER_SECOND = config('CHAT_LLM_TOKENS_PER_SECOND', default=40, cast=int)
+# First-turn answers kept for the cached-answer fast path
+CHAT_ANSWER_CACHE_SECONDS = config('CHAT_ANSWER_CACHE_SECONDS', default=3600, cast=int)
+# Identical concurrent first-turn questions wait for one answer (services.coalescing);
+# across processes too when enabled, which needs a shared cache backend
+CHAT_COALESCE_ACROSS_PROCESSES = config('CHAT_COALESCE_ACROSS_PROCESSES', default=False, cast=bool)
+CHAT_COALESCE_WAIT_SECONDS = config('CHAT_COALESCE_WAIT_SECONDS', default=30.0, cast=float)
+CHAT_COALESCE_POLL_SECONDS = config('CHAT_COALESCE_POLL_SECONDS', default=0.05, cast=float)
+
+# Fair scheduling of answers per chatbot owner (services.chat_scheduler), per process:
+# concurrent answers in total and per owner's plan, fair-queuing weights per plan,
+# and how long and how many requests an owner may queue before getting a 429
+CHAT_MAX_CONCURRENT_ANSWERS = config('CHAT_MAX_CONCURRENT_ANSWERS', default=16, cast=int)
+CHAT_PLAN_CONCURRENCY = {
+    'free': config('CHAT_FREE_CONCURRENCY', default=2, cast=int),
+    'pro': config('CHAT_PRO_CONCURRENCY', default=6, cast=int),
+    'enterprise': config('CHAT_ENTERPRISE_CONCURRENCY', default=12, cast=int),
+}
+CHAT_PLAN_WEIGHTS = {'free': 1, 'pro': 3, 'enterprise': 6}
+CHAT_QUEUE_TIMEOUT_SECONDS = config('CHAT_QUEUE_TIMEOUT_SECONDS', default=2.0, cast=float)
+CHAT_MAX_QUEUED_PER_OWNER = config('CHAT_MAX_QUEUED_PER_OWNER', default=20, cast=int)
+
 CORS_ALLOWED_ORIGINS = [
     'http://localhost:3000',
     'http://localhost:3001',
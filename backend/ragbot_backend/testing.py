@@ -0,0 +1,49 @@
+"""
+Shared fixtures for the apps' test suites.
+
+``RagbotTestCase`` creates the usual owner and chatbot and gives a test its
+own MEDIA_ROOT (or any other temporary directory and settings) for its
+duration. ``self.client`` is an ``APIClient``.
+"""
+
+import shutil
+import tempfile
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
+
+from chatbots.models import Chatbot
+
+
+class RagbotTestCase(TestCase):
+    client_class = APIClient
+
+    def create_owner(self, name: str = 'owner', **fields):
+        """Create a user named after ``name``; ``fields`` override quotas or plan"""
+        return get_user_model().objects.create_user(
+            email=f'{name}@example.com', username=name, password='pass12345',
+            first_name=name.capitalize(), last_name='User', **fields
+        )
+
+    def create_chatbot(self, owner=None, name: str = 'Test Bot', **fields) -> Chatbot:
+        """Create a chatbot for ``owner``, or for a new default owner"""
+        return Chatbot.objects.create(owner=owner or self.create_owner(), name=name, **fields)
+
+    def make_temp_dir(self) -> str:
+        """A directory that is removed after the test"""
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path, ignore_errors=True)
+        return path
+
+    def use_settings(self, **overrides) -> None:
+        """Override settings for the rest of the test, setUp included"""
+        settings_override = override_settings(**overrides)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def use_temp_media(self, **overrides) -> str:
+        """Point MEDIA_ROOT (and any other ``overrides``) at a fresh directory; returns it"""
+        media_root = self.make_temp_dir()
+        self.use_settings(MEDIA_ROOT=media_root, **overrides)
+        return media_root
@@ -0,0 +1,50 @@
+"""
+Recent answers to first-turn chat questions, kept in the Django cache.
+
+An answer is reused only as the deadline's ``cached_answer`` fast path, so
+keys cover everything that shaped it: the chatbot, the normalised question,
+the retrieval filter, the index version of its documents and the chatbot's
+prompt, sampling and retrieval settings. Follow-up questions depend on the
+conversation and are never cached. The same key identifies identical
+questions in flight for ``services.coalescing``.
+"""
+
+import hashlib
+import json
+from typing import Dict, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+
+from services.vector_index import version_name
+
+# Chatbot settings an answer depends on
+CONFIG_FIELDS = [
+    'system_prompt', 'temperature', 'max_tokens', 'mmr_enabled', 'mmr_lambda', 'duplicate_threshold',
+    'embedding_reduction', 'embedding_dimensions',
+]
+
+
+def normalize_query(text: str) -> str:
+    return ' '.join(text.lower().split())
+
+
+def answer_key(chatbot, question: str, signature, filters: Optional[Dict] = None) -> str:
+    material = [
+        normalize_query(question),
+        filters or {},
+        version_name(signature),
+        [getattr(chatbot, field) for field in CONFIG_FIELDS],
+    ]
+    digest = hashlib.sha256(json.dumps(material, sort_keys=True, default=str).encode()).hexdigest()
+    return f'chat-answer:{chatbot.id}:{digest}'
+
+
+def get_answer(key: str) -> Optional[Dict]:
+    return cache.get(key)
+
+
+def store_answer(key: str, result: Dict) -> None:
+    """Keep the reply and its sources; usage figures don't apply to a reuse"""
+    answer = {'success': True, 'response': result['response'], 'chunks_used': result.get('chunks_used', [])}
+    cache.set(key, answer, timeout=settings.CHAT_ANSWER_CACHE_SECONDS)
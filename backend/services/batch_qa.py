@@ -0,0 +1,116 @@
+"""
+Batch question answering for evaluation sets and bulk Q&A jobs.
+
+All questions of a batch are embedded together and retrieved with one
+matrix-matrix product against the chatbot's index. LLM calls then run on a
+bounded thread pool and results are yielded as soon as each one completes,
+so callers can stream them as NDJSON instead of waiting for the slowest
+question. Each generation takes one of the owner's ``chat_scheduler`` slots,
+so a batch shares the owner's concurrency limit with its chat traffic.
+Batch answers are not stored as conversations.
+"""
+
+import json
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from django.conf import settings
+
+from chatbots.models import Chatbot
+from services.chat_scheduler import plan_limit
+from services.rag_service import rag_service
+
+
+def _elapsed_ms(start: float) -> float:
+    return round((time.perf_counter() - start) * 1000, 1)
+
+
+def _answer(chatbot: Chatbot, plan: str, index: int, question: str, retrieved: Dict) -> Dict:
+    start = time.perf_counter()
+    item = {'type': 'result', 'index': index, 'question': question}
+    try:
+        with rag_service.chat_scheduler.slot(chatbot.owner_id, plan, settings.BATCH_QA_QUEUE_TIMEOUT_SECONDS):
+            result = rag_service.answer_from_chunks(chatbot, question, retrieved['chunks'])
+    except Exception as e:
+        item.update(success=False, error=str(e), latency_ms=_elapsed_ms(start))
+        return item
+    item.update(
+        success=True,
+        answer=result['response'],
+        sources=[
+            {'document': chunk['document'], 'similarity': round(chunk['similarity'], 4)}
+            for chunk in result['chunks_used']
+        ],
+        latency_ms=_elapsed_ms(start),
+        prompt_tokens=result['prompt_tokens'],
+        completion_tokens=result['completion_tokens'],
+        total_tokens=result['tokens_used'],
+        prompt_tokens_saved=retrieved['prompt_tokens_saved'],
+    )
+    return item
+
+
+def answer_questions(
+        chatbot: Chatbot,
+        questions: List[str],
+        filters: Optional[Dict] = None,
+        top_k: int = 5,
+        concurrency: Optional[int] = None
+) -> Iterator[Dict]:
+    """
+    Yield one ``result`` item per question, in completion order, then a ``summary``.
+
+    At most ``concurrency`` generations run at once, never more than the
+    owner's plan allows, and no more are queued, so closing the iterator
+    early stops the remaining work.
+    """
+    started = time.perf_counter()
+    plan = chatbot.owner.plan
+    concurrency = min(concurrency or getattr(settings, 'BATCH_QA_CONCURRENCY', 8), plan_limit(plan))
+
+    retrieval_start = time.perf_counter()
+    retrieved = rag_service.retrieve_many(
+        chatbot.id, questions, top_k=top_k, filters=filters, rerank=rag_service.rerank_options(chatbot)
+    )
+    retrieval_ms = _elapsed_ms(retrieval_start)
+
+    summary = {'type': 'summary', 'questions': len(questions), 'succeeded': 0, 'failed': 0,
+               'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0, 'prompt_tokens_saved': 0}
+    pending = iter(enumerate(zip(questions, retrieved)))
+    running = set()
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='batch-qa') as pool:
+        def submit_next():
+            for index, (question, found) in pending:
+                running.add(pool.submit(_answer, chatbot, plan, index, question, found))
+                return
+
+        try:
+            for _ in range(concurrency):
+                submit_next()
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    running.discard(future)
+                    submit_next()
+                    item = future.result()
+                    if item['success']:
+                        summary['succeeded'] += 1
+                        for key in ('prompt_tokens', 'completion_tokens', 'total_tokens', 'prompt_tokens_saved'):
+                            summary[key] += item[key]
+                    else:
+                        summary['failed'] += 1
+                    yield item
+        finally:
+            for future in running:
+                future.cancel()
+
+    summary['retrieval_ms'] = retrieval_ms
+    summary['elapsed_ms'] = _elapsed_ms(started)
+    yield summary
+
+
+def to_ndjson(items: Iterable[Dict]) -> Iterator[str]:
+    for item in items:
+        yield json.dumps(item) + '\n'
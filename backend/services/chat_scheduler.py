@@ -0,0 +1,226 @@
+"""
+Fair scheduling of chat answers across tenants (chatbot owners).
+
+Every answer that calls the LLM first takes a slot from ``FairScheduler``.
+A process has ``CHAT_MAX_CONCURRENT_ANSWERS`` slots, and an owner holds at
+most ``CHAT_PLAN_CONCURRENCY[plan]`` of them at once, so one owner's burst
+queues behind its own limit instead of occupying every worker.
+
+Waiting requests are admitted by weighted fair queuing: each gets a virtual
+finish tag ``max(virtual time, owner's last tag) + 1 / weight``, with the
+weight from ``CHAT_PLAN_WEIGHTS``, and a freed slot goes to the smallest tag
+among owners below their limit. A busy owner's tags run ahead, so a quiet
+owner's request is admitted next even behind a long queue.
+
+Waits are short: a request not admitted within its timeout, or arriving when
+its owner already has ``CHAT_MAX_QUEUED_PER_OWNER`` waiting, fails with
+``QueueTimeout`` straight away. Limits and metrics are per process.
+An owner is tracked only while it has answers in flight or waiting, so
+per-owner metrics cover its current busy spell; process totals keep the
+counts of every owner.
+
+A caller that gives up on a call still running in a worker thread passes
+its future as ``pending``; the slot is then released when that call
+finishes, so the limits cap the calls actually in flight upstream.
+"""
+
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence
+
+from django.conf import settings
+
+
+class QueueTimeout(Exception):
+
+    def __init__(self, message: str, retry_after: float = 1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Waiter:
+
+    def __init__(self, owner_id: int, tag: float):
+        self.owner_id = owner_id
+        self.tag = tag
+        self.admitted = threading.Event()
+        self.enqueued = time.monotonic()
+
+
+class _Tenant:
+
+    def __init__(self, plan: str):
+        self.plan = plan
+        self.in_flight = 0
+        self.queued = 0
+        self.finish = 0.0
+        self.admitted = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.overruns = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def stats(self) -> Dict:
+        return {
+            'plan': self.plan,
+            'in_flight': self.in_flight,
+            'queued': self.queued,
+            'admitted': self.admitted,
+            'timeouts': self.timeouts,
+            'rejected': self.rejected,
+            'overruns': self.overruns,
+            'average_wait_seconds': round(self.wait_total / self.admitted, 3) if self.admitted else 0.0,
+            'max_wait_seconds': round(self.wait_max, 3),
+        }
+
+
+def plan_limit(plan: str) -> int:
+    limits = settings.CHAT_PLAN_CONCURRENCY
+    return limits.get(plan, limits['free'])
+
+
+def plan_weight(plan: str) -> float:
+    weights = settings.CHAT_PLAN_WEIGHTS
+    return weights.get(plan, weights['free'])
+
+
+class FairScheduler:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tenants: Dict[int, _Tenant] = {}
+        self._waiting: List[_Waiter] = []
+        self._in_flight = 0
+        self._virtual_time = 0.0
+        self._totals = dict.fromkeys(['admitted', 'timeouts', 'rejected', 'overruns'], 0)
+
+    @contextmanager
+    def slot(
+            self,
+            owner_id: int,
+            plan: str,
+            timeout: Optional[float] = None,
+            pending: Optional[Sequence[Future]] = None
+    ):
+        """
+        Hold one of the owner's slots for the duration of the block.
+
+        ``pending`` is read when the block exits: if any of its futures is
+        still running, the slot is kept until the last of them finishes.
+        """
+        self.acquire(owner_id, plan, timeout)
+        try:
+            yield
+        finally:
+            self._release_after(owner_id, [future for future in pending or () if not future.done()])
+
+    def acquire(self, owner_id: int, plan: str, timeout: Optional[float] = None) -> None:
+        """Wait up to ``timeout`` (default ``CHAT_QUEUE_TIMEOUT_SECONDS``) for a slot"""
+        if timeout is None:
+            timeout = settings.CHAT_QUEUE_TIMEOUT_SECONDS
+        with self._lock:
+            tenant = self._tenant(owner_id, plan)
+            if tenant.queued >= settings.CHAT_MAX_QUEUED_PER_OWNER:
+                tenant.rejected += 1
+                self._totals['rejected'] += 1
+                self._forget_if_idle(owner_id)
+                raise QueueTimeout(f"{tenant.queued} requests of this owner are already waiting")
+            tenant.finish = max(self._virtual_time, tenant.finish) + 1.0 / plan_weight(plan)
+            waiter = _Waiter(owner_id, tenant.finish)
+            self._waiting.append(waiter)
+            tenant.queued += 1
+            self._dispatch()
+
+        waiter.admitted.wait(max(0.0, timeout))
+        with self._lock:
+            waited = time.monotonic() - waiter.enqueued
+            if not waiter.admitted.is_set():
+                self._waiting.remove(waiter)
+                tenant.queued -= 1
+                tenant.timeouts += 1
+                self._totals['timeouts'] += 1
+                self._forget_if_idle(owner_id)
+                raise QueueTimeout(f"No answer slot free within {timeout:.2f}s")
+            tenant.admitted += 1
+            self._totals['admitted'] += 1
+            tenant.wait_total += waited
+            tenant.wait_max = max(tenant.wait_max, waited)
+
+    def release(self, owner_id: int) -> None:
+        with self._lock:
+            self._tenants[owner_id].in_flight -= 1
+            self._in_flight -= 1
+            self._forget_if_idle(owner_id)
+            self._dispatch()
+
+    def _release_after(self, owner_id: int, futures: List[Future]) -> None:
+        """Release the owner's slot now, or once every one of ``futures`` is done"""
+        if not futures:
+            self.release(owner_id)
+            return
+        with self._lock:
+            self._tenants[owner_id].overruns += 1
+            self._totals['overruns'] += 1
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def finished(_):
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                self.release(owner_id)
+
+        for future in futures:
+            future.add_done_callback(finished)
+
+    def _tenant(self, owner_id: int, plan: str) -> _Tenant:
+        tenant = self._tenants.get(owner_id)
+        if tenant is None:
+            tenant = self._tenants[owner_id] = _Tenant(plan)
+        tenant.plan = plan
+        return tenant
+
+    def _forget_if_idle(self, owner_id: int) -> None:
+        """Drop an owner with nothing in flight or waiting; caller holds the lock"""
+        tenant = self._tenants[owner_id]
+        if not tenant.in_flight and not tenant.queued:
+            # Returning later, it starts from virtual time like any idle owner
+            del self._tenants[owner_id]
+
+    def _dispatch(self) -> None:
+        """Admit the smallest tags whose owners are under their limits; caller holds the lock"""
+        while self._waiting and self._in_flight < settings.CHAT_MAX_CONCURRENT_ANSWERS:
+            eligible = [
+                waiter for waiter in self._waiting
+                if self._tenants[waiter.owner_id].in_flight < plan_limit(self._tenants[waiter.owner_id].plan)
+            ]
+            if not eligible:
+                return
+            waiter = min(eligible, key=lambda candidate: (candidate.tag, candidate.enqueued))
+            self._waiting.remove(waiter)
+            tenant = self._tenants[waiter.owner_id]
+            tenant.queued -= 1
+            tenant.in_flight += 1
+            self._in_flight += 1
+            self._virtual_time = max(self._virtual_time, waiter.tag)
+            waiter.admitted.set()
+
+    def stats(self, owner_id: Optional[int] = None) -> Dict:
+        """Process totals, with the metrics of one busy owner or of every busy owner"""
+        with self._lock:
+            if owner_id is not None:
+                tenant = self._tenants.get(owner_id)
+                tenants = {owner_id: tenant.stats()} if tenant else {}
+            else:
+                tenants = {key: tenant.stats() for key, tenant in self._tenants.items()}
+            return {
+                'capacity': settings.CHAT_MAX_CONCURRENT_ANSWERS,
+                'in_flight': self._in_flight,
+                'queued': len(self._waiting),
+                'totals': dict(self._totals),
+                'tenants': tenants,
+            }
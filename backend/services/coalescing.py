@@ -0,0 +1,127 @@
+"""
+Single-flight coalescing of identical concurrent computations.
+
+The first caller of ``Coalescer.run`` for a key becomes the leader and runs
+the computation; callers arriving while it is in flight wait for it and get
+the same result (or exception) instead of repeating the work. Nothing is
+kept once the flight lands, so later callers start a new one.
+
+With ``CHAT_COALESCE_ACROSS_PROCESSES`` the leader also takes a lock in the
+cache (``cache.add``), and leaders of other processes wait for the result it
+publishes under the lock's token. That needs a cache shared by the
+processes; a follower whose leader disappears without a result computes on
+its own.
+"""
+
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+
+# Followers of another process read the leader's result for this long
+RESULT_SECONDS = 10
+
+
+class FlightTimeout(Exception):
+    pass
+
+
+class _Flight:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception: Optional[BaseException] = None
+
+
+class Coalescer:
+
+    def __init__(self, namespace: str):
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._flights: Dict[str, _Flight] = {}
+        self._counters = {'leaders': 0, 'followers': 0, 'remote_followers': 0, 'timeouts': 0}
+
+    def run(self, key: str, func: Callable[[], Any], timeout: Optional[float] = None) -> Tuple[Any, bool]:
+        """
+        Return ``(result, shared)`` of ``func`` for ``key``.
+
+        ``shared`` is True when another caller computed the result. Followers
+        wait at most ``timeout`` (default ``CHAT_COALESCE_WAIT_SECONDS``)
+        seconds, then ``FlightTimeout`` is raised.
+        """
+        if timeout is None:
+            timeout = settings.CHAT_COALESCE_WAIT_SECONDS
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self._counters['leaders'] += 1
+            else:
+                self._counters['followers'] += 1
+
+        if not leader:
+            if not flight.done.wait(timeout):
+                self._count('timeouts')
+                raise FlightTimeout(f"Identical request still running after {timeout:.2f}s")
+            if flight.exception is not None:
+                raise flight.exception
+            return flight.result, True
+
+        try:
+            if settings.CHAT_COALESCE_ACROSS_PROCESSES:
+                flight.result, shared = self._run_shared(key, func, timeout)
+            else:
+                flight.result, shared = func(), False
+            return flight.result, shared
+        except BaseException as exc:
+            flight.exception = exc
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {'in_flight': len(self._flights), **self._counters}
+
+    def _count(self, counter: str) -> None:
+        with self._lock:
+            self._counters[counter] += 1
+
+    def _run_shared(self, key: str, func: Callable[[], Any], timeout: float) -> Tuple[Any, bool]:
+        lock_key = f'flight:{self.namespace}:{key}'
+        token = uuid.uuid4().hex
+        if not cache.add(lock_key, token, timeout=settings.CHAT_COALESCE_WAIT_SECONDS):
+            return self._follow(lock_key, func, timeout)
+        try:
+            result = func()
+            cache.set(f'{lock_key}:{token}', result, timeout=RESULT_SECONDS)
+            return result, False
+        finally:
+            if cache.get(lock_key) == token:
+                cache.delete(lock_key)
+
+    def _follow(self, lock_key: str, func: Callable[[], Any], timeout: float) -> Tuple[Any, bool]:
+        """Wait for another process's leader by polling its result"""
+        give_up = time.monotonic() + timeout
+        owner = None
+        while True:
+            # Read the lock before the result: a leader publishes, then releases
+            current = cache.get(lock_key)
+            owner = current or owner
+            result = cache.get(f'{lock_key}:{owner}') if owner is not None else None
+            if result is not None:
+                self._count('remote_followers')
+                return result, True
+            if current is None:
+                return func(), False
+            if time.monotonic() >= give_up:
+                self._count('timeouts')
+                raise FlightTimeout(f"Identical request in another process still running after {timeout:.2f}s")
+            time.sleep(settings.CHAT_COALESCE_POLL_SECONDS)
@@ -0,0 +1,71 @@
+"""
+Per-request time budget for chat turns.
+
+``chat_endpoint`` starts a ``Deadline`` as soon as the request arrives and
+hands it down the pipeline. Each stage asks how much budget is left, bounds
+its own call with it, and picks a degraded fast path when too little is left
+for the normal one; the paths taken are recorded on the deadline and stored
+with the assistant message.
+
+Bounded calls run on a shared pool of ``CHAT_DEADLINE_WORKERS`` threads. A
+call that overruns is abandoned, not interrupted: it keeps its worker until
+the client's own timeout ends it, and its future is kept on the deadline
+(``abandoned``) so callers can tell when it has really finished.
+"""
+
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import Callable, List, Optional
+
+from django.conf import settings
+
+# Degraded fast paths
+LEXICAL_RETRIEVAL = 'lexical_retrieval'
+FEWER_CHUNKS = 'fewer_chunks'
+REDUCED_MAX_TOKENS = 'reduced_max_tokens'
+CACHED_ANSWER = 'cached_answer'
+
+
+_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'CHAT_DEADLINE_WORKERS', 32),
+    thread_name_prefix='deadline-call',
+)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds
+        self.degraded: List[str] = []
+        self.abandoned: List[Future] = []
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires - time.monotonic())
+
+    def degrade(self, path: str) -> None:
+        if path not in self.degraded:
+            self.degraded.append(path)
+
+    def call(self, func: Callable, timeout: Optional[float] = None):
+        """
+        Run ``func`` for at most ``timeout`` (default: all remaining) seconds.
+
+        Raises ``DeadlineExceeded`` when it takes longer; the call is left
+        to finish on its worker, so give it a client timeout too.
+        """
+        budget = self.remaining() if timeout is None else min(timeout, self.remaining())
+        if budget <= 0:
+            raise DeadlineExceeded("No time left for the call")
+        future = _executor.submit(func)
+        try:
+            return future.result(timeout=budget)
+        except FutureTimeout:
+            # Still queued behind busy workers: it never needs to run
+            if not future.cancel():
+                self.abandoned.append(future)
+            raise DeadlineExceeded(f"Call did not finish within {budget:.2f}s")
@@ -0,0 +1,74 @@
+"""
+Offline evaluation of reduced embedding representations.
+
+Compares searches over a chatbot's reduced index against the same searches at
+full dimension: recall@k of the full-dimension top ``k``, index memory, and
+per-query scoring latency. Queries are a sample of the chatbot's own chunk
+embeddings (each chunk's own row excluded from both result lists), or real
+user questions when query embeddings are passed in.
+"""
+
+import time
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from services import vector_index
+
+DEFAULT_SAMPLE = 200
+
+
+def sample_queries(index: vector_index.ChatbotIndex, sample: int = DEFAULT_SAMPLE, seed: int = 0):
+    """Rows of ``index`` used as queries, and those rows' positions"""
+    rows = np.arange(len(index))
+    if len(rows) > sample:
+        rows = np.sort(np.random.default_rng(seed).choice(rows, sample, replace=False))
+    return np.asarray(index.matrix[rows]), rows
+
+
+def _search(index, queries, k: int, exclude: Optional[np.ndarray]):
+    """Top-``k`` rows per query and the median seconds per single-query search"""
+    results, timings = [], []
+    for position, query in enumerate(queries):
+        started = time.perf_counter()
+        rows, _ = index.shortlist_many([query], k + (exclude is not None))[0]
+        timings.append(time.perf_counter() - started)
+        if exclude is not None:
+            rows = rows[rows != exclude[position]]
+        results.append(set(rows[:k].tolist()))
+    return results, float(np.median(timings)) if timings else 0.0
+
+
+def evaluate(chatbot_id: int, method: str, dimensions: Sequence[int], k: int = 10,
+             sample: int = DEFAULT_SAMPLE, query_embeddings=None) -> List[Dict]:
+    """
+    One report per entry of ``dimensions``, after a full-dimension baseline.
+
+    The chatbot's own ``embedding_reduction`` setting is ignored; the
+    baseline and every candidate are built from its full vectors.
+    """
+    full = vector_index.build_index(chatbot_id, reduce=False)
+    if not len(full):
+        return []
+    if query_embeddings is None:
+        queries, exclude = sample_queries(full, sample)
+    else:
+        queries, exclude = np.asarray(query_embeddings, dtype=np.float32), None
+
+    expected, full_latency = _search(full, queries, k, exclude)
+    reports = [{
+        'method': 'none', 'dimensions': full.matrix.shape[1], 'recall': 1.0, 'bytes': full.nbytes,
+        'latency_ms': full_latency * 1000, 'fit_seconds': 0.0,
+    }]
+    for size in dimensions:
+        started = time.perf_counter()
+        reduced = vector_index.reduce_index(full, method, size)
+        fit_seconds = time.perf_counter() - started
+        found, latency = _search(reduced, queries, k, exclude)
+        recalls = [len(hits & truth) / len(truth) for hits, truth in zip(found, expected) if truth]
+        reports.append({
+            'method': method, 'dimensions': reduced.matrix.shape[1],
+            'recall': float(np.mean(recalls)) if recalls else 1.0,
+            'bytes': reduced.nbytes, 'latency_ms': latency * 1000, 'fit_seconds': fit_seconds,
+        })
+    return reports
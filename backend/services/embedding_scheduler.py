@@ -0,0 +1,277 @@
+"""
+Central scheduler for document embedding requests.
+
+Documents processed concurrently (bulk uploads on the ingestion pool, API
+uploads, reprocessing) submit their chunks here instead of calling the
+embeddings API themselves. A few dispatcher threads merge pending chunks
+from all documents into full batches of up to ``EMBEDDING_BATCH_SIZE``
+texts and ``EMBEDDING_BATCH_MAX_TOKENS`` tokens.
+
+Every batch first takes one request from a requests-per-minute bucket and
+its tiktoken count from a tokens-per-minute bucket. The buckets are
+``usage_limits.TokenBucket`` entries in the cache; their updates are only
+serialised within a process, so run one scheduling process per API key or
+divide the budget between processes. A 429 pauses every dispatcher of the
+process for the advertised ``Retry-After`` (or an exponential backoff):
+each one waits out the pause before its next request, and the rate-limited
+batch is then retried. The embeddings client must not retry on its own
+(``max_retries=0``), or the retries multiply.
+
+Any error while sending a batch fails the documents in it, and ``embed``
+gives up on a job after ``EMBEDDING_JOB_TIMEOUT_SECONDS``, so a document
+never waits on the scheduler forever.
+
+Batches are filled from the job with the best rank: priority class first
+(``INTERACTIVE`` uploads, then ``BULK`` uploads, then ``BACKFILL`` for
+reprocessing and documents imported from snapshots unprocessed), then
+fewest tokens, so small documents finish first. A job waiting longer than
+``EMBEDDING_AGING_SECONDS`` jumps ahead of ranking so backfills still make
+progress under constant interactive load.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from typing import Callable, Dict, List, Optional, Sequence
+
+from django.conf import settings
+from openai import RateLimitError
+
+from services.text_splitter import count_tokens
+from services.usage_limits import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE, BULK, BACKFILL = 0, 1, 2
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BULK: 'bulk', BACKFILL: 'backfill'}
+
+# Waits recorded for the reported averages
+_WAIT_SAMPLES = 500
+
+
+class _Job:
+
+    def __init__(self, texts: Sequence[str], priority: int):
+        self.texts = list(texts)
+        self.tokens = [count_tokens(text) for text in self.texts]
+        self.total_tokens = sum(self.tokens)
+        self.priority = priority
+        self.vectors: List[Optional[List[float]]] = [None] * len(self.texts)
+        self.next = 0
+        self.remaining = len(self.texts)
+        self.future = Future()
+        self.enqueued = time.monotonic()
+
+
+class EmbeddingScheduler:
+
+    def __init__(self, embed_batch: Callable[[List[str]], List[List[float]]]):
+        self._embed_batch = embed_batch
+        self._cond = threading.Condition()
+        self._jobs: List[_Job] = []
+        self._threads: List[threading.Thread] = []
+        self._in_flight = 0
+        # time.monotonic() before which no dispatcher sends, after a 429
+        self._paused_until = 0.0
+        self._waits = deque(maxlen=_WAIT_SAMPLES)
+        self._counters = {
+            'batches': 0, 'texts': 0, 'tokens': 0, 'rate_limited': 0, 'failed_batches': 0, 'budget_wait_seconds': 0.0,
+        }
+
+    # Submitting
+
+    def submit(self, texts: Sequence[str], priority: int = INTERACTIVE) -> Future:
+        """Queue ``texts``; the future resolves to their vectors, in order"""
+        return self._enqueue(texts, priority).future
+
+    def embed(self, texts: Sequence[str], priority: int = INTERACTIVE, timeout: Optional[float] = None) -> List[List[float]]:
+        """Vectors of ``texts``; raises ``TimeoutError`` after ``timeout`` (default ``EMBEDDING_JOB_TIMEOUT_SECONDS``)"""
+        if timeout is None:
+            timeout = settings.EMBEDDING_JOB_TIMEOUT_SECONDS
+        job = self._enqueue(texts, priority)
+        try:
+            return job.future.result(timeout=timeout)
+        except FutureTimeout:
+            with self._cond:
+                # Texts not yet sent would be wasted work
+                if job in self._jobs:
+                    self._jobs.remove(job)
+            raise TimeoutError(f"Embedding {len(job.texts)} texts took longer than {timeout:g}s")
+
+    def _enqueue(self, texts: Sequence[str], priority: int) -> _Job:
+        job = _Job(texts, priority)
+        if not job.texts:
+            job.future.set_result([])
+            return job
+        with self._cond:
+            self._jobs.append(job)
+            self._start_dispatchers()
+            self._cond.notify()
+        return job
+
+    # Reporting
+
+    def stats(self) -> Dict:
+        """Queue depth, in-flight batches and wait times of this process"""
+        now = time.monotonic()
+        with self._cond:
+            by_priority = {name: 0 for name in PRIORITY_NAMES.values()}
+            for job in self._jobs:
+                by_priority[PRIORITY_NAMES.get(job.priority, str(job.priority))] += 1
+            waits = list(self._waits)
+            return {
+                'queued_jobs': len(self._jobs),
+                'queued_texts': sum(len(job.texts) - job.next for job in self._jobs),
+                'queued_tokens': sum(sum(job.tokens[job.next:]) for job in self._jobs),
+                'queued_by_priority': by_priority,
+                'oldest_wait_seconds': round(max((now - job.enqueued for job in self._jobs), default=0.0), 3),
+                'in_flight_batches': self._in_flight,
+                'average_wait_seconds': round(sum(waits) / len(waits), 3) if waits else 0.0,
+                'max_wait_seconds': round(max(waits), 3) if waits else 0.0,
+                **self._counters,
+            }
+
+    # Dispatching
+
+    def _start_dispatchers(self):
+        self._threads = [thread for thread in self._threads if thread.is_alive()]
+        for _ in range(settings.EMBEDDING_MAX_IN_FLIGHT - len(self._threads)):
+            thread = threading.Thread(target=self._dispatch_forever, name='embedding-dispatcher', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _rank(self, job: _Job, now: float):
+        if now - job.enqueued >= settings.EMBEDDING_AGING_SECONDS:
+            return (-1, job.enqueued)
+        return (job.priority, job.total_tokens, job.enqueued)
+
+    def _next_batch(self):
+        """Take up to a full batch of texts from the best-ranked jobs; caller holds the lock"""
+        now = time.monotonic()
+        max_texts, max_tokens = settings.EMBEDDING_BATCH_SIZE, settings.EMBEDDING_BATCH_MAX_TOKENS
+        texts, owners, tokens = [], [], 0
+        while self._jobs and len(texts) < max_texts:
+            job = min(self._jobs, key=lambda candidate: self._rank(candidate, now))
+            if job.next == 0:
+                self._waits.append(now - job.enqueued)
+            while job.next < len(job.texts) and len(texts) < max_texts:
+                # A single oversized text still goes out on its own
+                if texts and tokens + job.tokens[job.next] > max_tokens:
+                    break
+                texts.append(job.texts[job.next])
+                owners.append((job, job.next))
+                tokens += job.tokens[job.next]
+                job.next += 1
+            if job.next == len(job.texts):
+                self._jobs.remove(job)
+            else:
+                break
+        return texts, owners, tokens
+
+    def _buckets(self):
+        buckets = []
+        rpm, tpm = settings.EMBEDDING_REQUESTS_PER_MINUTE, settings.EMBEDDING_TOKENS_PER_MINUTE
+        if rpm:
+            buckets.append(TokenBucket('embeddings-requests', rpm, rpm))
+        if tpm:
+            buckets.append(TokenBucket('embeddings-tokens', tpm, tpm))
+        return buckets
+
+    def _wait_for_budget(self, tokens: int):
+        waited = 0.0
+        for bucket in self._buckets():
+            needed = 1 if bucket.scope == 'embeddings-requests' else min(tokens, bucket.burst)
+            while True:
+                wait = bucket.consume('global', needed)
+                if not wait:
+                    break
+                time.sleep(wait)
+                waited += wait
+        return waited
+
+    def _wait_out_pause(self) -> float:
+        """Sleep until the rate-limit pause set by any dispatcher is over"""
+        waited = 0.0
+        while True:
+            with self._cond:
+                wait = self._paused_until - time.monotonic()
+            if wait <= 0:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+    def _dispatch_forever(self):
+        while True:
+            with self._cond:
+                while not self._jobs:
+                    self._cond.wait()
+                texts, owners, tokens = self._next_batch()
+                self._in_flight += 1
+            try:
+                self._send(texts, owners, tokens)
+            except Exception as exc:
+                # Budget (cache) errors and malformed responses too; the thread lives on
+                self._fail(owners, exc)
+            finally:
+                with self._cond:
+                    self._in_flight -= 1
+
+    def _send(self, texts, owners, tokens):
+        """Embed one batch and resolve its finished jobs; raises when the batch fails"""
+        attempt = 0
+        while True:
+            waited = self._wait_for_budget(tokens)
+            # Last, so a pause that started while waiting for budget is honoured too
+            waited += self._wait_out_pause()
+            with self._cond:
+                self._counters['budget_wait_seconds'] += waited
+            try:
+                vectors = self._embed_batch(texts)
+                break
+            except RateLimitError as exc:
+                attempt += 1
+                with self._cond:
+                    self._counters['rate_limited'] += 1
+                    if attempt <= settings.EMBEDDING_MAX_RETRIES:
+                        pause_end = time.monotonic() + self._retry_after(exc, attempt)
+                        self._paused_until = max(self._paused_until, pause_end)
+                if attempt > settings.EMBEDDING_MAX_RETRIES:
+                    raise
+        if len(vectors) != len(texts):
+            raise ValueError(f"Embeddings API returned {len(vectors)} vectors for {len(texts)} texts")
+
+        finished = []
+        with self._cond:
+            self._counters['batches'] += 1
+            self._counters['texts'] += len(texts)
+            self._counters['tokens'] += tokens
+            for (job, position), vector in zip(owners, vectors):
+                job.vectors[position] = vector
+                job.remaining -= 1
+                if job.remaining == 0:
+                    finished.append(job)
+        for job in finished:
+            if not job.future.done():
+                job.future.set_result(job.vectors)
+
+    def _fail(self, owners, exc):
+        failed = {id(job): job for job, _ in owners}
+        with self._cond:
+            self._counters['failed_batches'] += 1
+            # Their other texts would be wasted work
+            self._jobs = [job for job in self._jobs if id(job) not in failed]
+        logger.warning("Embedding batch of %d texts failed: %s", len(owners), exc)
+        for job in failed.values():
+            if not job.future.done():
+                job.future.set_exception(exc)
+
+    @staticmethod
+    def _retry_after(exc, attempt: int) -> float:
+        response = getattr(exc, 'response', None)
+        header = response.headers.get('retry-after') if response is not None else None
+        try:
+            return max(0.0, float(header))
+        except (TypeError, ValueError):
+            return min(60.0, 2.0 ** attempt)
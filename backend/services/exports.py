@@ -0,0 +1,93 @@
+"""
+Streaming NDJSON exports of document chunks and conversations.
+
+Rows are read with server-side cursors (``.iterator(chunk_size=...)``) and
+written out as they arrive, grouped into blocks of about ``BLOCK_BYTES``, so
+a worker holds one block and one cursor batch however large the export is.
+
+Embeddings are optional; when included they are read as the database's JSON
+text and embedded verbatim, never parsed into Python lists.
+"""
+
+from typing import Dict, Iterable, Iterator
+
+import orjson
+from django.db.models import TextField
+from django.db.models.functions import Cast
+
+from chatbots.models import Message
+from documents.models import DocumentChunk
+from ragbot_backend.renderers import dumps
+from services.message_archive import CONVERSATION_FIELDS, MESSAGE_FIELDS
+
+ITERATOR_CHUNK_SIZE = 2000
+BLOCK_BYTES = 64 * 1024
+
+CHUNK_FIELDS = ['id', 'document_id', 'document__file_name', 'chunk_index', 'content', 'metadata']
+
+
+def ndjson_blocks(rows: Iterable[Dict]) -> Iterator[bytes]:
+    """Serialize ``rows`` one per line, yielding roughly ``BLOCK_BYTES`` at a time"""
+    block, size = [], 0
+    for row in rows:
+        line = dumps(row) + b'\n'
+        block.append(line)
+        size += len(line)
+        if size >= BLOCK_BYTES:
+            yield b''.join(block)
+            block, size = [], 0
+    if block:
+        yield b''.join(block)
+
+
+def iter_chunks(chunks, include_embeddings: bool = False) -> Iterator[Dict]:
+    """Rows of a ``DocumentChunk`` queryset, in document and chunk order"""
+    fields = list(CHUNK_FIELDS)
+    queryset = chunks.order_by('document_id', 'chunk_index')
+    if include_embeddings:
+        queryset = queryset.annotate(embedding_json=Cast('embedding', TextField()))
+        fields.append('embedding_json')
+    for row in queryset.values(*fields).iterator(chunk_size=ITERATOR_CHUNK_SIZE):
+        row['document'] = row.pop('document__file_name')
+        if include_embeddings:
+            raw = row.pop('embedding_json')
+            row['embedding'] = orjson.Fragment(raw) if raw is not None else None
+        yield row
+
+
+def iter_conversations(conversations) -> Iterator[Dict]:
+    """
+    A ``conversation`` line per conversation, followed by its ``message`` lines.
+
+    Conversations and messages are read by two cursors in conversation order
+    and merged, rather than one message query per conversation.
+    """
+    conversations = conversations.order_by('id')
+    messages = (
+        Message.objects.filter(conversation__in=conversations.values('id'))
+        .order_by('conversation_id', 'created_at', 'id')
+        .values(*MESSAGE_FIELDS)
+        .iterator(chunk_size=ITERATOR_CHUNK_SIZE)
+    )
+    pending = next(messages, None)
+    for conversation in conversations.values(*CONVERSATION_FIELDS).iterator(chunk_size=ITERATOR_CHUNK_SIZE):
+        yield {'type': 'conversation', **conversation}
+        # Skip messages of conversations created after the conversation cursor opened
+        while pending is not None and pending['conversation_id'] < conversation['id']:
+            pending = next(messages, None)
+        while pending is not None and pending['conversation_id'] == conversation['id']:
+            yield {'type': 'message', **pending}
+            pending = next(messages, None)
+
+
+def chunks_ndjson(chunks, include_embeddings: bool = False) -> Iterator[bytes]:
+    return ndjson_blocks(iter_chunks(chunks, include_embeddings))
+
+
+def conversations_ndjson(conversations) -> Iterator[bytes]:
+    return ndjson_blocks(iter_conversations(conversations))
+
+
+def chatbot_chunks(chatbot):
+    """Chunks of ``chatbot``'s documents that are not deleted"""
+    return DocumentChunk.objects.filter(document__chatbot=chatbot, document__deleted_at__isnull=True)
@@ -0,0 +1,232 @@
+"""
+Conversation retention: archival to compressed NDJSON and message partition upkeep.
+
+Chatbots with ``message_retention_days`` set have conversations that were
+inactive for longer archived and deleted. Each batch of conversations is
+locked, written to ``CONVERSATION_ARCHIVE_DIR/chatbot_<id>/<run>.ndjson.gz``
+(one gzip member per batch, one conversation with its messages per line),
+fsynced and deleted in its own short transaction. Conversations locked by a
+running chat turn are skipped and picked up by the next run.
+
+On PostgreSQL ``messages`` is range-partitioned by month (see migration
+``chatbots.0008``). Upcoming months get their partitions here, and old
+partitions left empty by archival are dropped instead of vacuumed. Rows of a
+month whose partition was not created in time land in the default partition;
+the next run creates that month's partition and moves them into it.
+"""
+
+import gzip
+import json
+import logging
+import os
+from datetime import date, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+from django.utils import timezone
+
+from chatbots.models import Chatbot, Conversation, Message
+
+logger = logging.getLogger(__name__)
+
+MESSAGES_TABLE = Message._meta.db_table
+PARTITION_PREFIX = f'{MESSAGES_TABLE}_p'
+DEFAULT_PARTITION = f'{MESSAGES_TABLE}_default'
+CONVERSATION_FIELDS = ['id', 'chatbot_id', 'user_id', 'title', 'created_at', 'updated_at']
+MESSAGE_FIELDS = [
+    'conversation_id', 'id', 'role', 'content', 'context_chunk_ids', 'context_scores', 'tokens_used',
+    'prompt_tokens_saved', 'degraded_paths', 'created_at',
+]
+
+
+def _next_month(day: date) -> date:
+    return date(day.year + 1, 1, 1) if day.month == 12 else date(day.year, day.month + 1, 1)
+
+
+def messages_partitioned() -> bool:
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = %s::regclass", [MESSAGES_TABLE])
+        row = cursor.fetchone()
+    return bool(row) and row[0] == 'p'
+
+
+def message_partitions() -> List[str]:
+    """Monthly partitions of ``messages``, oldest first"""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = %s::regclass AND c.relname LIKE %s
+            ORDER BY c.relname
+            """,
+            [MESSAGES_TABLE, PARTITION_PREFIX.replace('_', r'\_') + '%'],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def _default_partition_months() -> List[date]:
+    """Months that have rows in the default partition"""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT to_regclass(%s)", [DEFAULT_PARTITION])
+        if cursor.fetchone()[0] is None:
+            return []
+        cursor.execute(f"SELECT DISTINCT date_trunc('month', created_at)::date FROM {DEFAULT_PARTITION} ORDER BY 1")
+        return [row[0] for row in cursor.fetchall()]
+
+
+def _create_partition(name: str, start: date, end: date, move_from_default: bool) -> None:
+    bounds = f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+    with transaction.atomic(), connection.cursor() as cursor:
+        if not move_from_default:
+            cursor.execute(f"CREATE TABLE {name} PARTITION OF {MESSAGES_TABLE} {bounds}")
+            return
+        # A new range can't overlap rows already in the default partition; detaching
+        # it locks messages until the rows are moved and it is attached again
+        cursor.execute(f'ALTER TABLE {MESSAGES_TABLE} DETACH PARTITION {DEFAULT_PARTITION}')
+        cursor.execute(f"CREATE TABLE {name} PARTITION OF {MESSAGES_TABLE} {bounds}")
+        cursor.execute(
+            f'WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE created_at >= %s AND created_at < %s RETURNING *) '
+            f'INSERT INTO {name} SELECT * FROM moved',
+            [start, end],
+        )
+        cursor.execute(f'ALTER TABLE {MESSAGES_TABLE} ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT')
+
+
+def ensure_message_partitions(months_ahead: int = 3, today: Optional[date] = None) -> List[str]:
+    """
+    Create missing partitions from this month to ``months_ahead`` months out.
+
+    Months with rows in the default partition get theirs too, and the rows
+    are moved into it.
+    """
+    if not messages_partitioned():
+        return []
+    existing = set(message_partitions())
+    stranded = set(_default_partition_months())
+    months = set(stranded)
+    start = (today or timezone.now().date()).replace(day=1)
+    for _ in range(months_ahead + 1):
+        months.add(start)
+        start = _next_month(start)
+
+    created = []
+    for start in sorted(months):
+        name = f'{PARTITION_PREFIX}{start:%Y_%m}'
+        if name in existing:
+            continue
+        try:
+            _create_partition(name, start, _next_month(start), move_from_default=start in stranded)
+            created.append(name)
+        except Exception:
+            logger.exception("Could not create message partition %s", name)
+    return created
+
+
+def drop_empty_partitions(today: Optional[date] = None) -> List[str]:
+    """Drop monthly partitions before the current month that hold no rows"""
+    if not messages_partitioned():
+        return []
+    current = f'{PARTITION_PREFIX}{(today or timezone.now().date()):%Y_%m}'
+    dropped = []
+    for name in message_partitions():
+        if name >= current:
+            break
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f'SELECT EXISTS (SELECT 1 FROM {name})')
+            if cursor.fetchone()[0]:
+                continue
+            cursor.execute(f'ALTER TABLE {MESSAGES_TABLE} DETACH PARTITION {name}')
+            cursor.execute(f'DROP TABLE {name}')
+        dropped.append(name)
+    return dropped
+
+
+def _archive_dir() -> Path:
+    return Path(settings.CONVERSATION_ARCHIVE_DIR)
+
+
+def _write_batch(path: Path, conversations: List[Dict]) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Appending a gzip member per batch keeps the file valid after every batch
+    with open(path, 'ab') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb') as target:
+            for conversation in conversations:
+                target.write(json.dumps(conversation, cls=DjangoJSONEncoder).encode('utf-8') + b'\n')
+        raw.flush()
+        os.fsync(raw.fileno())
+
+
+def archive_chatbot(
+        chatbot: Chatbot,
+        now=None,
+        batch_size: int = 100,
+        dry_run: bool = False
+) -> Dict:
+    """Archive and delete ``chatbot``'s conversations past its retention period"""
+    now = now or timezone.now()
+    cutoff = now - timedelta(days=chatbot.message_retention_days)
+    expired = Conversation.objects.filter(chatbot=chatbot, updated_at__lt=cutoff)
+    path = _archive_dir() / f'chatbot_{chatbot.id}' / f'{now:%Y%m%d-%H%M%S}.ndjson.gz'
+    summary = {'chatbot_id': chatbot.id, 'conversations': 0, 'messages': 0, 'file': None}
+
+    if dry_run:
+        summary['conversations'] = expired.count()
+        summary['messages'] = Message.objects.filter(conversation__in=expired).count()
+        return summary
+
+    last_id = 0
+    while True:
+        with transaction.atomic():
+            # Row locks on this batch only; conversations in use are left for the next run
+            ids = list(
+                expired.filter(id__gt=last_id).order_by('id')
+                .select_for_update(skip_locked=True)
+                .values_list('id', flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+            last_id = ids[-1]
+
+            conversations = {
+                row['id']: {**row, 'messages': []}
+                for row in Conversation.objects.filter(id__in=ids).values(*CONVERSATION_FIELDS)
+            }
+            messages = Message.objects.filter(conversation_id__in=ids).order_by('conversation_id', 'created_at', 'id')
+            for row in messages.values(*MESSAGE_FIELDS).iterator(chunk_size=2000):
+                conversations[row.pop('conversation_id')]['messages'].append(row)
+                summary['messages'] += 1
+
+            _write_batch(path, [conversations[i] for i in ids])
+            Conversation.objects.filter(id__in=ids).delete()
+
+        summary['conversations'] += len(ids)
+        summary['file'] = str(path)
+
+    return summary
+
+
+def archive_expired_conversations(
+        chatbot_ids: Optional[List[int]] = None,
+        batch_size: int = 100,
+        dry_run: bool = False
+) -> List[Dict]:
+    """Apply every chatbot's retention policy, then maintain message partitions"""
+    now = timezone.now()
+    chatbots = Chatbot.objects.filter(message_retention_days__isnull=False).order_by('id')
+    if chatbot_ids:
+        chatbots = chatbots.filter(id__in=chatbot_ids)
+    results = [
+        archive_chatbot(chatbot, now=now, batch_size=batch_size, dry_run=dry_run)
+        for chatbot in chatbots
+    ]
+    if not dry_run:
+        created = ensure_message_partitions(settings.MESSAGE_PARTITION_MONTHS_AHEAD, now.date())
+        dropped = drop_empty_partitions(now.date())
+        if created or dropped:
+            logger.info("Message partitions created: %s; dropped: %s", created, dropped)
+    return results
@@ -1,15 +1,37 @@
 import os
 import json
-from typing import List, Dict, Optional
+import logging
+import re
+from functools import reduce
+from operator import or_
+from typing import Iterator, List, Dict, Optional
 from django.conf import settings
-from openai import OpenAI
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db.models import F
+from openai import APITimeoutError, OpenAI
 from langchain_openai import OpenAIEmbeddings
 import PyPDF2
 from docx import Document as DocxDocument
 from django.utils import timezone
 from documents.models import Document, DocumentChunk
 from chatbots.models import Chatbot
+from documents.upload_handlers import file_sha256
+from services import answer_cache, snapshots, text_cache, vector_index
+from services.deadline import (
+    CACHED_ANSWER, FEWER_CHUNKS, LEXICAL_RETRIEVAL, REDUCED_MAX_TOKENS, Deadline, DeadlineExceeded,
+)
+from services.chat_scheduler import FairScheduler, QueueTimeout
+from services.coalescing import Coalescer, FlightTimeout
+from services.embedding_scheduler import INTERACTIVE, EmbeddingScheduler
+from services.text_splitter import TokenTextSplitter, count_tokens
+
+
+logger = logging.getLogger(__name__)
+
+# Candidates scored per requested chunk when MMR re-ranking is enabled
+RERANK_SHORTLIST_FACTOR = 4
+# Words of a question used for lexical retrieval
+LEXICAL_MAX_TERMS = 32
 
 
 class RAGService:
@@ -21,79 +43,167 @@ class RAGService:
             raise ValueError("OPENAI_API_KEY not found in environment variables")
 
         self.client = OpenAI(api_key=api_key)
-        self.embeddings_model = OpenAIEmbeddings(openai_api_key=api_key)
-
-        # Text splitter configuration
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=500,  # Characters per chunk
-            chunk_overlap=50,  # Overlap to maintain context
-            length_function=len,
-            separators=["\n\n", "\n", " ", ""]
+        # embedding_scheduler retries 429s itself; client retries would multiply them.
+        # The request timeout also ends query embeddings a chat deadline gave up on
+        self.embeddings_model = OpenAIEmbeddings(
+            openai_api_key=api_key, max_retries=0, request_timeout=settings.EMBEDDING_REQUEST_TIMEOUT_SECONDS
+        )
+        # Document chunks from all concurrent ingestions share one rate-limited queue
+        self.embedding_scheduler = EmbeddingScheduler(lambda texts: self.embeddings_model.embed_documents(texts))
+        # Identical first-turn questions in flight at the same time share one answer
+        self.answer_flights = Coalescer('chat-answer')
+        # Answers take a slot per chatbot owner so one tenant's burst can't starve the rest
+        self.chat_scheduler = FairScheduler()
+
+    def get_text_splitter(self, chatbot: Chatbot) -> TokenTextSplitter:
+        """Token-based splitter sized by the chatbot's chunking settings"""
+        return TokenTextSplitter(
+            chunk_size=chatbot.chunk_size,
+            chunk_overlap=chatbot.chunk_overlap
         )
-
 
     def extract_text_from_file(self, file_path: str, file_type: str) -> str:
         """Extract text from different file types"""
+        return "".join(self.iter_text_from_file(file_path, file_type))
+
+    def iter_text_from_file(self, file_path: str, file_type: str) -> Iterator[str]:
+        """Yield the text of a file block by block (pages, paragraphs or reads)"""
         try:
             if file_type == 'pdf':
-                return self._extract_from_pdf(file_path)
+                yield from self._join_blocks(self._extract_from_pdf(file_path))
             elif file_type == 'docx':
-                return self._extract_from_docx(file_path)
+                yield from self._join_blocks(self._extract_from_docx(file_path))
             elif file_type in ['txt', 'md']:
-                return self._extract_from_text(file_path)
+                yield from self._extract_from_text(file_path)
             else:
                 raise ValueError(f"Unsupported file type: {file_type}")
         except Exception as e:
             raise Exception(f"Failed to extract text: {str(e)}")
 
-    def _extract_from_pdf(self, file_path: str) -> str:
+    def _join_blocks(self, blocks: Iterator[str]) -> Iterator[str]:
+        first = True
+        for block in blocks:
+            if not first:
+                yield "\n\n"
+            yield block
+            first = False
+
+    def _extract_from_pdf(self, file_path: str) -> Iterator[str]:
 
-        text = []
         with open(file_path, 'rb') as file:
             pdf_reader = PyPDF2.PdfReader(file)
             for page in pdf_reader.pages:
                 page_text = page.extract_text()
                 if page_text:
-                    text.append(page_text)
-        return "\n\n".join(text)
+                    yield page_text
 
-    def _extract_from_docx(self, file_path: str) -> str:
+    def _extract_from_docx(self, file_path: str) -> Iterator[str]:
 
         doc = DocxDocument(file_path)
-        text = []
         for paragraph in doc.paragraphs:
             if paragraph.text.strip():
-                text.append(paragraph.text)
-        return "\n\n".join(text)
+                yield paragraph.text
 
-    def _extract_from_text(self, file_path: str) -> str:
+    def _extract_from_text(self, file_path: str, block_size: int = 1024 * 1024) -> Iterator[str]:
 
         with open(file_path, 'r', encoding='utf-8') as file:
-            return file.read()
+            while True:
+                block = file.read(block_size)
+                if not block:
+                    break
+                yield block
+
+    def iter_document_text(self, document: Document) -> Iterator[str]:
+        """Text blocks of a document, from the extracted-text cache when possible"""
+        cached = text_cache.cached_blocks(document.content_hash)
+        if cached is not None:
+            return cached
+        blocks = self.iter_text_from_file(document.file.path, document.file_type)
+        return text_cache.caching(document.content_hash, blocks)
+
+    def find_reusable_document(self, document: Document) -> Optional[Document]:
+        """A processed copy of the same file, chunked with the same settings"""
+        if not document.content_hash:
+            return None
+        chatbot = document.chatbot
+        return (
+            Document.objects
+            .filter(
+                content_hash=document.content_hash,
+                status='completed',
+                chunk_count__gt=0,
+                chatbot__chunk_size=chatbot.chunk_size,
+                chatbot__chunk_overlap=chatbot.chunk_overlap,
+            )
+            .exclude(id=document.id)
+            .order_by('-processed_at')
+            .first()
+        )
+
+    def process_document(self, document_id: int, reuse_chunks: bool = True, priority: int = INTERACTIVE) -> Dict:
+        """
+        Extract, chunk and embed a document.
 
-    def process_document(self, document_id: int) -> Dict:
+        If an identical file was already processed with the same chunking
+        settings (in any chatbot) its chunks and embeddings are copied in the
+        database instead, without extraction or embedding calls. Pass
+        ``reuse_chunks=False`` to force new embeddings. Chunks are embedded
+        through ``embedding_scheduler`` at the given ``priority``.
+        """
+        try:
+            document = Document.objects.select_related('chatbot').get(id=document_id)
+        except Document.DoesNotExist:
+            # Deleted before processing started
+            return {'success': False, 'document_id': document_id, 'error': 'Document not found'}
 
         try:
-            document = Document.objects.get(id=document_id)
             document.status = 'processing'
             document.save()
 
-            file_path = document.file.path
-            text = self.extract_text_from_file(file_path, document.file_type)
+            if not document.content_hash:
+                # Uploaded before hashes were recorded
+                with document.file.open('rb') as source:
+                    document.content_hash = file_sha256(source)
+                document.save(update_fields=['content_hash'])
+
+            source = self.find_reusable_document(document) if reuse_chunks else None
+            if source is not None:
+                chunk_count = snapshots.copy_chunks([(source.id, document.id)])
+
+                document.status = 'completed'
+                document.chunk_count = chunk_count
+                document.processed_at = timezone.now()
+                document.save()
+                vector_index.refresh(document.chatbot_id)
+
+                return {
+                    'success': True,
+                    'document_id': document_id,
+                    'chunks_created': chunk_count,
+                    'reused_from': source.id
+                }
+
+            total_characters = 0
+
+            def counted(blocks):
+                nonlocal total_characters
+                for block in blocks:
+                    total_characters += len(block)
+                    yield block
+
+            # Stream the extracted text straight through the splitter
+            splitter = self.get_text_splitter(document.chatbot)
+            chunks = list(splitter.iter_chunks(
+                counted(self.iter_document_text(document))
+            ))
 
-            if not text.strip():
+            if not chunks:
                 raise ValueError("No text could be extracted from document")
 
-            chunks = self.text_splitter.split_text(text)
-
-            if not chunks:
-                raise ValueError("Document splitting produced no chunks")
+            embeddings = self.embedding_scheduler.embed(chunks, priority=priority)
 
             document_chunks = []
-            for idx, chunk_text in enumerate(chunks):
-                # Generate embedding for this chunk
-                embedding = self.embeddings_model.embed_query(chunk_text)
-
+            for idx, (chunk_text, embedding) in enumerate(zip(chunks, embeddings)):
                 chunk = DocumentChunk(
                     document=document,
                     content=chunk_text,
@@ -101,6 +211,7 @@ class RAGService:
                     embedding=embedding,
                     metadata={
                         'char_count': len(chunk_text),
+                        'token_count': count_tokens(chunk_text),
                         'chunk_number': idx + 1,
                         'total_chunks': len(chunks)
                     }
@@ -114,11 +225,14 @@ class RAGService:
             document.processed_at = timezone.now()
             document.save()
 
+            # Swap in the chatbot's new shared index version for all workers
+            vector_index.refresh(document.chatbot_id)
+
             return {
                 'success': True,
                 'document_id': document_id,
                 'chunks_created': len(chunks),
-                'total_characters': len(text)
+                'total_characters': total_characters
             }
 
         except Exception as e:
@@ -134,104 +248,229 @@ class RAGService:
             }
 
 
-    def cosine_similarity(self, vec1: List[float], vec2: List[float]) -> float:
-
-        import math
-
-        dot_product = sum(a * b for a, b in zip(vec1, vec2))
-        magnitude1 = math.sqrt(sum(a * a for a in vec1))
-        magnitude2 = math.sqrt(sum(b * b for b in vec2))
-
-        if magnitude1 == 0 or magnitude2 == 0:
-            return 0.0
-
-        return dot_product / (magnitude1 * magnitude2)
-
     def retrieve_relevant_chunks(
             self,
             chatbot_id: int,
             query: str,
-            top_k: int = 5
+            top_k: int = 5,
+            filters: Optional[Dict] = None,
+            rerank: Optional[Dict] = None
     ) -> List[Dict]:
+        """
+        Score the chatbot's chunks against ``query`` and return the best ``top_k``.
+
+        ``filters`` narrows the search to some documents (``document_ids``,
+        ``file_types``, ``uploaded_after``, ``uploaded_before``); only the
+        matching document segments of the index are scored.
+        """
+        return self.retrieve_many(chatbot_id, [query], top_k=top_k, filters=filters, rerank=rerank)[0]['chunks']
+
+    def rerank_options(self, chatbot: Chatbot) -> Optional[Dict]:
+        """The chatbot's MMR / duplicate-collapse settings, or None when both are off"""
+        options = {
+            'mmr_lambda': chatbot.mmr_lambda if chatbot.mmr_enabled else None,
+            'duplicate_threshold': chatbot.duplicate_threshold or None,
+        }
+        return options if any(value is not None for value in options.values()) else None
+
+    def retrieve_many(
+            self,
+            chatbot_id: int,
+            queries: List[str],
+            top_k: int = 5,
+            filters: Optional[Dict] = None,
+            rerank: Optional[Dict] = None,
+            index: Optional[vector_index.ChatbotIndex] = None,
+            query_embeddings: Optional[List[List[float]]] = None
+    ) -> List[Dict]:
+        """
+        Retrieve for several queries with one embedding call and one matrix product.
+
+        Returns one ``{'chunks': [...], 'prompt_tokens_saved': n}`` per query.
+        With ``rerank`` (see ``rerank_options``) a shortlist of
+        ``RERANK_SHORTLIST_FACTOR * top_k`` chunks is re-ranked; the tokens
+        saved are those of the plain top ``top_k`` minus those kept. Pass
+        ``index`` and ``query_embeddings`` when the caller already has them.
+        """
+        if index is None:
+            index = vector_index.get_index(chatbot_id)
+        if not len(index) or not queries:
+            return [{'chunks': [], 'prompt_tokens_saved': 0} for _ in queries]
+
+        if query_embeddings is None and len(queries) == 1:
+            query_embeddings = [self.embeddings_model.embed_query(queries[0])]
+        elif query_embeddings is None:
+            query_embeddings = self.embeddings_model.embed_documents(queries)
+
+        mmr_lambda = rerank.get('mmr_lambda') if rerank else None
+        shortlist_size = top_k * RERANK_SHORTLIST_FACTOR if mmr_lambda is not None else top_k
+        selections = []
+        for rows, scores in index.shortlist_many(query_embeddings, shortlist_size, filters=filters):
+            if rerank:
+                picks = index.rerank(rows, scores, top_k, mmr_lambda, rerank.get('duplicate_threshold'))
+            else:
+                picks = slice(0, top_k)
+            selections.append((
+                index.chunk_ids[rows[:top_k]].tolist(),
+                list(zip(index.chunk_ids[rows[picks]].tolist(), scores[picks].tolist())),
+            ))
+
+        chunk_ids = {chunk_id for baseline, picked in selections for chunk_id in baseline}
+        chunk_ids.update(chunk_id for _, picked in selections for chunk_id, _ in picked)
+        # A document deleted since the index was built must not leak into answers
+        chunks = (
+            DocumentChunk.objects.filter(document__deleted_at__isnull=True)
+            .select_related('document').in_bulk(chunk_ids)
+        )
 
-        query_embedding = self.embeddings_model.embed_query(query)
-
-        # Step 2: Get all chunks for this chatbot's documents
-        chatbot = Chatbot.objects.get(id=chatbot_id)
-        all_chunks = DocumentChunk.objects.filter(
-            document__chatbot=chatbot,
-            document__status='completed'
-        ).select_related('document')
-
-        if not all_chunks.exists():
+        results = []
+        for baseline, picked in selections:
+            results.append({
+                'chunks': [
+                    {
+                        'chunk': chunks[chunk_id],
+                        'similarity': similarity,
+                        'content': chunks[chunk_id].content,
+                        'document_name': chunks[chunk_id].document.file_name,
+                        'metadata': chunks[chunk_id].metadata
+                    }
+                    for chunk_id, similarity in picked
+                    if chunk_id in chunks
+                ],
+                'prompt_tokens_saved': (
+                    sum(self._chunk_tokens(chunks.get(chunk_id)) for chunk_id in baseline)
+                    - sum(self._chunk_tokens(chunks.get(chunk_id)) for chunk_id, _ in picked)
+                ) if rerank else 0,
+            })
+        return results
+
+    def lexical_search(
+            self,
+            chatbot_id: int,
+            query: str,
+            top_k: int = 5,
+            filters: Optional[Dict] = None
+    ) -> List[Dict]:
+        """
+        Full-text retrieval that needs no query embedding.
+
+        Chunks matching any word of ``query`` are ranked with ``ts_rank``
+        through the ``document_chunks_content_fts`` index. Results have the
+        shape of ``retrieve_many``'s chunks, with the rank as similarity.
+        """
+        terms = re.findall(r'\w+', query)[:LEXICAL_MAX_TERMS]
+        if not terms:
             return []
+        search_query = reduce(or_, (SearchQuery(term, config='english') for term in terms))
 
-        chunk_scores = []
-        for chunk in all_chunks:
-            if chunk.embedding:
-                similarity = self.cosine_similarity(query_embedding, chunk.embedding)
-                chunk_scores.append({
-                    'chunk': chunk,
-                    'similarity': similarity,
-                    'content': chunk.content,
-                    'document_name': chunk.document.file_name,
-                    'metadata': chunk.metadata
-                })
-
-        chunk_scores.sort(key=lambda x: x['similarity'], reverse=True)
-        return chunk_scores[:top_k]
+        chunks = DocumentChunk.objects.filter(
+            document__chatbot_id=chatbot_id, document__status='completed', document__deleted_at__isnull=True
+        )
+        filters = filters or {}
+        if filters.get('document_ids') is not None:
+            chunks = chunks.filter(document_id__in=filters['document_ids'])
+        if filters.get('file_types') is not None:
+            chunks = chunks.filter(document__file_type__in=filters['file_types'])
+        if filters.get('uploaded_after') is not None:
+            chunks = chunks.filter(document__uploaded_at__gte=filters['uploaded_after'])
+        if filters.get('uploaded_before') is not None:
+            chunks = chunks.filter(document__uploaded_at__lt=filters['uploaded_before'])
+
+        chunks = (
+            chunks.annotate(search=SearchVector('content', config='english'))
+            .filter(search=search_query)
+            .annotate(rank=SearchRank(F('search'), search_query))
+            .select_related('document')
+            .order_by('-rank', 'id')[:top_k]
+        )
+        return [
+            {
+                'chunk': chunk,
+                'similarity': chunk.rank,
+                'content': chunk.content,
+                'document_name': chunk.document.file_name,
+                'metadata': chunk.metadata
+            }
+            for chunk in chunks
+        ]
 
+    def _chunk_tokens(self, chunk: Optional[DocumentChunk]) -> int:
+        if chunk is None:
+            return 0
+        return chunk.metadata.get('token_count') or count_tokens(chunk.content)
 
     def generate_response(
             self,
             chatbot: Chatbot,
             user_message: str,
-            conversation_history: Optional[List[Dict]] = None
+            conversation_history: Optional[List[Dict]] = None,
+            retrieval_filter: Optional[Dict] = None,
+            deadline: Optional[Deadline] = None
     ) -> Dict:
-
+        """
+        Retrieve context for ``user_message`` and answer it.
+
+        With a ``deadline`` the query embedding and the completion are bounded
+        by the budget left, and degraded fast paths are taken as it runs out
+        (see ``services.deadline``). The result's ``degraded`` lists them;
+        ``timed_out`` is set when not even a cached answer fit the budget.
+
+        First-turn questions identical to one already being answered wait
+        for that answer instead (see ``services.coalescing``); their result
+        has ``coalesced`` set and no tokens of its own.
+
+        Answers are computed in one of the owner's ``chat_scheduler`` slots,
+        held until calls abandoned at the deadline finish; ``queue_timeout``
+        is set when none was free in time.
+        """
         try:
-            #  Retrieve relevant chunks
-            relevant_chunks = self.retrieve_relevant_chunks(
-                chatbot_id=chatbot.id,
-                query=user_message,
-                top_k=5
-            )
-
-            context = self._build_context(relevant_chunks)
-
-
-            prompt = self._build_prompt(
-                system_prompt=chatbot.system_prompt,
-                context=context,
-                user_message=user_message,
-                conversation_history=conversation_history
-            )
-
-            #  Call OpenAI
-            response = self.client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=prompt,
-                temperature=chatbot.temperature,
-                max_tokens=chatbot.max_tokens
-            )
-
-            ai_message = response.choices[0].message.content
-            tokens_used = response.usage.total_tokens
-
+            index = vector_index.get_index(chatbot.id)
+            # Annotated by chat_endpoint; saves a query for the owner
+            plan = getattr(chatbot, 'owner_plan', None) or chatbot.owner.plan
+            queue_timeout = abandoned = None
+            if deadline is not None:
+                queue_timeout = min(settings.CHAT_QUEUE_TIMEOUT_SECONDS, deadline.remaining())
+                # Calls given up on keep the slot until they actually finish
+                abandoned = deadline.abandoned
+
+            if conversation_history:
+                with self.chat_scheduler.slot(chatbot.owner_id, plan, queue_timeout, abandoned):
+                    return self._respond(chatbot, index, user_message, conversation_history, retrieval_filter, deadline)
+
+            cache_key = answer_cache.answer_key(chatbot, user_message, index.signature, retrieval_filter)
+
+            def respond():
+                with self.chat_scheduler.slot(chatbot.owner_id, plan, queue_timeout, abandoned):
+                    return self._respond(chatbot, index, user_message, None, retrieval_filter, deadline, cache_key)
+
+            try:
+                result, shared = self.answer_flights.run(
+                    cache_key, respond, timeout=deadline.remaining() if deadline else None
+                )
+            except FlightTimeout:
+                if deadline is None:
+                    return respond()
+                return self._cached_answer(deadline, cache_key)
+            if shared:
+                result = {**result, 'tokens_used': 0, 'coalesced': True}
+            return result
+
+        except QueueTimeout as e:
             return {
-                'success': True,
-                'response': ai_message,
-                'tokens_used': tokens_used,
-                'chunks_used': [
-                    {
-                        'document': chunk['document_name'],
-                        'similarity': chunk['similarity'],
-                        'content_preview': chunk['content'][:200] + '...'
-                    }
-                    for chunk in relevant_chunks
-                ]
+                'success': False,
+                'queue_timeout': True,
+                'retry_after': e.retry_after,
+                'error': str(e),
+                'response': "I'm sorry, too many questions are being answered right now. Please try again."
+            }
+        except DeadlineExceeded as e:
+            return {
+                'success': False,
+                'timed_out': True,
+                'error': str(e),
+                'degraded': list(deadline.degraded) if deadline else [],
+                'response': "I'm sorry, I couldn't answer in time. Please try again."
             }
-
         except Exception as e:
             return {
                 'success': False,
@@ -239,6 +478,156 @@ class RAGService:
                 'response': "I'm sorry, I encountered an error processing your request."
             }
 
+    def _respond(
+            self,
+            chatbot: Chatbot,
+            index: vector_index.ChatbotIndex,
+            user_message: str,
+            conversation_history: Optional[List[Dict]],
+            retrieval_filter: Optional[Dict],
+            deadline: Optional[Deadline],
+            cache_key: Optional[str] = None
+    ) -> Dict:
+        """Retrieve and answer within ``deadline``; raises ``DeadlineExceeded`` when out of time"""
+        if deadline is not None and deadline.remaining() < settings.CHAT_LLM_MIN_SECONDS:
+            return self._cached_answer(deadline, cache_key)
+
+        retrieved = self._retrieve_within(deadline, chatbot, index, user_message, retrieval_filter)
+
+        max_tokens = chatbot.max_tokens
+        if deadline is not None:
+            remaining = deadline.remaining()
+            if remaining < settings.CHAT_LLM_MIN_SECONDS:
+                return self._cached_answer(deadline, cache_key)
+            affordable = int(remaining * settings.CHAT_LLM_TOKENS_PER_SECOND)
+            if affordable < max_tokens:
+                max_tokens = affordable
+                deadline.degrade(REDUCED_MAX_TOKENS)
+
+        try:
+            result = self.answer_from_chunks(
+                chatbot, user_message, retrieved['chunks'], conversation_history,
+                max_tokens=max_tokens, deadline=deadline
+            )
+        except (APITimeoutError, DeadlineExceeded):
+            if deadline is None:
+                raise
+            return self._cached_answer(deadline, cache_key)
+
+        result['prompt_tokens_saved'] = retrieved['prompt_tokens_saved']
+        result['degraded'] = list(deadline.degraded) if deadline else []
+        if cache_key and not result['degraded']:
+            answer_cache.store_answer(cache_key, result)
+        elif result['degraded']:
+            logger.info("Chatbot %s answered on degraded paths: %s", chatbot.id, ', '.join(result['degraded']))
+        return result
+
+    def _retrieve_within(
+            self,
+            deadline: Optional[Deadline],
+            chatbot: Chatbot,
+            index: vector_index.ChatbotIndex,
+            query: str,
+            filters: Optional[Dict] = None
+    ) -> Dict:
+        """
+        Retrieve for a single query, within the deadline when there is one.
+
+        The query embedding may use what is left after reserving
+        ``CHAT_LLM_MIN_SECONDS`` for the completion, up to
+        ``CHAT_EMBEDDING_TIMEOUT_SECONDS``; without it retrieval is lexical.
+        Fewer chunks are retrieved once less than
+        ``CHAT_DEGRADE_BELOW_SECONDS`` is left.
+        """
+        rerank = self.rerank_options(chatbot)
+        if deadline is None:
+            return self.retrieve_many(chatbot.id, [query], top_k=5, filters=filters, rerank=rerank, index=index)[0]
+        if not len(index):
+            return {'chunks': [], 'prompt_tokens_saved': 0}
+
+        embedding = None
+        budget = min(deadline.remaining() - settings.CHAT_LLM_MIN_SECONDS, settings.CHAT_EMBEDDING_TIMEOUT_SECONDS)
+        if budget > 0:
+            try:
+                embedding = deadline.call(lambda: self.embeddings_model.embed_query(query), timeout=budget)
+            except DeadlineExceeded:
+                pass
+
+        top_k = 5
+        if deadline.remaining() < settings.CHAT_DEGRADE_BELOW_SECONDS and settings.CHAT_DEGRADED_TOP_K < top_k:
+            top_k = settings.CHAT_DEGRADED_TOP_K
+            deadline.degrade(FEWER_CHUNKS)
+
+        if embedding is None:
+            deadline.degrade(LEXICAL_RETRIEVAL)
+            return {'chunks': self.lexical_search(chatbot.id, query, top_k, filters), 'prompt_tokens_saved': 0}
+        return self.retrieve_many(
+            chatbot.id, [query], top_k=top_k, filters=filters, rerank=rerank, index=index, query_embeddings=[embedding]
+        )[0]
+
+    def _cached_answer(self, deadline: Deadline, cache_key: Optional[str]) -> Dict:
+        """The cached answer to the same question, when the budget is spent"""
+        cached = answer_cache.get_answer(cache_key) if cache_key else None
+        if cached is None:
+            raise DeadlineExceeded(f"No answer within the {deadline.seconds:g}s response deadline")
+        deadline.degrade(CACHED_ANSWER)
+        return {**cached, 'tokens_used': 0, 'prompt_tokens_saved': 0, 'degraded': list(deadline.degraded)}
+
+    def answer_from_chunks(
+            self,
+            chatbot: Chatbot,
+            user_message: str,
+            relevant_chunks: List[Dict],
+            conversation_history: Optional[List[Dict]] = None,
+            max_tokens: Optional[int] = None,
+            deadline: Optional[Deadline] = None
+    ) -> Dict:
+        """
+        Call the LLM with already retrieved chunks; raises on API errors.
+
+        ``max_tokens`` overrides the chatbot's; with a ``deadline`` the call
+        raises ``DeadlineExceeded`` once it runs out.
+        """
+        context = self._build_context(relevant_chunks)
+
+        prompt = self._build_prompt(
+            system_prompt=chatbot.system_prompt,
+            context=context,
+            user_message=user_message,
+            conversation_history=conversation_history
+        )
+
+        #  Call OpenAI
+        options = dict(
+            model="gpt-3.5-turbo",
+            messages=prompt,
+            temperature=chatbot.temperature,
+            max_tokens=max_tokens or chatbot.max_tokens
+        )
+        if deadline is None:
+            response = self.client.chat.completions.create(**options)
+        else:
+            # The client timeout ends an abandoned call shortly after the deadline
+            timeout = deadline.remaining()
+            response = deadline.call(lambda: self.client.chat.completions.create(timeout=timeout, **options))
+
+        return {
+            'success': True,
+            'response': response.choices[0].message.content,
+            'tokens_used': response.usage.total_tokens,
+            'prompt_tokens': response.usage.prompt_tokens,
+            'completion_tokens': response.usage.completion_tokens,
+            'chunks_used': [
+                {
+                    'chunk_id': chunk['chunk'].id,
+                    'document': chunk['document_name'],
+                    'similarity': chunk['similarity'],
+                    'content_preview': chunk['content'][:200] + '...'
+                }
+                for chunk in relevant_chunks
+            ]
+        }
+
     def _build_context(self, relevant_chunks: List[Dict]) -> str:
 
         if not relevant_chunks:
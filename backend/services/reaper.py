@@ -0,0 +1,177 @@
+"""
+Background removal of soft-deleted chatbots, documents and conversations.
+
+Deleting a chatbot, document or conversation through the API only sets its
+``deleted_at`` (a chatbot's documents and conversations are marked with it):
+the default managers hide it at once and retrieval skips the chunks of
+deleted documents. The reaper then deletes the chunks or messages in batches
+of ``REAP_BATCH_SIZE`` rows, each batch its own short statement, before
+deleting the parent row itself and, for documents, the uploaded file. A
+chatbot row goes last, once none of its documents or conversations is left.
+
+Queryset deletes bypass ``Document.delete`` and leave files behind;
+``remove_orphaned_files`` sweeps ``MEDIA_ROOT/documents`` for files no
+document row references.
+"""
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from pathlib import Path
+from typing import Dict, List
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import connections, transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from chatbots.models import Chatbot, Conversation, Message
+from documents.models import Document, DocumentChunk
+from services import vector_index
+
+logger = logging.getLogger(__name__)
+
+# Documents still being processed are left alone for this long after their last update
+PROCESSING_GRACE = timedelta(hours=1)
+UPLOAD_DIR = 'documents'
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='reaper')
+_pending = threading.Event()
+
+
+def delete_in_batches(queryset, batch_size: int) -> int:
+    """Delete the rows of ``queryset`` ``batch_size`` at a time; returns the number deleted"""
+    model = queryset.model
+    deleted = 0
+    while True:
+        ids = list(queryset.order_by().values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        count, _ = model._base_manager.filter(pk__in=ids).delete()
+        deleted += count
+
+
+def _delete_file(name: str) -> bool:
+    """Remove an uploaded file unless another document (e.g. a clone) still references it"""
+    if not name or Document.all_objects.filter(file=name).exists():
+        return False
+    default_storage.delete(name)
+    return True
+
+
+def reap_documents(batch_size: int) -> Dict:
+    now = timezone.now()
+    deleted = (
+        Document.all_objects.filter(deleted_at__isnull=False)
+        .exclude(status='processing', updated_at__gt=now - PROCESSING_GRACE)
+        .order_by('id')
+    )
+    summary = {'documents': 0, 'chunks': 0, 'files': 0}
+    for document_id, file_name in deleted.values_list('id', 'file'):
+        summary['chunks'] += delete_in_batches(DocumentChunk.objects.filter(document_id=document_id), batch_size)
+        # Only the row is left; its cascade finds no chunks
+        with transaction.atomic():
+            Document.all_objects.filter(id=document_id).delete()
+        summary['documents'] += 1
+        summary['files'] += _delete_file(file_name)
+    return summary
+
+
+def reap_conversations(batch_size: int) -> Dict:
+    deleted = Conversation.all_objects.filter(deleted_at__isnull=False).order_by('id')
+    summary = {'conversations': 0, 'messages': 0}
+    for conversation_id in deleted.values_list('id', flat=True):
+        summary['messages'] += delete_in_batches(Message.objects.filter(conversation_id=conversation_id), batch_size)
+        with transaction.atomic():
+            Conversation.all_objects.filter(id=conversation_id).delete()
+        summary['conversations'] += 1
+    return summary
+
+
+def reap_chatbots() -> Dict:
+    """Delete soft-deleted chatbots whose documents and conversations are already reaped"""
+    deleted = (
+        Chatbot.all_objects.filter(deleted_at__isnull=False)
+        .exclude(Exists(Document.all_objects.filter(chatbot=OuterRef('pk'))))
+        .exclude(Exists(Conversation.all_objects.filter(chatbot=OuterRef('pk'))))
+        .order_by('id')
+    )
+    summary = {'chatbots': 0}
+    for chatbot_id in deleted.values_list('id', flat=True):
+        with transaction.atomic():
+            Chatbot.all_objects.filter(id=chatbot_id).delete()
+        vector_index.discard(chatbot_id)
+        summary['chatbots'] += 1
+    return summary
+
+
+def remove_orphaned_files(grace_seconds: int = 3600, dry_run: bool = False) -> List[str]:
+    """
+    Delete files under ``MEDIA_ROOT/documents`` that no document references.
+
+    Files younger than ``grace_seconds`` are kept: uploads are written before
+    their document row is committed.
+    """
+    root = Path(settings.MEDIA_ROOT)
+    upload_dir = root / UPLOAD_DIR
+    if not upload_dir.is_dir():
+        return []
+    cutoff = time.time() - grace_seconds
+    removed = []
+    for directory, _, files in os.walk(upload_dir):
+        names = [
+            Path(directory, name).relative_to(root).as_posix()
+            for name in files
+            if os.path.getmtime(os.path.join(directory, name)) < cutoff
+        ]
+        if not names:
+            continue
+        referenced = set(Document.all_objects.filter(file__in=names).values_list('file', flat=True))
+        for name in names:
+            if name not in referenced:
+                if not dry_run:
+                    default_storage.delete(name)
+                removed.append(name)
+    return removed
+
+
+def reap(batch_size: int = None, orphan_grace_seconds: int = None) -> Dict:
+    """Delete every soft-deleted document, conversation and chatbot, then sweep orphaned files"""
+    batch_size = batch_size or settings.REAP_BATCH_SIZE
+    if orphan_grace_seconds is None:
+        orphan_grace_seconds = settings.ORPHAN_FILE_GRACE_SECONDS
+    return {
+        **reap_documents(batch_size),
+        **reap_conversations(batch_size),
+        **reap_chatbots(),
+        'orphaned_files': len(remove_orphaned_files(orphan_grace_seconds)),
+    }
+
+
+def _run():
+    # Rows deleted while this run is underway schedule the next one
+    _pending.clear()
+    try:
+        summary = reap()
+        logger.info("Reaped %s", summary)
+    except Exception:
+        logger.exception("Reaping soft-deleted rows failed")
+    finally:
+        connections.close_all()
+
+
+def schedule_reap() -> None:
+    """Reap in the background after the current transaction commits"""
+    if not settings.REAP_IN_BACKGROUND:
+        return
+
+    def submit():
+        if not _pending.is_set():
+            _pending.set()
+            _executor.submit(_run)
+
+    transaction.on_commit(submit)
@@ -0,0 +1,341 @@
+"""
+Knowledge-base snapshots: export, import and server-side cloning.
+
+A snapshot is a ZIP archive with a columnar layout, so a tuned chatbot can be
+copied to another tenant or environment without re-embedding anything:
+
+    manifest.json    chatbot configuration and document metadata
+    chunks.json      chunk columns (document, chunk_index, content, metadata)
+    embeddings.npy   float64 matrix, one row per chunk (NaN rows = no embedding)
+    files/<n>/<name> original uploads, when exported with include_files
+"""
+
+import csv
+import io
+import json
+import zipfile
+from typing import Dict, List
+
+import numpy as np
+from django.core.files import File
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from chatbots.models import Chatbot
+from documents.models import Document, DocumentChunk
+
+
+SNAPSHOT_FORMAT = 'ragbot-snapshot'
+SNAPSHOT_VERSION = 1
+INSERT_BATCH_SIZE = 5000
+
+CHATBOT_FIELDS = [
+    'name', 'description', 'system_prompt', 'temperature', 'max_tokens', 'chunk_size', 'chunk_overlap',
+    'mmr_enabled', 'mmr_lambda', 'duplicate_threshold', 'embedding_reduction', 'embedding_dimensions',
+    'response_deadline_seconds',
+]
+DOCUMENT_FIELDS = ['file_name', 'file_type', 'file_size', 'content_hash', 'status', 'chunk_count', 'error_message']
+# Required type of every document entry key; content_hash is optional (older snapshots lack it)
+ENTRY_TYPES = {
+    'file_name': (str,), 'file_type': (str,), 'file_size': (int,), 'status': (str,), 'chunk_count': (int,),
+    'error_message': (str, type(None)), 'processed_at': (str, type(None)), 'file': (str, type(None)),
+}
+DOCUMENT_STATUSES = {value for value, _ in Document.STATUS_CHOICES}
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+def export_snapshot(chatbot: Chatbot, fileobj, include_files: bool = True) -> Dict:
+    """Write ``chatbot``'s knowledge base to ``fileobj`` as a snapshot archive"""
+    documents = list(chatbot.documents.order_by('id'))
+    positions = {document.id: i for i, document in enumerate(documents)}
+
+    chunks = DocumentChunk.objects.filter(
+        document__chatbot=chatbot, document__deleted_at__isnull=True
+    ).order_by('document_id', 'chunk_index')
+    total = chunks.count()
+    columns = {'document': [], 'chunk_index': [], 'content': [], 'metadata': []}
+    matrix = None
+
+    rows = chunks.values_list('document_id', 'chunk_index', 'content', 'metadata', 'embedding')
+    for row_number, (document_id, chunk_index, content, metadata, embedding) in enumerate(rows.iterator(chunk_size=2000)):
+        columns['document'].append(positions[document_id])
+        columns['chunk_index'].append(chunk_index)
+        columns['content'].append(content)
+        columns['metadata'].append(metadata)
+        if embedding:
+            if matrix is None:
+                # Embeddings are stored as float64 JSON; keep every bit
+                matrix = np.full((total, len(embedding)), np.nan, dtype=np.float64)
+            matrix[row_number] = embedding
+
+    if matrix is None:
+        matrix = np.empty((total, 0), dtype=np.float64)
+
+    manifest = {
+        'format': SNAPSHOT_FORMAT,
+        'version': SNAPSHOT_VERSION,
+        'exported_at': timezone.now().isoformat(),
+        'chatbot': {field: getattr(chatbot, field) for field in CHATBOT_FIELDS},
+        'documents': [],
+        'chunk_count': total,
+        'embedding_dim': matrix.shape[1],
+    }
+
+    with zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for i, document in enumerate(documents):
+            entry = {field: getattr(document, field) for field in DOCUMENT_FIELDS}
+            entry['processed_at'] = document.processed_at.isoformat() if document.processed_at else None
+            entry['file'] = None
+            if include_files and document.file and document.file.storage.exists(document.file.name):
+                entry['file'] = f'files/{i}/{document.file_name}'
+                with document.file.open('rb') as source, archive.open(entry['file'], 'w', force_zip64=True) as target:
+                    for block in source.chunks():
+                        target.write(block)
+            manifest['documents'].append(entry)
+
+        archive.writestr('manifest.json', json.dumps(manifest))
+        archive.writestr('chunks.json', json.dumps(columns))
+        # Floats barely compress; store the matrix as-is
+        matrix_info = zipfile.ZipInfo('embeddings.npy', date_time=timezone.now().timetuple()[:6])
+        matrix_info.compress_type = zipfile.ZIP_STORED
+        with archive.open(matrix_info, 'w', force_zip64=True) as target:
+            np.save(target, matrix)
+
+    return {'documents': len(documents), 'chunks': total, 'embedding_dim': manifest['embedding_dim']}
+
+
+def read_manifest(fileobj) -> Dict:
+    try:
+        with zipfile.ZipFile(fileobj) as archive:
+            manifest = json.loads(archive.read('manifest.json'))
+    except (zipfile.BadZipFile, KeyError, ValueError):
+        raise SnapshotError('Not a valid chatbot snapshot')
+    finally:
+        fileobj.seek(0)
+    if not isinstance(manifest, dict) or manifest.get('format') != SNAPSHOT_FORMAT \
+            or manifest.get('version') != SNAPSHOT_VERSION:
+        raise SnapshotError('Unsupported snapshot format or version')
+    if not isinstance(manifest.get('documents'), list):
+        raise SnapshotError('Snapshot manifest has no document list')
+    for position, entry in enumerate(manifest['documents']):
+        _check_entry(position, entry)
+    return manifest
+
+
+def _check_entry(position: int, entry) -> None:
+    """Reject a manifest document entry with missing keys, wrong types or an unknown status"""
+    if not isinstance(entry, dict):
+        raise SnapshotError(f'Snapshot document {position} is not an object')
+    for key, types in ENTRY_TYPES.items():
+        # bool is an int subclass but never a valid size or count
+        if key not in entry or not isinstance(entry[key], types) or isinstance(entry[key], bool):
+            raise SnapshotError(f'Snapshot document {position} has a missing or invalid "{key}"')
+    if not isinstance(entry.get('content_hash', ''), str):
+        raise SnapshotError(f'Snapshot document {position} has an invalid "content_hash"')
+    if entry['status'] not in DOCUMENT_STATUSES:
+        raise SnapshotError(f'Snapshot document {position} has unknown status "{entry["status"]}"')
+    if entry['processed_at'] is not None:
+        try:
+            valid = parse_datetime(entry['processed_at']) is not None
+        except ValueError:
+            valid = False
+        if not valid:
+            raise SnapshotError(f'Snapshot document {position} has an invalid "processed_at"')
+
+
+def import_snapshot(chatbot: Chatbot, fileobj) -> Dict:
+    """
+    Add the documents and chunks of a snapshot to ``chatbot``.
+
+    Documents that were not processed yet when exported, but whose file is in
+    the snapshot, are imported as pending; ``pending_document_ids`` lists
+    them for processing. Without their file they are imported as failed.
+    """
+    manifest = read_manifest(fileobj)
+    saved_files = []
+
+    with zipfile.ZipFile(fileobj) as archive:
+        try:
+            columns = json.loads(archive.read('chunks.json'))
+            with archive.open('embeddings.npy') as source:
+                matrix = np.load(source)
+        except (KeyError, ValueError):
+            raise SnapshotError('Snapshot chunk records or embeddings are missing or corrupt')
+        _check_columns(columns, matrix, len(manifest['documents']))
+        # Checked up front so no uploaded file is saved for a snapshot that is then rejected
+        members = set(archive.namelist())
+        for entry in manifest['documents']:
+            if entry['file'] and entry['file'] not in members:
+                raise SnapshotError(f'Snapshot file {entry["file"]} is missing')
+
+        documents = []
+        for entry in manifest['documents']:
+            document = Document(
+                chatbot=chatbot,
+                processed_at=parse_datetime(entry['processed_at']) if entry['processed_at'] else None,
+                # Snapshots exported before content hashes lack that field
+                **{field: entry[field] for field in DOCUMENT_FIELDS if field in entry},
+            )
+            if entry['file']:
+                info = archive.getinfo(entry['file'])
+                with archive.open(info) as member:
+                    content = File(member, name=entry['file_name'])
+                    content.size = info.file_size
+                    document.file.save(entry['file_name'], content, save=False)
+                saved_files.append(document.file)
+                if document.status != 'completed':
+                    document.status = 'pending'
+            elif document.status in ('pending', 'processing'):
+                # Nothing to process it from; don't leave it waiting forever
+                document.status = 'failed'
+                document.error_message = 'File not included in the snapshot'
+            documents.append(document)
+
+        try:
+            with transaction.atomic():
+                documents = Document.objects.bulk_create(documents)
+                document_ids = [documents[position].id for position in columns['document']]
+                _insert_chunks(document_ids, columns, matrix)
+        except Exception:
+            for stored in saved_files:
+                stored.delete(save=False)
+            raise
+
+    return {
+        'documents': len(documents),
+        'chunks': len(columns['content']),
+        'pending_document_ids': [document.id for document in documents if document.status == 'pending'],
+    }
+
+
+def clone_knowledge_base(source: Chatbot, target: Chatbot) -> Dict:
+    """
+    Copy every document and chunk of ``source`` to ``target`` inside the database.
+
+    Chunks, including their embeddings, are copied with one INSERT ... SELECT
+    so no embedding is ever loaded into Python or re-requested from the API.
+    Uploaded files are copied so each document owns its own file.
+    """
+    sources = list(source.documents.order_by('id'))
+    clones = []
+    try:
+        for document in sources:
+            clone = Document(
+                chatbot=target,
+                processed_at=document.processed_at,
+                **{field: getattr(document, field) for field in DOCUMENT_FIELDS},
+            )
+            if document.file and document.file.storage.exists(document.file.name):
+                with document.file.open('rb') as original:
+                    clone.file.save(document.file_name, File(original), save=False)
+            clones.append(clone)
+
+        with transaction.atomic():
+            clones = Document.objects.bulk_create(clones)
+            mapping = [(original.id, clone.id) for original, clone in zip(sources, clones)]
+            chunk_count = copy_chunks(mapping)
+    except Exception:
+        for clone in clones:
+            if clone.file:
+                clone.file.delete(save=False)
+        raise
+
+    return {'documents': len(clones), 'chunks': chunk_count}
+
+
+def copy_chunks(mapping: List[tuple]) -> int:
+    """Copy all chunks of each ``(source_id, target_id)`` document pair in one statement"""
+    if not mapping:
+        return 0
+    table = DocumentChunk._meta.db_table
+    values = ', '.join(['(%s, %s)'] * len(mapping))
+    params = [value for pair in mapping for value in pair]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            INSERT INTO {table} (document_id, content, chunk_index, embedding, metadata, created_at)
+            SELECT m.dst, c.content, c.chunk_index, c.embedding, c.metadata, %s
+            FROM {table} c
+            JOIN (VALUES {values}) AS m(src, dst) ON c.document_id = m.src
+            """,
+            [timezone.now(), *params],
+        )
+        return cursor.rowcount
+
+
+def _check_columns(columns: Dict, matrix: np.ndarray, document_count: int) -> None:
+    """Reject chunk records that don't line up with the matrix or point past the documents"""
+    try:
+        lengths = {len(columns[name]) for name in ('document', 'chunk_index', 'content', 'metadata')}
+    except (KeyError, TypeError):
+        raise SnapshotError('Snapshot chunk records are incomplete')
+    if lengths != {len(matrix)}:
+        raise SnapshotError('Embedding matrix does not match chunk records')
+    for position in columns['document']:
+        if type(position) is not int or not 0 <= position < document_count:
+            raise SnapshotError('Snapshot chunk refers to a document that is not in the snapshot')
+
+
+def _embedding_json(row) -> str:
+    # Shortest repr keeps the JSON compact and round-trips exactly
+    return '[' + ','.join(row.astype(str)) + ']'
+
+
+def _insert_chunks(document_ids: List[int], columns: Dict, matrix: np.ndarray) -> None:
+    has_embedding = ~np.isnan(matrix).any(axis=1) if matrix.shape[1] else np.zeros(len(matrix), dtype=bool)
+    now = timezone.now()
+
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            # COPY via psycopg2; other drivers fall through to bulk_create
+            if hasattr(cursor.cursor, 'copy_expert'):
+                _copy_insert(cursor, document_ids, columns, matrix, has_embedding, now)
+                return
+
+    batch = []
+    for i, document_id in enumerate(document_ids):
+        batch.append(DocumentChunk(
+            document_id=document_id,
+            content=columns['content'][i],
+            chunk_index=columns['chunk_index'][i],
+            embedding=matrix[i].tolist() if has_embedding[i] else None,
+            metadata=columns['metadata'][i],
+        ))
+        if len(batch) >= INSERT_BATCH_SIZE:
+            DocumentChunk.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        DocumentChunk.objects.bulk_create(batch)
+
+
+def _copy_insert(cursor, document_ids, columns, matrix, has_embedding, now) -> None:
+    """Stream chunk rows into Postgres with COPY, one buffer per batch"""
+    table = DocumentChunk._meta.db_table
+    sql = (
+        f"COPY {table} (document_id, content, chunk_index, embedding, metadata, created_at) "
+        "FROM STDIN WITH (FORMAT csv, NULL '\\N', FORCE_NOT_NULL (content, metadata))"
+    )
+    created_at = now.isoformat()
+    for start in range(0, len(document_ids), INSERT_BATCH_SIZE):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        for i in range(start, min(start + INSERT_BATCH_SIZE, len(document_ids))):
+            writer.writerow([
+                document_ids[i],
+                columns['content'][i],
+                columns['chunk_index'][i],
+                _embedding_json(matrix[i]) if has_embedding[i] else '\\N',
+                json.dumps(columns['metadata'][i]),
+                created_at,
+            ])
+        buffer.seek(0)
+        cursor.copy_expert(sql, buffer)
+
+
+def snapshot_filename(chatbot: Chatbot) -> str:
+    stamp = timezone.now().strftime('%Y%m%d-%H%M%S')
+    return f'chatbot_{chatbot.id}_{stamp}.zip'
@@ -0,0 +1,105 @@
+"""
+Compressed cache of extracted document text, keyed by file content hash.
+
+Parsing PDFs and DOCX files is the slowest part of ingestion, and the same
+bytes are often processed more than once (reprocessing, re-chunking, the
+same file in several chatbots). Extracted text is written gzip-compressed to
+``EXTRACTED_TEXT_CACHE_DIR/<hash[:2]>/<hash>.txt.gz`` while it streams to the
+splitter, and later runs read it back block by block instead of parsing.
+
+Reads refresh an entry's modification time, and whenever a new entry is
+written the least recently used ones are evicted until the cache fits in
+``EXTRACTED_TEXT_CACHE_MB``.
+"""
+
+import gzip
+import logging
+import os
+import tempfile
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 1024 * 1024
+
+
+def _cache_path(content_hash: str) -> Optional[Path]:
+    directory = getattr(settings, 'EXTRACTED_TEXT_CACHE_DIR', '')
+    if not directory or not content_hash:
+        return None
+    return Path(directory) / content_hash[:2] / f'{content_hash}.txt.gz'
+
+
+def cached_blocks(content_hash: str) -> Optional[Iterator[str]]:
+    """Blocks of previously extracted text, or None on a cache miss"""
+    path = _cache_path(content_hash)
+    if path is None:
+        return None
+    try:
+        # Marks the entry as recently used for eviction
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    return _read_blocks(path)
+
+
+def _read_blocks(path: Path) -> Iterator[str]:
+    with gzip.open(path, 'rt', encoding='utf-8') as source:
+        for block in iter(lambda: source.read(BLOCK_SIZE), ''):
+            yield block
+
+
+def caching(content_hash: str, blocks: Iterable[str]) -> Iterator[str]:
+    """
+    Pass ``blocks`` through while writing them to the cache.
+
+    The entry is only published (atomically renamed into place) once the
+    whole text has been read, so a failed extraction never leaves a partial
+    entry behind.
+    """
+    path = _cache_path(content_hash)
+    if path is None:
+        yield from blocks
+        return
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, scratch = tempfile.mkstemp(prefix='.tmp-', dir=path.parent)
+    try:
+        with os.fdopen(fd, 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6) as target:
+            for block in blocks:
+                target.write(block.encode('utf-8'))
+                yield block
+        os.replace(scratch, path)
+    finally:
+        if os.path.exists(scratch):
+            os.remove(scratch)
+    evict(Path(settings.EXTRACTED_TEXT_CACHE_DIR), settings.EXTRACTED_TEXT_CACHE_MB * 1024 * 1024)
+
+
+def evict(directory: Path, max_bytes: int) -> int:
+    """Remove the least recently used entries until ``directory`` holds at most ``max_bytes``"""
+    entries = []
+    for path in directory.glob('*/*.txt.gz'):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+        if total <= max_bytes:
+            break
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+    if removed:
+        logger.info("Evicted %d extracted-text cache entries", removed)
+    return removed
@@ -0,0 +1,244 @@
+"""
+Single-pass, token-aware text splitter.
+
+Replaces langchain's ``RecursiveCharacterTextSplitter`` for ingestion. Text is
+scanned once as a stream of words ("atoms") instead of being re-split
+recursively. Per-atom work stays in C: atoms come from one regex pass, token
+counts from a memoised tiktoken lookup, and chunk boundaries from prefix sums
+with ``bisect``. Each chunk is cut at the best boundary that fits the token
+budget, using the recursive splitter's priority: paragraph (blank line), then
+line, then word. The tail of each chunk is repeated at the start of the next
+as overlap.
+
+An atom is a word together with the whitespace before it, so a chunk is its
+atoms concatenated, stripped, and separators count against the budget. Block
+boundaries of a streamed source never change the atoms, so streaming a text
+gives the same chunks as splitting it whole.
+
+Token counts are summed per atom, which can differ from encoding a whole chunk
+by a token at the rare boundaries where tiktoken merges punctuation with the
+following newline.
+"""
+
+import re
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+from itertools import accumulate
+from typing import Iterable, Iterator, List
+
+import tiktoken
+
+
+DEFAULT_ENCODING = 'cl100k_base'
+
+# Boundary classes, best first, stored one byte per atom: "\n\n", "\n", " ", none
+PARAGRAPH, LINE, WORD, NONE = b'0', b'1', b'2', b'3'
+
+# A run of whitespace and the word after it
+_ATOM = re.compile(r'(\s*)(\S+)')
+# Whitespace a streamed block ends with, and the word after it that may continue
+_OPEN_TAIL = re.compile(r'\s+\S*\Z')
+
+_TOKEN_CACHE_LIMIT = 500_000
+
+
+@lru_cache(maxsize=None)
+def get_encoding(name: str = DEFAULT_ENCODING):
+    return tiktoken.get_encoding(name)
+
+
+class _TokenCounts(dict):
+    """
+    Memoised token count per atom; missing atoms are encoded on first use.
+
+    Atoms include the whitespace before them, so most are ``' word'``.
+    """
+
+    def __init__(self, encoding_name):
+        super().__init__()
+        self.encoding = get_encoding(encoding_name)
+
+    def __missing__(self, atom):
+        if len(self) >= _TOKEN_CACHE_LIMIT:
+            self.clear()
+        count = self[atom] = len(self.encoding.encode(atom, disallowed_special=()))
+        return count
+
+
+class _Boundaries(dict):
+    """Boundary class of the whitespace before an atom, memoised per distinct run"""
+
+    def __missing__(self, space):
+        newlines = space.count('\n')
+        boundary = self[space] = (PARAGRAPH if newlines > 1 else LINE if newlines else WORD if space else NONE)[0]
+        return boundary
+
+
+_boundaries = _Boundaries()
+
+
+_token_counts = {}
+
+
+def _counts_for(encoding_name: str) -> _TokenCounts:
+    counts = _token_counts.get(encoding_name)
+    if counts is None:
+        counts = _token_counts[encoding_name] = _TokenCounts(encoding_name)
+    return counts
+
+
+def clear_token_cache() -> None:
+    _token_counts.clear()
+
+
+def count_tokens(text: str, encoding_name: str = DEFAULT_ENCODING) -> int:
+    return len(get_encoding(encoding_name).encode(text, disallowed_special=()))
+
+
+class TokenTextSplitter:
+    """
+    Split text into chunks of at most ``chunk_size`` tokens with up to
+    ``chunk_overlap`` tokens repeated between consecutive chunks.
+
+    ``min_fill`` is the fraction of ``chunk_size`` a chunk must reach before
+    an earlier, better boundary is preferred to cutting at the budget.
+    """
+
+    def __init__(self, chunk_size: int = 128, chunk_overlap: int = 16,
+                 encoding_name: str = DEFAULT_ENCODING, min_fill: float = 0.5):
+        if chunk_size <= 0:
+            raise ValueError("chunk_size must be positive")
+        if not 0 <= chunk_overlap < chunk_size:
+            raise ValueError("chunk_overlap must be between 0 and chunk_size")
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.min_fill = min_fill
+        self.encoding = get_encoding(encoding_name)
+        self._counts = _counts_for(encoding_name)
+
+    def split_text(self, text: str) -> List[str]:
+        return list(self.iter_chunks([text]))
+
+    def iter_chunks(self, blocks: Iterable[str]) -> Iterator[str]:
+        """Yield chunks from an iterable of text blocks (pages, file reads, ...)"""
+        words: List[str] = []
+        tokens: List[int] = []
+        boundaries = bytearray()
+        carried = 0  # atoms at the head of the buffer repeated from the last chunk
+
+        for piece in self._complete_pieces(blocks):
+            self._extend(piece, words, tokens, boundaries)
+            consumed, carried = yield from self._pack(words, tokens, boundaries, carried, final=False)
+            del words[:consumed], tokens[:consumed], boundaries[:consumed]
+
+        yield from self._pack(words, tokens, boundaries, carried, final=True)
+
+    def _complete_pieces(self, blocks: Iterable[str]) -> Iterator[str]:
+        """
+        Re-cut blocks so no atom straddles two pieces.
+
+        The whitespace a block ends with is held back with the word after it,
+        so each piece after the first starts with a whole whitespace run.
+        """
+        pending = ''
+        for block in blocks:
+            if not block:
+                continue
+            buffer = pending + block
+            tail = _OPEN_TAIL.search(buffer)
+            hold = tail.start() if tail else 0
+            pending = buffer[hold:]
+            if hold:
+                yield buffer[:hold]
+        if pending.strip():
+            yield pending
+
+    def _extend(self, piece, words, tokens, boundaries):
+        """
+        Append the atoms of ``piece``.
+
+        Each atom keeps the whitespace before it, so ``''.join`` restores the
+        text and an atom's count includes its separator.
+        """
+        atoms = _ATOM.findall(piece)
+        start = len(tokens)
+        words.extend(space + word for space, word in atoms)
+        boundaries += bytes(_boundaries[space] for space, _ in atoms)
+        tokens.extend(map(self._counts.__getitem__, words[start:]))
+        if max(tokens[start:], default=0) > self.chunk_size:
+            self._split_oversized(start, words, tokens, boundaries)
+
+    def _split_oversized(self, start, words, tokens, boundaries):
+        """Slice words longer than the whole budget into token-sized atoms"""
+        step = self.chunk_size - self.chunk_overlap
+        new_words, new_tokens, new_boundaries = [], [], bytearray()
+        for word, count, boundary in zip(words[start:], tokens[start:], boundaries[start:]):
+            if count <= self.chunk_size:
+                new_words.append(word)
+                new_tokens.append(count)
+                new_boundaries.append(boundary)
+                continue
+            ids = self.encoding.encode(word, disallowed_special=())
+            for i, offset in enumerate(range(0, len(ids), step)):
+                piece = ids[offset:offset + step]
+                new_words.append(self.encoding.decode(piece))
+                new_tokens.append(len(piece))
+                new_boundaries.append(boundary if i == 0 else NONE[0])
+        words[start:] = new_words
+        tokens[start:] = new_tokens
+        boundaries[start:] = new_boundaries
+
+    @staticmethod
+    def _text(words, start, end):
+        # Slices of a long whitespace run can leave nothing to emit
+        text = ''.join(words[start:end]).strip()
+        if text:
+            yield text
+
+    def _pack(self, words, tokens, boundaries, carried, final):
+        """
+        Emit every chunk whose end is already decided.
+
+        Returns ``(consumed, carried)``: how many leading atoms can be dropped
+        from the buffer, and how many of the remaining ones are overlap.
+        """
+        prefix = [0, *accumulate(tokens)]
+        total = len(tokens)
+        start = 0
+
+        while start < total:
+            limit = prefix[start] + self.chunk_size
+            end = bisect_right(prefix, limit) - 1
+            if end >= total:
+                # Everything left fits; wait for more text unless this is the end
+                if final and total - start > carried:
+                    yield from self._text(words, start, total)
+                    return total, 0
+                break
+
+            # Only prefer a better boundary once the chunk is reasonably full
+            filled = bisect_left(prefix, prefix[start] + self.min_fill * self.chunk_size)
+            low = max(start + carried + 1, min(filled, end))
+            if low > end:
+                # Overlap plus the next atom exceed the budget: drop the overlap
+                start += carried
+                carried = 0
+                continue
+
+            cut = self._best_cut(boundaries, low, end)
+            yield from self._text(words, start, cut)
+
+            next_start = bisect_left(prefix, prefix[cut] - self.chunk_overlap, start + 1, cut)
+            carried = cut - next_start
+            start = next_start
+
+        return start, carried
+
+    @staticmethod
+    def _best_cut(boundaries, low, end):
+        """Latest index in [low, end] starting at the best boundary class"""
+        for boundary in (PARAGRAPH, LINE, WORD):
+            cut = boundaries.rfind(boundary, low, end + 1)
+            if cut >= 0:
+                return cut
+        return end
@@ -0,0 +1,121 @@
+"""
+Cheap admission checks for the chat endpoint.
+
+Both checks run before any retrieval or embedding work: token buckets kept in
+the cache backend throttle bursts per client IP and per chatbot, and the
+owner's monthly query quota is consumed with a single conditional UPDATE.
+"""
+
+import math
+import threading
+import time
+from datetime import datetime, time as dt_time, timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db.models import Case, F, Q, Value, When
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+# Retry-After for a bucket that never refills (a rate of 0); its entry expires after this long
+NO_REFILL_SECONDS = 3600
+
+
+class TokenBucket:
+    """
+    Token bucket stored in the Django cache as ``(tokens, last_refill)``.
+
+    Entries expire once the bucket would have refilled completely, so idle
+    keys cost nothing; a rate of 0 allows ``burst`` requests per
+    ``NO_REFILL_SECONDS``. The lock only serialises threads of this process;
+    with a shared cache a concurrent refill may occasionally let one extra
+    request through, which is acceptable for abuse protection.
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, scope: str, per_minute: int, burst: int):
+        self.scope = scope
+        self.rate = per_minute / 60.0
+        self.burst = max(1, burst)
+        self.ttl = math.ceil(self.burst / self.rate) + 1 if self.rate else NO_REFILL_SECONDS
+
+    def consume(self, key, tokens: int = 1) -> float:
+        """Take ``tokens`` from the bucket; return 0 if allowed, else seconds to wait"""
+        cache_key = f'ratelimit:{self.scope}:{key}'
+        now = time.time()
+        with self._lock:
+            state = cache.get(cache_key)
+            available, last = state if state else (self.burst, now)
+            available = min(self.burst, available + (now - last) * self.rate)
+            if available >= tokens:
+                cache.set(cache_key, (available - tokens, now), timeout=self.ttl)
+                return 0.0
+            if not self.rate:
+                # Rejections must not push back the expiry that refills the bucket
+                return float(NO_REFILL_SECONDS)
+            cache.set(cache_key, (available, now), timeout=self.ttl)
+        return (tokens - available) / self.rate
+
+
+def _bucket(scope: str) -> TokenBucket:
+    limits = settings.CHAT_RATE_LIMITS[scope]
+    return TokenBucket(scope, limits['per_minute'], limits['burst'])
+
+
+def client_ip(request) -> str:
+    if getattr(settings, 'CHAT_TRUST_X_FORWARDED_FOR', False):
+        forwarded = request.META.get('HTTP_X_FORWARDED_FOR')
+        if forwarded:
+            return forwarded.split(',')[0].strip()
+    return request.META.get('REMOTE_ADDR', 'unknown')
+
+
+def check_chat_rate_limits(request, chatbot_id: int) -> float:
+    """Return 0 if the chat request may proceed, else the Retry-After in seconds"""
+    wait = _bucket('ip').consume(client_ip(request))
+    if wait:
+        return wait
+    return _bucket('chatbot').consume(chatbot_id)
+
+
+def _current_period():
+    return timezone.localdate().replace(day=1)
+
+
+def seconds_until_next_period() -> int:
+    period = _current_period()
+    next_period = (period + timedelta(days=32)).replace(day=1)
+    start = timezone.make_aware(datetime.combine(next_period, dt_time.min))
+    return max(1, math.ceil((start - timezone.now()).total_seconds()))
+
+
+def consume_query_quota(owner_id: int, count: int = 1) -> bool:
+    """
+    Atomically count ``count`` queries against the owner's monthly quota.
+
+    A single UPDATE resets the counter when the month rolled over, increments
+    it otherwise, and matches no row when the quota cannot cover ``count``.
+    """
+    period = _current_period()
+    User = get_user_model()
+    updated = User.objects.filter(
+        Q(pk=owner_id, max_queries_per_month__gte=count),
+        ~Q(quota_period=period) | Q(quota_period__isnull=True)
+        | Q(queries_this_month__lte=F('max_queries_per_month') - count),
+    ).update(
+        queries_this_month=Case(
+            When(quota_period=period, then=F('queries_this_month') + count),
+            default=Value(count),
+        ),
+        quota_period=period,
+    )
+    return updated == 1
+
+
+def refund_query_quota(owner_id: int, count: int = 1) -> None:
+    """Give back queries that failed before producing an answer"""
+    User = get_user_model()
+    User.objects.filter(
+        pk=owner_id, quota_period=_current_period(), queries_this_month__gt=0
+    ).update(queries_this_month=Greatest(F('queries_this_month') - count, Value(0)))
@@ -0,0 +1,583 @@
+"""
+In-memory embedding index per chatbot.
+
+Each chatbot's completed chunks are loaded once into a normalised float32
+matrix, ordered by document so every document owns one contiguous row range
+(its segment). Document attributes used for filtering are kept as small
+per-document arrays with precomputed bitmap masks per file type. A filtered
+search resolves the filter against those masks, merges the selected segments
+into contiguous runs and scores only those rows, so its cost scales with the
+selected subset rather than with the whole knowledge base.
+
+Indexes are cached per process within a count and memory budget, and
+revalidated with one aggregate query, so new, reprocessed or deleted
+documents are picked up on the next search.
+
+When ``RAG_INDEX_DIR`` is set, each index version is written once per node
+to ``<RAG_INDEX_DIR>/chatbot_<id>/<version>/`` as ``.npy`` files and every
+worker maps the matrix read-only, so the page cache holds one copy however
+many workers there are. Versions are named after the document signature
+each process reads, written to a scratch directory and renamed into place.
+Loading a version holds a shared lock on the chatbot's directory and
+publishing one an exclusive lock, so old versions are pruned only while no
+process is opening their files. ``prewarm`` loads the indexes of the most
+recently active chatbots ahead of their first chat.
+
+A chatbot with ``embedding_reduction`` set keeps only a reduced copy of its
+vectors: the first ``embedding_dimensions`` components (meaningful for
+Matryoshka-trained models such as ``text-embedding-3-*``), or a PCA
+projection fitted on its own chunks. Rows are renormalised after reduction
+and queries go through the same ``Projection`` before scoring. The setting
+is part of the signature, so changing it builds a new version.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import timezone as dt_timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from django.conf import settings
+from django.db import connections
+from django.db.models import Count, Max, Q
+
+from documents.models import Document, DocumentChunk
+
+
+logger = logging.getLogger(__name__)
+
+
+# Rows sampled to fit a PCA projection
+PCA_FIT_ROWS = 20000
+
+
+class Projection:
+    """Maps full embeddings to a chatbot's reduced, renormalised representation"""
+
+    def __init__(self, method: str, dimensions: int, components=None):
+        self.method = method
+        self.dimensions = dimensions
+        self.components = components          # (dim, dimensions) float32, PCA only
+
+    @classmethod
+    def fit(cls, matrix: np.ndarray, method: str, dimensions: int) -> 'Projection':
+        dimensions = min(dimensions, matrix.shape[1])
+        if method == 'truncate':
+            return cls(method, dimensions)
+        if method != 'pca':
+            raise ValueError(f"Unknown embedding reduction: {method}")
+        sample = matrix
+        if len(matrix) > PCA_FIT_ROWS:
+            rows = np.random.default_rng(0).choice(len(matrix), PCA_FIT_ROWS, replace=False)
+            sample = matrix[np.sort(rows)]
+        sample = np.asarray(sample, dtype=np.float64)
+        # Uncentred principal axes, largest first: cosine similarities of rows
+        # within the kept subspace are preserved exactly
+        _, vectors = np.linalg.eigh(sample.T @ sample)
+        components = vectors[:, ::-1][:, :dimensions]
+        return cls(method, dimensions, np.ascontiguousarray(components, dtype=np.float32))
+
+    def apply(self, vectors) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.method == 'truncate':
+            reduced = vectors[:, :self.dimensions]
+        else:
+            reduced = vectors @ self.components
+        return np.ascontiguousarray(_normalise(reduced), dtype=np.float32)
+
+    @property
+    def nbytes(self) -> int:
+        return self.components.nbytes if self.components is not None else 0
+
+
+class ChatbotIndex:
+
+    def __init__(self, signature, chunk_ids, matrix, document_ids, segments, file_types, uploaded_at,
+                 projection: Optional[Projection] = None):
+        self.signature = signature
+        self.chunk_ids = chunk_ids            # (rows,) int64
+        self.matrix = matrix                  # (rows, dim) float32, unit rows
+        self.document_ids = document_ids      # (documents,) int64, ascending
+        self.segments = segments              # (documents, 2) row range per document
+        self.uploaded_at = uploaded_at        # (documents,) datetime64[us]
+        self.file_types = file_types          # (documents,) str
+        self.projection = projection
+        self.file_type_masks = {
+            file_type: file_types == file_type for file_type in np.unique(file_types)
+        }
+
+    @property
+    def nbytes(self) -> int:
+        projection = self.projection.nbytes if self.projection is not None else 0
+        return self.matrix.nbytes + self.chunk_ids.nbytes + self.segments.nbytes + projection
+
+    def __len__(self):
+        return len(self.chunk_ids)
+
+    def document_mask(self, filters: Optional[Dict] = None) -> np.ndarray:
+        """Boolean mask over documents selected by ``filters``"""
+        mask = np.ones(len(self.document_ids), dtype=bool)
+        if not filters:
+            return mask
+        if filters.get('document_ids') is not None:
+            mask &= np.isin(self.document_ids, np.asarray(filters['document_ids'], dtype=np.int64))
+        if filters.get('file_types') is not None:
+            types = np.zeros_like(mask)
+            for file_type in filters['file_types']:
+                if file_type in self.file_type_masks:
+                    types |= self.file_type_masks[file_type]
+            mask &= types
+        if filters.get('uploaded_after') is not None:
+            mask &= self.uploaded_at >= _datetime64(filters['uploaded_after'])
+        if filters.get('uploaded_before') is not None:
+            mask &= self.uploaded_at < _datetime64(filters['uploaded_before'])
+        return mask
+
+    def row_runs(self, mask: np.ndarray) -> List[Tuple[int, int]]:
+        """Merge the segments of selected documents into contiguous row ranges"""
+        if mask.all():
+            return [(0, len(self))] if len(self) else []
+        selected = self.segments[mask]
+        if not len(selected):
+            return []
+        # A new run starts wherever a segment doesn't continue the previous one
+        breaks = np.flatnonzero(selected[1:, 0] != selected[:-1, 1]) + 1
+        starts = selected[np.r_[0, breaks], 0]
+        stops = selected[np.r_[breaks - 1, len(selected) - 1], 1]
+        return list(zip(starts.tolist(), stops.tolist()))
+
+    def search(self, query_embedding, top_k: int = 5, filters: Optional[Dict] = None) -> List[Tuple[int, float]]:
+        """Return ``(chunk_id, cosine similarity)`` pairs, best first"""
+        return self.search_many([query_embedding], top_k=top_k, filters=filters)[0]
+
+    def search_many(self, query_embeddings, top_k: int = 5, filters: Optional[Dict] = None,
+                    block_size: int = 256) -> List[List[Tuple[int, float]]]:
+        """Score many queries at once; see ``shortlist_many``"""
+        return [
+            list(zip(self.chunk_ids[rows].tolist(), scores.tolist()))
+            for rows, scores in self.shortlist_many(query_embeddings, top_k, filters, block_size)
+        ]
+
+    def shortlist_many(self, query_embeddings, k: int, filters: Optional[Dict] = None,
+                       block_size: int = 256) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Return ``(rows, scores)`` of the ``k`` best rows per query, best first.
+
+        Queries are scored with matrix-matrix products, ``block_size`` at a
+        time to bound the size of the score matrix; the same filter applies
+        to every query. Full-dimension queries are projected like the rows.
+        """
+        queries = np.asarray(query_embeddings, dtype=np.float32).reshape(len(query_embeddings), -1)
+        if self.projection is not None:
+            queries = self.projection.apply(queries)
+        runs = self.row_runs(self.document_mask(filters))
+        if not runs or k <= 0:
+            empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32))
+            return [empty for _ in range(len(queries))]
+
+        if len(runs) == 1:
+            start, stop = runs[0]
+            selected = self.matrix[start:stop]
+            rows = np.arange(start, stop)
+        else:
+            selected = np.concatenate([self.matrix[start:stop] for start, stop in runs])
+            rows = np.concatenate([np.arange(start, stop) for start, stop in runs])
+
+        k = min(k, len(rows))
+        results = []
+        for offset in range(0, len(queries), block_size):
+            block = _normalise(queries[offset:offset + block_size])
+            scores = block @ selected.T                                  # (queries, rows)
+            best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            best_scores = np.take_along_axis(scores, best, axis=1)
+            order = np.argsort(-best_scores, axis=1, kind='stable')
+            best = np.take_along_axis(best, order, axis=1)
+            best_scores = np.take_along_axis(best_scores, order, axis=1)
+            results.extend(zip(rows[best], best_scores))
+        return results
+
+    def rerank(self, rows: np.ndarray, scores: np.ndarray, top_k: int,
+               mmr_lambda: Optional[float] = None, duplicate_threshold: Optional[float] = None) -> np.ndarray:
+        """
+        Pick up to ``top_k`` positions of a shortlist, best first.
+
+        With ``mmr_lambda`` the picks maximise Maximal Marginal Relevance,
+        ``lambda * relevance - (1 - lambda) * max similarity to earlier picks``,
+        updated incrementally from one pairwise similarity matrix. With
+        ``duplicate_threshold``, picks at least that similar to an earlier
+        pick are dropped without replacement, so the context gets shorter.
+        """
+        vectors = np.asarray(self.matrix[rows])
+        similarity = vectors @ vectors.T                                 # (shortlist, shortlist)
+
+        if mmr_lambda is None:
+            picks = list(range(min(top_k, len(rows))))
+        else:
+            relevance = np.asarray(scores, dtype=np.float32)
+            redundancy = np.zeros(len(rows), dtype=np.float32)
+            available = np.ones(len(rows), dtype=bool)
+            picks = []
+            for _ in range(min(top_k, len(rows))):
+                marginal = mmr_lambda * relevance - (1 - mmr_lambda) * redundancy
+                pick = int(np.argmax(np.where(available, marginal, -np.inf)))
+                picks.append(pick)
+                available[pick] = False
+                redundancy = np.maximum(redundancy, similarity[pick])
+
+        if duplicate_threshold:
+            kept = []
+            for pick in picks:
+                if not kept or similarity[pick, kept].max() < duplicate_threshold:
+                    kept.append(pick)
+            picks = kept
+        return np.array(picks, dtype=np.int64)
+
+
+def _normalise(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def _datetime64(value) -> np.datetime64:
+    # Index timestamps are naive UTC
+    if getattr(value, 'tzinfo', None) is not None:
+        value = value.astimezone(dt_timezone.utc).replace(tzinfo=None)
+    return np.datetime64(value, 'us')
+
+
+def index_signature(chatbot_id: int) -> Tuple:
+    """
+    Cheap fingerprint of a chatbot's completed documents and reduction setting.
+
+    ``(count, last_id, last_processed, reduction, dimensions)``, read with one query.
+    """
+    from chatbots.models import Chatbot
+
+    completed = Q(documents__status='completed', documents__deleted_at__isnull=True)
+    row = (
+        Chatbot.objects.filter(id=chatbot_id)
+        .annotate(
+            completed_count=Count('documents', filter=completed),
+            last_id=Max('documents__id', filter=completed),
+            last_processed=Max('documents__processed_at', filter=completed),
+        )
+        .order_by()
+        .values_list('completed_count', 'last_id', 'last_processed', 'embedding_reduction', 'embedding_dimensions')
+        .first()
+    )
+    if row is None:
+        return 0, None, None, 'none', None
+    count, last_id, last_processed, reduction, dimensions = row
+    if reduction == 'none' or not dimensions:
+        reduction, dimensions = 'none', None
+    return count, last_id, last_processed, reduction, dimensions
+
+
+def reduce_index(index: ChatbotIndex, method: str, dimensions: int) -> ChatbotIndex:
+    """A copy of full-dimension ``index`` searching a reduced representation"""
+    if not len(index) or dimensions >= index.matrix.shape[1]:
+        return index
+    projection = Projection.fit(index.matrix, method, dimensions)
+    return ChatbotIndex(
+        signature=index.signature,
+        chunk_ids=index.chunk_ids,
+        matrix=projection.apply(index.matrix),
+        document_ids=index.document_ids,
+        segments=index.segments,
+        file_types=index.file_types,
+        uploaded_at=index.uploaded_at,
+        projection=projection,
+    )
+
+
+def build_index(chatbot_id: int, signature: Optional[Tuple] = None, reduce: bool = True) -> ChatbotIndex:
+    """Load the chatbot's chunks; ``reduce=False`` ignores its embedding reduction"""
+    if signature is None:
+        signature = index_signature(chatbot_id)
+
+    documents = list(
+        Document.objects.filter(chatbot_id=chatbot_id, status='completed')
+        .order_by('id')
+        .values_list('id', 'file_type', 'uploaded_at')
+    )
+    rows = (
+        DocumentChunk.objects.filter(document__chatbot_id=chatbot_id, document__status='completed',
+                                     document__deleted_at__isnull=True, embedding__isnull=False)
+        .order_by('document_id', 'chunk_index')
+        .values_list('id', 'document_id', 'embedding')
+    )
+
+    chunk_ids, row_documents, vectors = [], [], []
+    for chunk_id, document_id, embedding in rows.iterator(chunk_size=2000):
+        if embedding:
+            chunk_ids.append(chunk_id)
+            row_documents.append(document_id)
+            vectors.append(embedding)
+
+    document_ids = np.array([row[0] for row in documents], dtype=np.int64)
+    row_documents = np.array(row_documents, dtype=np.int64)
+    # Rows are sorted by document, so each document's rows are one slice
+    starts = np.searchsorted(row_documents, document_ids, side='left')
+    stops = np.searchsorted(row_documents, document_ids, side='right')
+
+    matrix = _normalise(np.array(vectors, dtype=np.float32)) if vectors else np.empty((0, 0), dtype=np.float32)
+    index = ChatbotIndex(
+        signature=signature,
+        chunk_ids=np.array(chunk_ids, dtype=np.int64),
+        matrix=matrix,
+        document_ids=document_ids,
+        segments=np.stack([starts, stops], axis=1) if len(documents) else np.empty((0, 2), dtype=np.int64),
+        file_types=np.array([row[1] for row in documents], dtype=object),
+        uploaded_at=np.array([_datetime64(row[2]) for row in documents], dtype='datetime64[us]'),
+    )
+    reduction, dimensions = signature[3:]
+    if reduce and reduction != 'none':
+        index = reduce_index(index, reduction, dimensions)
+    return index
+
+
+def _index_dir() -> Optional[Path]:
+    directory = getattr(settings, 'RAG_INDEX_DIR', '')
+    return Path(directory) if directory else None
+
+
+def version_name(signature: Tuple) -> str:
+    """Directory name of an index version, derived from its signature"""
+    count, last_id, last_processed, reduction, dimensions = signature
+    stamp = int(last_processed.timestamp() * 1_000_000) if last_processed else 0
+    name = f'v{count}-{last_id or 0}-{stamp}'
+    return name if reduction == 'none' else f'{name}-{reduction}{dimensions}'
+
+
+@contextmanager
+def _directory_lock(chatbot_dir: Path, shared: bool = False):
+    """Shared to load versions, exclusive to publish or prune them"""
+    chatbot_dir.mkdir(parents=True, exist_ok=True)
+    with open(chatbot_dir / '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _write_version(index: ChatbotIndex, target: Path) -> None:
+    """Write ``index`` to a scratch directory, then rename it into place"""
+    scratch = Path(tempfile.mkdtemp(prefix=f'.{target.name}-', dir=target.parent))
+    try:
+        np.save(scratch / 'matrix.npy', index.matrix)
+        np.save(scratch / 'chunk_ids.npy', index.chunk_ids)
+        np.save(scratch / 'document_ids.npy', index.document_ids)
+        np.save(scratch / 'segments.npy', index.segments)
+        np.save(scratch / 'uploaded_at.npy', index.uploaded_at)
+        with open(scratch / 'file_types.json', 'w') as meta:
+            json.dump(index.file_types.tolist(), meta)
+        if index.projection is not None:
+            projection = index.projection
+            with open(scratch / 'projection.json', 'w') as meta:
+                json.dump({'method': projection.method, 'dimensions': projection.dimensions}, meta)
+            if projection.components is not None:
+                np.save(scratch / 'projection_components.npy', projection.components)
+        os.rename(scratch, target)
+    except BaseException:
+        shutil.rmtree(scratch, ignore_errors=True)
+        raise
+
+
+def _prune_versions(chatbot_dir: Path, keep: str) -> None:
+    """Drop all versions but ``keep`` and the newest other one; caller holds the exclusive lock"""
+    versions = sorted(
+        (path for path in chatbot_dir.iterdir()
+         if path.is_dir() and path.name.startswith('v') and path.name != keep),
+        key=lambda path: path.stat().st_mtime,
+    )
+    # Processes still mapping a removed version keep their pages until they unmap
+    for path in versions[:-1]:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def _load_version(directory: Path, signature: Tuple) -> ChatbotIndex:
+    with open(directory / 'file_types.json') as meta:
+        file_types = np.array(json.load(meta), dtype=object)
+    projection = None
+    if (directory / 'projection.json').exists():
+        with open(directory / 'projection.json') as meta:
+            projection = Projection(**json.load(meta))
+        if projection.method == 'pca':
+            projection.components = np.load(directory / 'projection_components.npy')
+    return ChatbotIndex(
+        signature=signature,
+        chunk_ids=np.load(directory / 'chunk_ids.npy', mmap_mode='r'),
+        matrix=np.load(directory / 'matrix.npy', mmap_mode='r'),
+        document_ids=np.load(directory / 'document_ids.npy'),
+        segments=np.load(directory / 'segments.npy'),
+        file_types=file_types,
+        uploaded_at=np.load(directory / 'uploaded_at.npy'),
+        projection=projection,
+    )
+
+
+def publish(chatbot_id: int, signature: Optional[Tuple] = None) -> ChatbotIndex:
+    """
+    Make the current index version of a chatbot available to every process.
+
+    Only one process per node builds a given version; the others wait on the
+    lock and map the finished files. Returns the memory-mapped index.
+    """
+    if signature is None:
+        signature = index_signature(chatbot_id)
+    chatbot_dir = _index_dir() / f'chatbot_{chatbot_id}'
+    target = chatbot_dir / version_name(signature)
+    with _directory_lock(chatbot_dir):
+        if not target.exists():
+            _write_version(build_index(chatbot_id, signature), target)
+            _prune_versions(chatbot_dir, target.name)
+        # Mapped files stay readable once loaded, even if a later publish prunes them
+        return _load_version(target, signature)
+
+
+def _load_or_build(chatbot_id: int, signature: Tuple) -> ChatbotIndex:
+    if _index_dir() is None:
+        return build_index(chatbot_id, signature)
+    chatbot_dir = _index_dir() / f'chatbot_{chatbot_id}'
+    target = chatbot_dir / version_name(signature)
+    with _directory_lock(chatbot_dir, shared=True):
+        if target.exists():
+            return _load_version(target, signature)
+    return publish(chatbot_id, signature)
+
+
+def refresh(chatbot_id: int) -> None:
+    """Publish a chatbot's new index version after its documents changed"""
+    invalidate(chatbot_id)
+    if _index_dir() is None:
+        return
+    try:
+        publish(chatbot_id)
+    except Exception:
+        # Searches fall back to building the version on demand
+        logger.exception("Publishing the retrieval index of chatbot %s failed", chatbot_id)
+
+
+_indexes: 'OrderedDict[int, ChatbotIndex]' = OrderedDict()
+_lock = threading.Lock()
+
+
+def _memory_budget() -> int:
+    return getattr(settings, 'RAG_INDEX_MEMORY_MB', 512) * 1024 * 1024
+
+
+def cached_bytes() -> int:
+    with _lock:
+        return sum(index.nbytes for index in _indexes.values())
+
+
+def _store(chatbot_id: int, index: ChatbotIndex) -> None:
+    """Cache ``index``, evicting least recently used ones over the count or memory budget"""
+    with _lock:
+        _indexes[chatbot_id] = index
+        _indexes.move_to_end(chatbot_id)
+        total = sum(cached.nbytes for cached in _indexes.values())
+        limit = getattr(settings, 'RAG_INDEX_CACHE_SIZE', 32)
+        while len(_indexes) > 1 and (len(_indexes) > limit or total > _memory_budget()):
+            _, evicted = _indexes.popitem(last=False)
+            total -= evicted.nbytes
+
+
+def get_index(chatbot_id: int) -> ChatbotIndex:
+    """Return the chatbot's index, rebuilding it if its documents changed"""
+    signature = index_signature(chatbot_id)
+    with _lock:
+        index = _indexes.get(chatbot_id)
+        if index is not None and index.signature == signature:
+            _indexes.move_to_end(chatbot_id)
+            return index
+
+    index = _load_or_build(chatbot_id, signature)
+    _store(chatbot_id, index)
+    return index
+
+
+def invalidate(chatbot_id: Optional[int] = None) -> None:
+    with _lock:
+        if chatbot_id is None:
+            _indexes.clear()
+        else:
+            _indexes.pop(chatbot_id, None)
+
+
+def discard(chatbot_id: int) -> None:
+    """Forget a deleted chatbot's index and remove its published versions"""
+    invalidate(chatbot_id)
+    if _index_dir() is not None:
+        shutil.rmtree(_index_dir() / f'chatbot_{chatbot_id}', ignore_errors=True)
+
+
+def hot_chatbot_ids(limit: int) -> List[int]:
+    """Active chatbots ordered by their most recent conversation activity"""
+    from chatbots.models import Chatbot
+
+    return list(
+        Chatbot.objects.filter(is_active=True)
+        .annotate(last_active=Max('conversations__updated_at'))
+        .filter(last_active__isnull=False)
+        .order_by('-last_active')
+        .values_list('id', flat=True)[:limit]
+    )
+
+
+def prewarm(chatbot_ids: Optional[List[int]] = None, limit: Optional[int] = None,
+            memory_budget: Optional[int] = None) -> List[Dict]:
+    """
+    Load indexes for the given (or the most recently active) chatbots.
+
+    Chatbots are warmed hottest first. An index that would push the cache
+    past ``memory_budget`` bytes is skipped, so warming never evicts a hotter
+    chatbot's index to make room for a colder one.
+    """
+    if chatbot_ids is None:
+        chatbot_ids = hot_chatbot_ids(limit or getattr(settings, 'RAG_PREWARM_CHATBOTS', 20))
+    budget = min(memory_budget or _memory_budget(), _memory_budget())
+
+    warmed = []
+    used = cached_bytes()
+    for chatbot_id in chatbot_ids:
+        signature = index_signature(chatbot_id)
+        with _lock:
+            cached = _indexes.get(chatbot_id)
+        if cached is not None and cached.signature == signature:
+            warmed.append({'chatbot_id': chatbot_id, 'rows': len(cached), 'bytes': cached.nbytes, 'cached': True})
+            continue
+        index = _load_or_build(chatbot_id, signature)
+        if used + index.nbytes > budget:
+            continue
+        _store(chatbot_id, index)
+        used += index.nbytes
+        warmed.append({'chatbot_id': chatbot_id, 'rows': len(index), 'bytes': index.nbytes, 'cached': False})
+    return warmed
+
+
+def start_prewarm_thread() -> threading.Thread:
+    """Prewarm in a daemon thread so process startup isn't blocked"""
+
+    def run():
+        try:
+            warmed = prewarm()
+            logger.info("Prewarmed %d retrieval indexes (%d bytes)", len(warmed), sum(w['bytes'] for w in warmed))
+        except Exception:
+            logger.exception("Retrieval index prewarm failed")
+        finally:
+            connections.close_all()
+
+    thread = threading.Thread(target=run, name='rag-prewarm', daemon=True)
+    thread.start()
+    return thread